@@ -0,0 +1,78 @@
+#
+# Copyright (C) 2017 The Regents of the University of California.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+"""
+TSKBATCH decoding benchmarks, on synthetic messages.
+"""
+
+import common
+import pytimeseries.tsk.proxy
+
+
+def run(results, msg_cnt=1000, kv_per_msg=(10, 100, 1000), key_cnt=100000):
+    keys = common.make_keys(key_cnt)
+    common.install_fake_consumer([])
+    reader = pytimeseries.tsk.proxy.TskReader('bench', common.CHANNEL,
+                                              'bench', 'localhost:9092')
+    ts = common.new_timeseries()
+
+    for kv_cnt in kv_per_msg:
+        params = {'messages': msg_cnt, 'kv_per_msg': kv_cnt}
+        msgs = common.make_messages(keys, msg_cnt, kv_cnt)
+        ops = msg_cnt * kv_cnt
+
+        def handle_msgs(_):
+            kv_cb = lambda key, val: None
+            for msg in msgs:
+                reader.handle_msg(msg, None, kv_cb)
+
+        results.measure('decode.handle_msg', params, ops, handle_msgs)
+
+        # python decoding into a KP, with keys looked up in place
+        kp = ts.new_keypackage(reset=False, disable=True)
+        kp.upsert_many(keys, [0] * len(keys))
+
+        def handle_msgs_views(_):
+            def kv_cb(key, val):
+                kp.set(kp.get_key(key), val)
+            for msg in msgs:
+                reader.handle_msg(msg, None, kv_cb, key_views=True)
+
+        results.measure('decode.handle_msg_views', params, ops,
+                        handle_msgs_views)
+
+        # decoding in the extension, straight into a KP
+        kp = ts.new_keypackage(reset=False, disable=True)
+        msg_cb = lambda *args: kp
+
+        def apply_msgs(_):
+            for msg in msgs:
+                reader.apply_msg(msg, msg_cb)
+
+        results.measure('decode.apply_msg', params, ops, apply_msgs)
+
+    reader.close()
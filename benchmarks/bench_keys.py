@@ -0,0 +1,147 @@
+#
+# Copyright (C) 2017 The Regents of the University of California.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+Key store benchmarks: memory used by the KeyPackage's copy of graphite-style
+keys (on its own, and as a share of all the memory used for a KeyPackage of
+those keys, including libtimeseries' copy), and the rate at which keys are
+added and iterated over.
+
+Keys are added either in order (so that consecutive keys share long
+prefixes, as when a producer writes all the stats of a prefix together) or
+in a shuffled order.
+
+Run on its own (bench_keys.py SIZE ORDER), this prints the growth of the
+resident set size when adding the keys to a KeyPackage, which run() measures
+in a fresh process so that memory freed by earlier runs is not reused.
+
+The suite also runs against builds whose KeyPackage keeps no copy of the
+keys (and so has no key_store_bytes), recording only kp_rss_bytes, so that a
+baseline from such a build gives the net memory cost of the copy.
+"""
+
+import math
+import os
+import subprocess
+import sys
+
+import common
+
+ORDERS = ('grouped', 'shuffled')
+
+
+def key_order(size, order):
+    """Get the key indices, in the given order, as a generator."""
+    if order == 'grouped':
+        return range(size)
+    # a multiplicative permutation of the indices (by a multiplier close to
+    # size / golden ratio, so that consecutive keys end up far apart), so
+    # that shuffled keys do not need to be held in a list
+    mult = int(size * 0.6180339887) | 1
+    while math.gcd(mult, size) != 1:
+        mult += 2
+    return ((i * mult) % size for i in range(size))
+
+
+def add_keys(kp, size, order):
+    add_key = kp.add_key
+    key = common.graphite_key
+    for i in key_order(size, order):
+        add_key(key(i))
+
+
+def kp_rss_bytes(size, order):
+    """
+    Get the growth of the resident set size of a fresh process when adding
+    the keys to a KeyPackage, or None if it cannot be measured.
+    """
+    out = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                   str(size), order])
+    rss = int(out)
+    return rss if rss >= 0 else None
+
+
+def run(results, sizes):
+    ts = common.new_timeseries()
+    for size in sizes:
+        for order in ORDERS:
+            params = {'keys': size, 'order': order}
+
+            # size of the keys, and of the flat store (NUL-terminated keys
+            # with an 8-byte offset each) that KeyPackage used to keep
+            key_bytes = 0
+            for i in range(size):
+                key_bytes += len(common.graphite_key(i))
+            flat_bytes = key_bytes + size * 9
+
+            kps = []
+
+            def new_kp():
+                del kps[:]
+                kps.append(ts.new_keypackage(reset=False))
+                return kps[0]
+
+            # the memory used does not depend on timing, so measure it once
+            # up front
+            add_keys(new_kp(), size, order)
+            extra = {'key_bytes': key_bytes}
+            has_store = hasattr(kps[0], 'key_store_bytes')
+            if has_store:
+                store_bytes = kps[0].key_store_bytes
+                extra.update({
+                    'flat_store_bytes': flat_bytes,
+                    'key_store_bytes': store_bytes,
+                    'key_store_ratio': round(store_bytes / float(flat_bytes),
+                                             3),
+                })
+            # the store only compresses the wrapper's copy of the keys, so
+            # also give its share of all the memory used
+            rss = kp_rss_bytes(size, order)
+            if rss:
+                extra['kp_rss_bytes'] = rss
+                if has_store:
+                    extra['key_store_rss_share'] = round(
+                        store_bytes / float(rss), 3)
+            results.measure('keys.add_key', params, size,
+                            lambda kp: add_keys(kp, size, order),
+                            setup=new_kp, extra=extra)
+
+            def iterate(_):
+                for _ in kps[0].keys():
+                    pass
+
+            if has_store:
+                results.measure('keys.iterate', params, size, iterate)
+            del kps[:]
+
+
+if __name__ == '__main__':
+    ts = common.new_timeseries()
+    before = common.rss_bytes()
+    kp = ts.new_keypackage(reset=False)
+    add_keys(kp, int(sys.argv[1]), sys.argv[2])
+    after = common.rss_bytes()
+    print(-1 if before is None or after is None else after - before)
@@ -0,0 +1,79 @@
+#
+# Copyright (C) 2017 The Regents of the University of California.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+"""
+KeyPackage benchmarks: adding, looking up, setting and flushing keys.
+"""
+
+import array
+
+import common
+
+
+def run(results, sizes):
+    ts = common.new_timeseries()
+    for size in sizes:
+        params = {'keys': size}
+        keys = common.make_keys(size)
+        idxs = list(range(size))
+
+        def add_keys(kp):
+            add_key = kp.add_key
+            for key in keys:
+                add_key(key)
+
+        results.measure('kp.add_key', params, size, add_keys,
+                        setup=lambda: ts.new_keypackage(reset=False))
+
+        # the remaining benchmarks all use a filled KP
+        kp = ts.new_keypackage(reset=False)
+        add_keys(kp)
+
+        def get_keys(_):
+            get_key = kp.get_key
+            for key in keys:
+                get_key(key)
+
+        results.measure('kp.get_key', params, size, get_keys)
+
+        def set_values(_):
+            kp_set = kp.set
+            for idx in idxs:
+                kp_set(idx, idx)
+
+        results.measure('kp.set', params, size, set_values)
+
+        idx_arr = array.array('Q', idxs)
+        val_arr = array.array('Q', idxs)
+        results.measure('kp.set_many', params, size,
+                        lambda _: kp.set_many(idx_arr, val_arr))
+
+        results.measure('kp.upsert_many', params, size,
+                        lambda _: kp.upsert_many(keys, val_arr))
+
+        results.measure('kp.flush', params, size,
+                        lambda _: kp.flush(0))
@@ -0,0 +1,67 @@
+#
+# Copyright (C) 2017 The Regents of the University of California.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+"""
+End-to-end TSK proxy benchmarks, fed by an in-process fake Kafka consumer.
+"""
+
+import os
+
+import common
+import pytimeseries.tsk.proxy
+
+
+def _run_proxy(config, msgs):
+    proxy = None
+
+    def stop():
+        proxy.shutdown = 1
+
+    common.install_fake_consumer(msgs, on_exhausted=stop)
+    proxy = pytimeseries.tsk.proxy.Proxy(config, False)
+    proxy.run()
+
+
+def run(results, msg_cnt=2000, kv_per_msg=500, key_cnt=100000, intervals=5,
+        modes=((0, 1), (2, 2))):
+    keys = common.make_keys(key_cnt)
+    msgs = common.make_messages(keys, msg_cnt, kv_per_msg, intervals)
+    for queue_depth, window in modes:
+        params = {
+            'messages': msg_cnt,
+            'kv_per_msg': kv_per_msg,
+            'keys': key_cnt,
+            'flush_queue_depth': queue_depth,
+            'reorder_window': window,
+        }
+        config = common.write_proxy_config(flush_queue_depth=queue_depth,
+                                           reorder_window=window)
+        try:
+            results.measure('proxy.run', params, msg_cnt * kv_per_msg,
+                            lambda _: _run_proxy(config, msgs))
+        finally:
+            os.unlink(config)
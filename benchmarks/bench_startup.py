@@ -0,0 +1,89 @@
+#
+# Copyright (C) 2017 The Regents of the University of California.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+Startup benchmarks: the time taken by a new interpreter to import the TSK
+proxy and to check a proxy configuration (pytsk-proxy --check-config), and
+the time taken to create a Proxy (which does not enable backends until they
+are first needed).
+"""
+
+import os
+import subprocess
+import sys
+
+import common
+import pytimeseries.tsk.proxy
+
+# modules that should only be imported once they are used
+LAZY_MODULES = ('confluent_kafka', '_pytimeseries',
+                'pytimeseries.tsk.supervisor')
+
+LAUNCHES = 5
+
+
+def _launch(args):
+    subprocess.check_call([sys.executable] + args)
+
+
+def _loaded_modules(code):
+    out = subprocess.check_output([
+        sys.executable, '-c',
+        code + "; import sys; print(' '.join(m for m in %r "
+               "if m in sys.modules))" % (LAZY_MODULES,)])
+    return out.decode().split()
+
+
+def run(results):
+    config = common.write_proxy_config()
+    try:
+        commands = [
+            ('startup.python', ['-c', 'pass'], None),
+            ('startup.import_proxy',
+             ['-c', 'import pytimeseries.tsk.proxy'],
+             'import pytimeseries.tsk.proxy'),
+            ('startup.check_config',
+             ['-m', 'pytimeseries.tsk.proxy', '-c', config,
+              '--check-config'],
+             None),
+        ]
+        for (name, args, code) in commands:
+            extra = None
+            if code is not None:
+                extra = {'lazy_modules_loaded': _loaded_modules(code)}
+            results.measure(name, {}, LAUNCHES,
+                            lambda _: [_launch(args)
+                                       for _ in range(LAUNCHES)],
+                            extra=extra)
+
+        def new_proxy(_):
+            proxy = pytimeseries.tsk.proxy.Proxy(config, False)
+            proxy.tsk_reader.close()
+
+        common.install_fake_consumer([])
+        results.measure('startup.proxy_init', {}, 1, new_proxy)
+    finally:
+        os.unlink(config)
@@ -0,0 +1,276 @@
+#
+# Copyright (C) 2017 The Regents of the University of California.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+"""
+Helpers shared by the benchmarks.
+"""
+
+import os
+import struct
+import tempfile
+import time
+
+import _pytimeseries
+
+# the ascii backend, writing to /dev/null (so that the benchmarks measure
+# PyTimeSeries and libtimeseries rather than the disk)
+BACKEND = 'ascii'
+BACKEND_OPTS = '-f /dev/null'
+
+CHANNEL = 'bench'
+
+
+class Results:
+    """
+    Collects benchmark results.
+
+    Each result is identified by its name and parameters, which is what runs
+    are compared on.
+    """
+
+    def __init__(self, repeat=3):
+        self.repeat = repeat
+        self.results = []
+
+    def add(self, name, params, ops, seconds, extra=None):
+        rate = ops / seconds if seconds > 0 else float('inf')
+        result = {
+            'name': name,
+            'params': params,
+            'ops': ops,
+            'seconds': seconds,
+            'ops_per_sec': rate,
+        }
+        result.update(extra or {})
+        self.results.append(result)
+        print("%-28s %-32s %12d ops %10.4fs %14.0f ops/s" %
+              (name, format_params(params), ops, seconds, rate))
+        for key in sorted(extra or {}):
+            print("%-28s %-32s %s=%s" % ("", "", key, extra[key]))
+
+    def measure(self, name, params, ops, fn, setup=None, extra=None):
+        """
+        Time fn (which performs ops operations), keeping the best of
+        self.repeat runs. If given, setup is called before each run (untimed)
+        and its return value passed to fn, and extra holds additional fields
+        (e.g. memory use) to record with the result.
+        """
+        best = None
+        for _ in range(self.repeat):
+            arg = setup() if setup is not None else None
+            start = time.perf_counter()
+            fn(arg)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        self.add(name, params, ops, best, extra)
+
+
+def format_params(params):
+    return ",".join("%s=%s" % (k, params[k]) for k in sorted(params))
+
+
+def result_id(result):
+    return "%s[%s]" % (result['name'], format_params(result['params']))
+
+
+def rss_bytes():
+    """Get the resident set size of this process, or None if unknown."""
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def new_timeseries():
+    ts = _pytimeseries.Timeseries()
+    be = ts.get_backend_by_name(BACKEND)
+    if not be or not ts.enable_backend(be, BACKEND_OPTS):
+        raise RuntimeError("Could not enable the %s backend" % BACKEND)
+    return ts
+
+
+def make_keys(cnt, prefix='bench.key'):
+    return [("%s.%08d" % (prefix, i)).encode() for i in range(cnt)]
+
+
+def graphite_key(i, groups=8, channels=4, stats=16):
+    """
+    Get the i-th of a set of graphite keys shaped like those written by TSK
+    producers (systems.services.tsk.<group>.<prefix>.<channel>.<stat>).
+    Consecutive keys share most of their prefix.
+    """
+    (i, stat) = divmod(i, stats)
+    (i, channel) = divmod(i, channels)
+    (pfx, group) = divmod(i, groups)
+    return ("systems.services.tsk.group-%d.10_%d_%d_0__24.channel-%d."
+            "stat_%02d" % (group, pfx >> 8 & 0xff, pfx & 0xff, channel,
+                           stat)).encode()
+
+
+def make_tskbatch(msg_time, channel, kvs):
+    """Encode a TSKBATCH message with the given (key, value) pairs."""
+    channel = channel.encode()
+    parts = [b"TSKBATCH",
+             struct.pack("!BLH", 0, msg_time, len(channel)), channel]
+    for key, val in kvs:
+        parts.append(struct.pack("!H", len(key)))
+        parts.append(key)
+        parts.append(struct.pack("!Q", val))
+    return b"".join(parts)
+
+
+def make_messages(keys, msg_cnt, kv_per_msg, intervals=1, interval=60):
+    """
+    Build msg_cnt TSKBATCH messages of kv_per_msg key/values each, cycling
+    through the given keys and spreading the messages over the given number
+    of intervals.
+    """
+    msgs = []
+    key_idx = 0
+    per_interval = max(1, msg_cnt // intervals)
+    for i in range(msg_cnt):
+        kvs = []
+        for _ in range(kv_per_msg):
+            kvs.append((keys[key_idx], key_idx))
+            key_idx = (key_idx + 1) % len(keys)
+        msg_time = (i // per_interval) * interval
+        msgs.append(make_tskbatch(msg_time, CHANNEL, kvs))
+    return msgs
+
+
+class FakeMessage:
+
+    def __init__(self, value, error=None, partition=0):
+        self._value = value
+        self._error = error
+        self._partition = partition
+
+    def error(self):
+        return self._error
+
+    def value(self):
+        return self._value
+
+    def partition(self):
+        return self._partition
+
+
+class FakeConsumer:
+    """
+    An in-process stand-in for confluent_kafka.Consumer that serves a fixed
+    list of message payloads, followed by a partition EOF. on_exhausted is
+    called once the EOF has been consumed.
+    """
+
+    # set by install_fake_consumer before the consumer is created
+    messages = []
+    on_exhausted = None
+
+    def __init__(self, conf):
+        import confluent_kafka
+        self.kafka = confluent_kafka
+        self.pending = [FakeMessage(m) for m in self.messages]
+        self.pending.append(FakeMessage(None, confluent_kafka.KafkaError(
+            confluent_kafka.KafkaError._PARTITION_EOF)))
+        self.pos = 0
+
+    def subscribe(self, topics):
+        pass
+
+    def assign(self, partitions):
+        pass
+
+    def consume(self, num_messages=1, timeout=-1):
+        if self.pos >= len(self.pending):
+            if self.on_exhausted is not None:
+                self.on_exhausted()
+            return []
+        msgs = self.pending[self.pos:self.pos + num_messages]
+        self.pos += len(msgs)
+        return msgs
+
+    def poll(self, timeout=-1):
+        msgs = self.consume(1, timeout)
+        return msgs[0] if msgs else None
+
+    def commit(self, asynchronous=True):
+        pass
+
+    def close(self):
+        pass
+
+
+def install_fake_consumer(messages, on_exhausted=None):
+    """Make confluent_kafka.Consumer serve the given messages."""
+    import confluent_kafka
+    FakeConsumer.messages = messages
+    FakeConsumer.on_exhausted = staticmethod(on_exhausted) \
+        if on_exhausted is not None else None
+    confluent_kafka.Consumer = FakeConsumer
+
+
+PROXY_CONFIG = """
+[logging]
+loglevel = WARNING
+
+[timeseries]
+backends = %(backend)s
+%(backend)s-opts = %(backend_opts)s
+flush_queue_depth = %(flush_queue_depth)d
+reorder_window = %(reorder_window)d
+
+[kafka]
+brokers = localhost:9092
+topic_prefix = bench
+channel = %(channel)s
+consumer_group = bench
+batch_size = %(batch_size)d
+
+[stats]
+ts_backend = %(backend)s
+ts_opts = %(backend_opts)s
+interval = 0
+"""
+
+
+def write_proxy_config(**opts):
+    """Write a proxy config file and return its path."""
+    values = {
+        'backend': BACKEND,
+        'backend_opts': BACKEND_OPTS,
+        'channel': CHANNEL,
+        'flush_queue_depth': 0,
+        'reorder_window': 1,
+        'batch_size': 1000,
+    }
+    values.update(opts)
+    fd, path = tempfile.mkstemp(prefix='pytimeseries-bench-', suffix='.conf')
+    with os.fdopen(fd, 'w') as fh:
+        fh.write(PROXY_CONFIG % values)
+    return path
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2017 The Regents of the University of California.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+"""
+Run the PyTimeSeries benchmarks, optionally comparing against a baseline.
+
+Results are written as JSON, e.g.:
+
+    python benchmarks/run.py -o results.json
+    python benchmarks/run.py -b baseline.json -o results.json
+
+The comparison exits with a non-zero status if any benchmark is slower than
+its baseline by more than the given threshold. Memory use (kp_rss_bytes) is
+compared too, but is only reported.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+import common
+
+SUITES = ('kp', 'keys', 'decode', 'proxy', 'startup')
+
+
+def parse_sizes(spec):
+    return [int(float(s)) for s in spec.split(',') if s]
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results against a baseline.
+
+    :return: list of (result id, baseline rate, current rate, ratio) for
+             each benchmark that regressed
+    """
+    base = dict((common.result_id(r), r) for r in baseline['results'])
+    regressions = []
+    print()
+    print("%-64s %14s %14s %8s" % ("benchmark", "baseline", "current",
+                                   "ratio"))
+    for result in results:
+        rid = common.result_id(result)
+        if rid not in base:
+            print("%-64s %14s %14.0f %8s" % (rid, "-",
+                                              result['ops_per_sec'], "new"))
+            continue
+        base_rate = base[rid]['ops_per_sec']
+        ratio = result['ops_per_sec'] / base_rate if base_rate else 1.0
+        flag = ""
+        if ratio < 1.0 - threshold:
+            regressions.append((rid, base_rate, result['ops_per_sec'], ratio))
+            flag = " REGRESSION"
+        print("%-64s %14.0f %14.0f %8.2f%s" % (rid, base_rate,
+                                               result['ops_per_sec'], ratio,
+                                               flag))
+        base_rss = base[rid].get('kp_rss_bytes')
+        rss = result.get('kp_rss_bytes')
+        if base_rss and rss:
+            print("%-64s %14d %14d %8.2f" % ("  kp_rss_bytes", base_rss, rss,
+                                             rss / float(base_rss)))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""
+    Benchmarks the PyTimeSeries extension and the TSK proxy hot path
+    """)
+    parser.add_argument('-s', '--suites',
+                        required=False, default=",".join(SUITES),
+                        help='Comma-separated suites to run (default: %s)'
+                             % ",".join(SUITES))
+    parser.add_argument('-k', '--kp-sizes',
+                        required=False, default='1e4,1e5,1e6',
+                        type=parse_sizes,
+                        help='Comma-separated KeyPackage sizes '
+                             '(default: 1e4,1e5,1e6; add 1e7 for a full run)')
+    parser.add_argument('-K', '--key-sizes',
+                        required=False, default='1e5,1e6',
+                        type=parse_sizes,
+                        help='Comma-separated key store sizes '
+                             '(default: 1e5,1e6; add 1e7 for a full run)')
+    parser.add_argument('-r', '--repeat',
+                        required=False, default=3, type=int,
+                        help='Number of runs of each benchmark (the fastest '
+                             'is reported)')
+    parser.add_argument('-o', '--output',
+                        required=False,
+                        help='File to write the results to (JSON)')
+    parser.add_argument('-b', '--baseline',
+                        required=False,
+                        help='Results file (JSON) to compare against')
+    parser.add_argument('-t', '--threshold',
+                        required=False, default=0.1, type=float,
+                        help='Slowdown (as a fraction of the baseline rate) '
+                             'that counts as a regression (default: 0.1)')
+    opts = parser.parse_args()
+
+    suites = [s for s in opts.suites.split(',') if s]
+    for suite in suites:
+        if suite not in SUITES:
+            parser.error("Unknown suite '%s'" % suite)
+
+    results = common.Results(repeat=opts.repeat)
+    if 'kp' in suites:
+        import bench_kp
+        bench_kp.run(results, opts.kp_sizes)
+    if 'keys' in suites:
+        import bench_keys
+        bench_keys.run(results, opts.key_sizes)
+    if 'decode' in suites:
+        import bench_decode
+        bench_decode.run(results)
+    if 'proxy' in suites:
+        import bench_proxy
+        bench_proxy.run(results)
+    if 'startup' in suites:
+        import bench_startup
+        bench_startup.run(results)
+
+    output = {
+        'meta': {
+            'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'backend': "%s %s" % (common.BACKEND, common.BACKEND_OPTS),
+            'repeat': opts.repeat,
+        },
+        'results': results.results,
+    }
+    if opts.output:
+        with open(opts.output, 'w') as fh:
+            json.dump(output, fh, indent=2, sort_keys=True)
+
+    if opts.baseline:
+        with open(opts.baseline) as fh:
+            baseline = json.load(fh)
+        regressions = compare(results.results, baseline, opts.threshold)
+        if regressions:
+            print("%d benchmark(s) regressed by more than %d%%" %
+                  (len(regressions), opts.threshold * 100))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
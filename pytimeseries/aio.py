@@ -0,0 +1,131 @@
+#
+# Copyright (C) 2017 The Regents of the University of California.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+"""
+asyncio front-end for PyTimeSeries.
+
+The blocking libtimeseries calls (enabling backends, setting single values,
+resolving and flushing key packages) run on an executor, with the GIL
+released, so that they do not stall the event loop. Calls on the same
+KeyPackage are serialized, so it is safe to await several of them at once.
+"""
+
+import asyncio
+import concurrent.futures
+
+
+class AsyncKeyPackage:
+    """
+    Wraps a KeyPackage for use from a coroutine.
+
+    flush(), resolve(), save_keys() and load_keys() are coroutines that run
+    on the executor. Other KeyPackage methods and attributes are passed
+    through unchanged; since they do not block, they run directly on the
+    event loop. They raise RuntimeError if called while a blocking call is
+    running, so callers that may race with a flush should hold lock, e.g.:
+
+        async with akp.lock:
+            akp.set(idx, value)
+    """
+
+    def __init__(self, kp, executor):
+        self.kp = kp
+        self.executor = executor
+        self.lock = asyncio.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.kp, name)
+
+    async def _call(self, fn, *args):
+        async with self.lock:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, fn, *args)
+
+    async def flush(self, time):
+        return await self._call(self.kp.flush, time)
+
+    async def resolve(self):
+        return await self._call(self.kp.resolve)
+
+    async def save_keys(self, path):
+        return await self._call(self.kp.save_keys, path)
+
+    async def load_keys(self, path):
+        return await self._call(self.kp.load_keys, path)
+
+
+class AsyncTimeseries:
+    """
+    Wraps a Timeseries for use from a coroutine.
+
+    Unless an executor is given, a single-threaded one is created (backend
+    I/O is serialized per Timeseries, so more threads would not help). To
+    flush several Timeseries objects in parallel, share an executor with one
+    thread per Timeseries.
+    """
+
+    def __init__(self, ts=None, executor=None):
+        if ts is None:
+            import _pytimeseries
+            ts = _pytimeseries.Timeseries()
+        self.ts = ts
+        self.own_executor = executor is None
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='pytimeseries')
+        self.executor = executor
+
+    def __getattr__(self, name):
+        return getattr(self.ts, name)
+
+    async def _call(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
+    async def enable_backend(self, *args):
+        return await self._call(self.ts.enable_backend, *args)
+
+    async def set_single(self, key, value, time):
+        return await self._call(self.ts.set_single, key, value, time)
+
+    async def new_keypackage(self, reset=False, disable=False, preload=None,
+                             **kwargs):
+        """
+        Create a KeyPackage (preloading keys, if given, on the executor).
+        Other keyword arguments (e.g. delta, full_every, aggregation) are
+        passed through to Timeseries.new_keypackage.
+
+        :return: AsyncKeyPackage
+        """
+        kp = await self._call(lambda: self.ts.new_keypackage(
+            reset=reset, disable=disable, preload=preload, **kwargs))
+        return AsyncKeyPackage(kp, self.executor)
+
+    def close(self):
+        """Shut down the executor (if it was created by this object)."""
+        if self.own_executor:
+            self.executor.shutdown(wait=True)
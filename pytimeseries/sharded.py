@@ -0,0 +1,162 @@
+#
+# Copyright (C) 2017 The Regents of the University of California.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+"""
+KeyPackage sharded across several Timeseries objects, so that it can be
+flushed on several cores at once.
+"""
+
+import concurrent.futures
+import time
+import zlib
+
+
+def _flush_shard(kp, flush_time):
+    start = time.perf_counter()
+    kp.flush(flush_time)
+    return time.perf_counter() - start
+
+
+class ShardedKeyPackage:
+    """
+    A set of KeyPackages that behaves like a single one.
+
+    Keys are spread across the shards by a hash (CRC-32) of the key. The
+    index of a key is local_index * nshards + shard, so that the shard (and
+    the index within it) can be found from the index alone.
+
+    One shard is created per Timeseries given. Backend I/O is serialized per
+    Timeseries, so shards are only flushed in parallel if each Timeseries is
+    a distinct object with its own enabled backends.
+
+    flush() flushes all shards on worker threads (the extension releases the
+    GIL while flushing) and records how long each shard took in
+    shard_flush_times.
+    """
+
+    def __init__(self, timeseries, reset=True, disable=False):
+        self.shards = [ts.new_keypackage(reset=reset, disable=disable)
+                       for ts in timeseries]
+        if not self.shards:
+            raise ValueError("At least one Timeseries is required")
+        self.nshards = len(self.shards)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.nshards, thread_name_prefix='kp-shard')
+        # duration (in seconds) of the last flush of each shard
+        self.shard_flush_times = [0.0] * self.nshards
+
+    def _shard_of(self, key):
+        return zlib.crc32(key) % self.nshards
+
+    def _split(self, idx):
+        if idx < 0:
+            raise IndexError("key index out of range")
+        return self.shards[idx % self.nshards], idx // self.nshards
+
+    def add_key(self, key):
+        shard = self._shard_of(key)
+        return self.shards[shard].add_key(key) * self.nshards + shard
+
+    def get_key(self, key):
+        shard = self._shard_of(key)
+        idx = self.shards[shard].get_key(key)
+        if idx is None:
+            return None
+        return idx * self.nshards + shard
+
+    def disable_key(self, idx):
+        kp, local = self._split(idx)
+        kp.disable_key(local)
+
+    def enable_key(self, idx):
+        kp, local = self._split(idx)
+        kp.enable_key(local)
+
+    def get(self, idx):
+        kp, local = self._split(idx)
+        return kp.get(local)
+
+    def set(self, idx, val):
+        kp, local = self._split(idx)
+        kp.set(local, val)
+
+    def upsert_many(self, keys, values):
+        """
+        Add (or enable) each of the given keys and set its value.
+
+        :return: number of keys that were added
+        """
+        if len(keys) != len(values):
+            raise ValueError("keys and values must have the same length")
+        shard_keys = [[] for _ in self.shards]
+        shard_vals = [[] for _ in self.shards]
+        nshards = self.nshards
+        crc32 = zlib.crc32
+        for key, val in zip(keys, values):
+            shard = crc32(key) % nshards
+            shard_keys[shard].append(key)
+            shard_vals[shard].append(val)
+        added = 0
+        for kp, skeys, svals in zip(self.shards, shard_keys, shard_vals):
+            if skeys:
+                added += kp.upsert_many(skeys, svals)
+        return added
+
+    def set_many(self, indices, values):
+        """Set the current values of the keys with the given indices."""
+        if len(indices) != len(values):
+            raise ValueError("indices and values must have the same length")
+        shard_idxs = [[] for _ in self.shards]
+        shard_vals = [[] for _ in self.shards]
+        nshards = self.nshards
+        for idx, val in zip(indices, values):
+            shard_idxs[idx % nshards].append(idx // nshards)
+            shard_vals[idx % nshards].append(val)
+        for kp, sidxs, svals in zip(self.shards, shard_idxs, shard_vals):
+            if sidxs:
+                kp.set_many(sidxs, svals)
+
+    def resolve(self):
+        """Resolve the keys of all shards, in parallel."""
+        list(self.executor.map(lambda kp: kp.resolve(), self.shards))
+
+    def flush(self, flush_time):
+        """Flush all shards, in parallel."""
+        self.shard_flush_times = list(self.executor.map(
+            _flush_shard, self.shards, [flush_time] * self.nshards))
+
+    @property
+    def size(self):
+        return sum(kp.size for kp in self.shards)
+
+    @property
+    def enabled_size(self):
+        return sum(kp.enabled_size for kp in self.shards)
+
+    def close(self):
+        """Stop the flush threads."""
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,230 @@
+#
+# Copyright (C) 2017 The Regents of the University of California.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+"""
+asyncio version of the TSK proxy loop.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import time as _time
+import pytimeseries.aio
+import pytimeseries.tsk.proxy
+
+
+class AsyncFlusher:
+    """
+    Flushes KeyPackages as asyncio tasks, with the same interface as
+    pytimeseries.tsk.flusher.Flusher.
+
+    Since acquire() is called from synchronous code, it never blocks:
+    instead, the caller applies backpressure by awaiting wait(), which
+    returns once at most queue_depth flushes are in progress.
+    """
+
+    def __init__(self, timeseries, executor, queue_depth=0, on_flush=None,
+                 **kp_opts):
+        self.timeseries = [pytimeseries.aio.AsyncTimeseries(ts, executor)
+                           for ts in timeseries]
+        if not self.timeseries:
+            raise ValueError("At least one Timeseries is required")
+        if kp_opts.get('delta'):
+            # a KP is acquired for the next interval while the previous one
+            # is still being flushed, so several KPs take turns
+            raise ValueError("Delta KeyPackages cannot be flushed "
+                             "asynchronously")
+        self.queue_depth = queue_depth
+        self.on_flush = on_flush
+        self.kp_opts = kp_opts
+
+        self.kps = []
+        self.free_kps = []
+        self.tasks = set()
+        self.error = None
+
+    def _check_error(self):
+        if self.error is not None:
+            raise RuntimeError("Background flush failed: %s" % self.error)
+
+    def acquire(self):
+        self._check_error()
+        if self.free_kps:
+            return self.free_kps.pop()
+        # KPs are created synchronously (any preload is done here, at
+        # startup, before the event loop has anything else to do)
+        ts = self.timeseries[len(self.kps) % len(self.timeseries)]
+        kp = pytimeseries.aio.AsyncKeyPackage(
+            ts.ts.new_keypackage(**self.kp_opts), ts.executor)
+        self.kps.append(kp)
+        return kp
+
+    def acquire_late(self):
+        # KPs are never in delta mode (see __init__), so late data can go in
+        # any of them
+        return self.acquire()
+
+    async def _flush(self, kp, time):
+        start = _time.perf_counter()
+        try:
+            await kp.flush(time)
+            if self.on_flush is not None:
+                self.on_flush(_time.perf_counter() - start)
+        except Exception as e:
+            logging.error("Failed to flush KP at %d: %s" % (time, e))
+            if self.error is None:
+                self.error = e
+        self.free_kps.append(kp)
+
+    def submit(self, kp, time):
+        self._check_error()
+        task = asyncio.ensure_future(self._flush(kp, time))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    @property
+    def pending(self):
+        return len(self.tasks)
+
+    async def wait(self):
+        """Wait until at most queue_depth flushes are in progress."""
+        while len(self.tasks) > self.queue_depth:
+            await asyncio.wait(list(self.tasks),
+                               return_when=asyncio.FIRST_COMPLETED)
+        self._check_error()
+
+    async def close(self):
+        """Wait for all flushes to complete."""
+        if self.tasks:
+            await asyncio.wait(list(self.tasks))
+        self._check_error()
+
+
+class AsyncProxy(pytimeseries.tsk.proxy.Proxy):
+    """
+    TSK proxy that runs on an asyncio event loop.
+
+    Kafka consumption and KeyPackage flushes run on executor threads, so
+    other coroutines (e.g. a collector sharing the process) keep running
+    while the proxy waits for messages or backends.
+    """
+
+    def _init_timeseries(self):
+        pytimeseries.tsk.proxy.Proxy._init_timeseries(self)
+        # enabling backends blocks, so do it now rather than on the event
+        # loop (this also creates the executor used to consume from Kafka)
+        self._start_flusher()
+
+    def _new_flusher(self, timeseries, queue_depth, kp_opts):
+        # one thread per Timeseries for flushes, plus one for Kafka
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(timeseries) + 1, thread_name_prefix='tsk-proxy')
+        return AsyncFlusher(timeseries, self.executor, queue_depth,
+                            on_flush=self.flush_times.append,
+                            reset=False, disable=True, **kp_opts)
+
+    def _new_backend_flusher(self, timeseries, queue_depth, kp_opts):
+        raise ValueError("parallel_backends cannot be used with asyncio")
+
+    async def _save_key_cache(self):
+        # the flusher's KPs are AsyncKeyPackages, whose save_keys must be
+        # awaited
+        kp = self._key_cache_kp()
+        if kp is not None:
+            await kp.save_keys(self.key_cache)
+
+    async def _start_stats(self):
+        # as Proxy._start_stats, but enabling the backend (which may connect
+        # to it) runs on the executor
+        import _pytimeseries
+        self.stats_ts = pytimeseries.aio.AsyncTimeseries(
+            _pytimeseries.Timeseries(), self.executor)
+        be, opts = self._stats_backend(self.stats_ts)
+        if not await self.stats_ts.enable_backend(be, opts):
+            raise RuntimeError("Could not enable stats TS backend %s" %
+                               be.name)
+        self.stats_kp = await self.stats_ts.new_keypackage(reset=True,
+                                                           disable=False)
+        self._bind_stats()
+
+    async def _maybe_flush_stats(self):
+        # see Proxy._maybe_flush_stats; the stats KP is an AsyncKeyPackage,
+        # so its flush runs on the executor
+        now = self._collect_stats()
+        if now is None:
+            return
+        if self.stats_queue is not None:
+            self.stats_queue.put((self.stats_time, self.stats.snapshot()))
+        else:
+            if self.stats_kp is None:
+                await self._start_stats()
+            self.stats.write(self.stats_kp)
+            await self.stats_kp.flush(self.stats_time)
+        self.stats_time = now
+
+    async def run(self):
+        logging.info("TSK Proxy starting (asyncio)...")
+        loop = asyncio.get_running_loop()
+        batch_size = self.config.getint('kafka', 'batch_size',
+                                        fallback=1000)
+        try:
+            while True:
+                # see Proxy.run
+                self._flush_idle_intervals()
+                await self.flusher.wait()
+                await self._maybe_flush_stats()
+                if self.tsk_reader.finished:
+                    logging.info("No more messages to replay")
+                    self.shutdown = 1
+                if self.shutdown:
+                    self._maybe_flush()
+                    await self.flusher.close()
+                    await self._save_key_cache()
+                    self.tsk_reader.commit()
+                    self.tsk_reader.close()
+                    if self.recorder is not None:
+                        self.recorder.close()
+                    logging.info("Shutdown complete")
+                    return
+                while not self.shutdown:
+                    start = _time.perf_counter()
+                    msgs = await loop.run_in_executor(
+                        self.executor, self.tsk_reader.consume_batch,
+                        batch_size, 10)
+                    self.poll_latency.observe(_time.perf_counter() - start)
+                    if not msgs:
+                        break
+                    at_eof = self._handle_batch(msgs)
+                    self.tsk_reader.commit()
+                    self._flush_idle_intervals()
+                    # backpressure: let flushes catch up
+                    await self.flusher.wait()
+                    await self._maybe_flush_stats()
+                    if at_eof:
+                        break
+        finally:
+            self.executor.shutdown(wait=True)
@@ -0,0 +1,426 @@
+#
+# Copyright (C) 2017 The Regents of the University of California.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+import collections
+import logging
+import queue
+import threading
+import time as _time
+
+
+class Flusher:
+    """
+    Flushes KeyPackages to the timeseries backends, either in the calling
+    thread or on background flusher threads.
+
+    KeyPackages are obtained with acquire(), filled by the caller and then
+    handed back with submit(). The caller may fill up to max_open KPs at
+    once. If queue_depth is 0, submit() flushes the KP before returning (and
+    the next acquire() returns the same KP). Otherwise up to queue_depth KPs
+    can be waiting to be (or being) flushed by the flusher threads while the
+    caller fills others, and acquire() blocks until a KP is free once that
+    limit is reached.
+
+    One flusher thread is started per Timeseries object given, with its own
+    queue of KPs to flush. KPs are created on each Timeseries in turn, and
+    every submitted KP is queued for the thread of the Timeseries it belongs
+    to, so that no two threads wait on the same Timeseries (backend I/O is
+    serialized per Timeseries). Flushes therefore only run in parallel if the
+    Timeseries objects are distinct (each with its own enabled backends). Note
+    that parallel flushes may complete out of order.
+
+    A failed flush is fatal: the error is re-raised (as a RuntimeError) by the
+    next call to submit() or acquire().
+
+    Delta KPs (see KeyPackage.flush) skip the values that are unchanged since
+    that KP was last flushed, so they can only be used if every interval goes
+    through the same KP, i.e. with a queue_depth of 0 and a max_open of 1.
+
+    Data for intervals that have already been flushed is written to a
+    separate KP, obtained with acquire_late(), which is not counted in
+    max_open.
+
+    If given, on_flush is called with the duration (in seconds) of every
+    successful flush, from the thread that did the flush.
+    """
+
+    def __init__(self, timeseries, queue_depth=0, max_open=1, on_flush=None,
+                 **kp_opts):
+        self.timeseries = list(timeseries)
+        if not self.timeseries:
+            raise ValueError("At least one Timeseries is required")
+        if kp_opts.get('delta') and (queue_depth or max_open > 1):
+            raise ValueError("Delta KeyPackages need a queue_depth of 0 and a "
+                             "max_open of 1")
+        self.queue_depth = queue_depth
+        self.kp_opts = kp_opts
+        self.on_flush = on_flush
+
+        # all KPs, the index of the Timeseries (and so of the flusher thread)
+        # that each belongs to, and the KPs that are ready to be filled
+        self.kps = []
+        self.owners = {}
+        self.free_kps = queue.Queue()
+        self.kp_cnt = 0
+        self.max_kps = queue_depth + max_open
+
+        # KP for late data (see acquire_late), once created
+        self.late_kp = None
+        self.late_free = queue.Queue()
+
+        # KPs waiting to be flushed by each thread, as (kp, time) tuples
+        self.jobs = []
+        self.error = None
+
+        self.threads = []
+        if queue_depth:
+            for i in range(len(self.timeseries)):
+                jobs = queue.Queue()
+                self.jobs.append(jobs)
+                thread = threading.Thread(target=self._run, args=(jobs, ),
+                                          name="flusher-%d" % i)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def _check_error(self):
+        if self.error is not None:
+            raise RuntimeError("Background flush failed: %s" % self.error)
+
+    def _flush(self, kp, time):
+        start = _time.perf_counter()
+        kp.flush(time)
+        if self.on_flush is not None:
+            self.on_flush(_time.perf_counter() - start)
+
+    def _new_kp(self):
+        owner = self.kp_cnt % len(self.timeseries)
+        self.kp_cnt += 1
+        kp = self.timeseries[owner].new_keypackage(**self.kp_opts)
+        self.kps.append(kp)
+        self.owners[kp] = owner
+        return kp
+
+    def acquire(self):
+        """
+        Get a KeyPackage to fill, waiting for a flush to complete if none is
+        free.
+        """
+        self._check_error()
+        try:
+            return self.free_kps.get_nowait()
+        except queue.Empty:
+            pass
+        if self.kp_cnt < self.max_kps:
+            return self._new_kp()
+        # backpressure: wait for one of the queued KPs to be flushed
+        kp = self.free_kps.get()
+        self._check_error()
+        return kp
+
+    def acquire_late(self):
+        """
+        Get the KeyPackage to write data for an interval that has already
+        been flushed to, waiting for its previous flush to complete. Since it
+        only holds part of an interval, this KP is never in delta mode.
+        """
+        self._check_error()
+        if self.late_kp is None:
+            kp_opts = dict(self.kp_opts, delta=False)
+            self.late_kp = self.timeseries[0].new_keypackage(**kp_opts)
+            self.owners[self.late_kp] = 0
+            return self.late_kp
+        kp = self.late_free.get()
+        self._check_error()
+        return kp
+
+    def _release(self, kp):
+        if kp is self.late_kp:
+            self.late_free.put(kp)
+        else:
+            self.free_kps.put(kp)
+
+    def submit(self, kp, time):
+        """
+        Flush the given KeyPackage (obtained from acquire or acquire_late) at
+        the given time.
+        """
+        self._check_error()
+        if not self.threads:
+            self._flush(kp, time)
+            self._release(kp)
+        else:
+            self.jobs[self.owners[kp]].put((kp, time))
+
+    @property
+    def pending(self):
+        """Number of KeyPackages waiting to be flushed"""
+        return sum(jobs.qsize() for jobs in self.jobs)
+
+    def close(self):
+        """Wait for all pending flushes to complete and stop the threads."""
+        for jobs in self.jobs:
+            jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.jobs = []
+        self._check_error()
+
+    def _run(self, jobs):
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            kp, time = job
+            try:
+                self._flush(kp, time)
+            except Exception as e:
+                logging.error("Failed to flush KP at %d: %s" % (time, e))
+                if self.error is None:
+                    self.error = e
+            # hand the KP back even on error so that acquire never deadlocks
+            self._release(kp)
+
+
+class BackendQueue:
+    """
+    Queue of intervals waiting to be copied and flushed to a single backend,
+    with the thread that does so (see BackendFlusher).
+    """
+
+    def __init__(self, name, timeseries, queue_depth, on_flush, release,
+                 kp_opts):
+        self.name = name
+        self.timeseries = timeseries
+        self.queue_depth = queue_depth
+        self.on_flush = on_flush
+        self.release = release
+        self.kp_opts = kp_opts
+
+        # our copy of each source KP: since a copy only has to add the keys
+        # that its source has gained since it was last copied, it is always
+        # made from the same source
+        self.kps = {}
+        # source KPs waiting to be copied, as (kp, time) tuples
+        self.jobs = collections.deque()
+        self.flushing = False
+        self.closing = False
+        self.cond = threading.Condition()
+
+        # intervals dropped because the backend fell behind, and flushes
+        # that failed
+        self.dropped = 0
+        self.failed = 0
+
+        self.thread = threading.Thread(target=self._run,
+                                       name="flusher-%s" % name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def pending(self):
+        """Number of intervals queued or being flushed"""
+        return len(self.jobs) + self.flushing
+
+    def put(self, src, time):
+        """
+        Queue the given source (a _SourceKP) to be copied and flushed at
+        time. release(src) is called once it has been copied (or dropped).
+        """
+        dropped = None
+        with self.cond:
+            if len(self.jobs) >= self.queue_depth:
+                # the backend is too far behind: drop the oldest queued
+                # interval
+                dropped = self.jobs.popleft()
+            self.jobs.append((src, time))
+            self.cond.notify()
+        if dropped is not None:
+            self.dropped += 1
+            logging.warning("Backend %s is falling behind, dropping the "
+                            "interval at %d" % (self.name, dropped[1]))
+            self.release(dropped[0])
+
+    def close(self):
+        """Wait for the queued intervals to be flushed and stop the thread."""
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.jobs and not self.closing:
+                    self.cond.wait()
+                if not self.jobs:
+                    return
+                src, time = self.jobs.popleft()
+                self.flushing = True
+            kp = self.kps.get(src)
+            if kp is None:
+                kp = self.kps[src] = \
+                    self.timeseries.new_keypackage(**self.kp_opts)
+            try:
+                try:
+                    with src.lock:
+                        kp.copy_from(src.kp)
+                finally:
+                    self.release(src)
+                start = _time.perf_counter()
+                kp.flush(time)
+                if self.on_flush is not None:
+                    self.on_flush(self.name, _time.perf_counter() - start)
+            except Exception as e:
+                logging.error("Failed to flush KP at %d to backend %s: %s" %
+                              (time, self.name, e))
+                self.failed += 1
+            with self.cond:
+                self.flushing = False
+
+
+class _SourceKP:
+    """
+    A KeyPackage filled by the caller of a BackendFlusher, with the state
+    needed to share it between the backend threads.
+    """
+
+    def __init__(self, kp):
+        self.kp = kp
+        # serializes copies (a KP cannot be copied from by two threads at
+        # once)
+        self.lock = threading.Lock()
+        # number of backends that have yet to copy (or drop) the KP, and the
+        # time it was submitted at
+        self.refs = 0
+        self.time = None
+
+
+class BackendFlusher:
+    """
+    Flushes KeyPackages to each backend independently, so that a slow or
+    failing backend holds up neither the other backends nor the caller.
+
+    This has the same interface as Flusher, but the KPs returned by acquire()
+    belong to a Timeseries without backends. When a KP is submitted, it is
+    queued to be copied, by the thread of every backend (each with its own
+    Timeseries, given by name in timeseries), into a KP of that backend,
+    which is then flushed. Each backend KP is only ever copied from the same
+    source KP, so that copies only add the keys that are new since the last
+    one. At most queue_depth intervals are queued per backend: once a
+    backend is that far behind, its oldest queued interval is dropped.
+    Failed flushes are logged and counted (see BackendQueue), but are not
+    fatal.
+
+    A submitted KP is handed back once every backend has copied it (or
+    dropped it). Up to max_open KPs can be filled at once, plus one for late
+    data and queue_depth waiting to be copied, after which acquire() blocks
+    until a KP is handed back.
+
+    If given, on_flush is called with the name of the backend and the
+    duration (in seconds) of every successful flush, from the thread that did
+    the flush.
+    """
+
+    def __init__(self, timeseries, queue_depth=1, max_open=1, on_flush=None,
+                 **kp_opts):
+        if not timeseries:
+            raise ValueError("At least one Timeseries is required")
+        if queue_depth < 1:
+            raise ValueError("queue_depth must be at least 1")
+        if kp_opts.get('delta'):
+            # each backend flushes several KPs in turn
+            raise ValueError("Delta KeyPackages cannot be flushed to each "
+                             "backend separately")
+        self.kp_opts = kp_opts
+        import _pytimeseries
+        self.source_ts = _pytimeseries.Timeseries()
+        self.backends = [BackendQueue(name, ts, queue_depth, on_flush,
+                                      self._release, kp_opts)
+                         for (name, ts) in sorted(timeseries.items())]
+
+        # KPs filled by the caller, and the _SourceKP of each
+        self.kps = []
+        self.sources = {}
+        self.free_kps = queue.Queue()
+        self.max_kps = max_open + queue_depth + 1
+
+    def acquire(self):
+        """
+        Get a KeyPackage to fill, waiting for one to be copied by every
+        backend if all are in use.
+        """
+        try:
+            return self.free_kps.get_nowait()
+        except queue.Empty:
+            pass
+        if len(self.kps) < self.max_kps:
+            kp = self.source_ts.new_keypackage(**self.kp_opts)
+            self.kps.append(kp)
+            self.sources[kp] = _SourceKP(kp)
+            return kp
+        return self.free_kps.get()
+
+    def acquire_late(self):
+        """
+        Get a KeyPackage to write data for an interval that has already been
+        flushed to (see Flusher.acquire_late).
+        """
+        return self.acquire()
+
+    def submit(self, kp, time):
+        """
+        Queue the given KeyPackage (obtained from acquire or acquire_late)
+        to be flushed to every backend at the given time.
+        """
+        source = self.sources[kp]
+        with source.lock:
+            source.refs = len(self.backends)
+            source.time = time
+        for backend in self.backends:
+            backend.put(source, time)
+
+    def _release(self, source):
+        # called (from any thread) once a backend no longer needs the KP
+        with source.lock:
+            source.refs -= 1
+            if source.refs:
+                return
+            # the KP has no backends, so this only ends its interval
+            source.kp.flush(source.time)
+        self.free_kps.put(source.kp)
+
+    @property
+    def pending(self):
+        """Largest number of intervals waiting to be flushed to a backend"""
+        return max(backend.pending for backend in self.backends)
+
+    def close(self):
+        """Wait for all pending flushes to complete and stop the threads."""
+        for backend in self.backends:
+            backend.close()
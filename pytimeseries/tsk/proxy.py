@@ -24,29 +24,192 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 
-import argparse
-import configparser
-import confluent_kafka
+# confluent_kafka, _pytimeseries (and so the libtimeseries backends) and the
+# supervisor (and argparse) are only imported once they are needed, so that
+# importing this module, and short runs such as --check-config, stay fast
+import collections
 import logging
 import os
-import _pytimeseries
 import pytimeseries.utils
+import pytimeseries.tsk.flusher
+import pytimeseries.tsk.stats
 import signal
 import struct
 import sys
 import time
 
-HEADER_MAGIC_LEN = 8
+TSKBATCH_MAGIC = b"TSKBATCH"
+HEADER_MAGIC_LEN = len(TSKBATCH_MAGIC)
 
 TSKBATCH_VERSION = 0
 
 STAT_METRIC_PFX = "systems.services.tsk"
 
+U16 = struct.Struct("!H")
+U64 = struct.Struct("!Q")
+
+
+# options that the proxy cannot run without
+REQUIRED_OPTIONS = [
+    ('logging', 'loglevel'),
+    ('timeseries', 'backends'),
+    ('kafka', 'brokers'),
+    ('kafka', 'topic_prefix'),
+    ('kafka', 'channel'),
+    ('kafka', 'consumer_group'),
+    ('stats', 'interval'),
+]
+
+INT_OPTIONS = [
+    ('timeseries', 'flush_queue_depth'),
+    ('timeseries', 'flush_threads'),
+    ('timeseries', 'reorder_window'),
+    ('timeseries', 'reorder_grace'),
+    ('timeseries', 'full_flush_every'),
+    ('timeseries', 'evict_idle'),
+    ('timeseries', 'max_keys'),
+    ('kafka', 'lpf_interval'),
+    ('kafka', 'batch_size'),
+    ('stats', 'interval'),
+]
+
+FLOAT_OPTIONS = [
+    ('timeseries', 'evict_min_fraction'),
+]
+
+BOOLEAN_OPTIONS = [
+    ('timeseries', 'parallel_backends'),
+    ('timeseries', 'delta_flush'),
+]
+
+
+def _delta_flush_problem(config):
+    # changes are tracked per KP, so every interval must go through the same
+    # KP
+    if (config.getint('timeseries', 'flush_queue_depth', fallback=0) or
+            config.getint('timeseries', 'reorder_window', fallback=1) > 1 or
+            config.getboolean('timeseries', 'parallel_backends',
+                              fallback=False)):
+        return ("delta_flush cannot be used with flush_queue_depth, "
+                "reorder_window or parallel_backends")
+    return None
+
+
+def check_config(config_file, check_backends=False):
+    """
+    Check a proxy configuration file, without connecting to Kafka or
+    enabling any backend.
+
+    Only the sections and options are checked, unless check_backends is
+    True, in which case the backends are also looked up in libtimeseries
+    (which loads the extension).
+
+    :return: list of the problems found (empty if there are none)
+    """
+    import configparser
+    config = configparser.ConfigParser()
+    try:
+        with open(os.path.expanduser(config_file)) as fh:
+            config.read_file(fh)
+    except (IOError, configparser.Error) as e:
+        return [str(e)]
+
+    problems = ["Missing option '%s' in section [%s]" % (option, section)
+                for (section, option) in REQUIRED_OPTIONS
+                if not config.has_option(section, option)]
+    if problems:
+        return problems
+
+    if not isinstance(logging.getLevelName(config.get('logging',
+                                                      'loglevel')), int):
+        problems.append("Unknown log level '%s'" %
+                        config.get('logging', 'loglevel'))
+    for (options, getter) in ((INT_OPTIONS, config.getint),
+                              (FLOAT_OPTIONS, config.getfloat),
+                              (BOOLEAN_OPTIONS, config.getboolean)):
+        for (section, option) in options:
+            try:
+                getter(section, option, fallback=None)
+            except ValueError as e:
+                problems.append("Invalid [%s] %s: %s" % (section, option, e))
+    if not problems and config.getboolean('timeseries', 'delta_flush',
+                                          fallback=False):
+        problem = _delta_flush_problem(config)
+        if problem:
+            problems.append(problem)
+    if config.get('kafka', 'format', fallback='tsk') not in ('tsk', 'lpf'):
+        problems.append("Unknown message format '%s' (expected tsk or lpf)" %
+                        config.get('kafka', 'format'))
+    if config.get('timeseries', 'aggregation', fallback='set') not in \
+            ('set', 'add', 'max', 'min'):
+        problems.append("Unknown aggregation '%s'" %
+                        config.get('timeseries', 'aggregation'))
+
+    backends = [(name, 'timeseries', name + '-opts') for name in
+                config.get('timeseries', 'backends').split(',')]
+    if config.getint('stats', 'interval', fallback=0):
+        backends.append((config.get('stats', 'ts_backend', fallback=''),
+                         'stats', 'ts_opts'))
+    for (name, section, opts) in backends:
+        if not config.has_option(section, opts):
+            problems.append("Missing option '%s' in section [%s]" %
+                            (opts, section))
+    if check_backends:
+        # backends are looked up, but not enabled
+        import _pytimeseries
+        ts = _pytimeseries.Timeseries()
+        for (name, _, _) in backends:
+            if not ts.get_backend_by_name(name):
+                problems.append("Unknown TS backend '%s'" % name)
+    return problems
+
+
+def _kafka_error():
+    # only needed for messages from Kafka, which has then been imported
+    import confluent_kafka
+    return confluent_kafka.KafkaError
+
+
+def _kafka_exception():
+    import confluent_kafka
+    return confluent_kafka.KafkaException
+
+
+def stat_key(config, instance, stat):
+    """
+    Build the full metric key for the given proxy stat.
+    """
+    if instance is not None:
+        stat = ".".join([
+            pytimeseries.utils.graphite_safe_node(instance),
+            stat
+        ])
+    return ".".join([
+        STAT_METRIC_PFX,
+        pytimeseries.utils.graphite_safe_node(
+            config.get('kafka', 'consumer_group')),
+        pytimeseries.utils.graphite_safe_node(
+            config.get('kafka', 'topic_prefix')),
+        pytimeseries.utils.graphite_safe_node(
+            config.get('kafka', 'channel')),
+        stat
+    ])
+
 
 class TskReader:
+    """
+    Reads TSKBATCH messages from Kafka.
+
+    A consumer (with the interface of confluent_kafka.Consumer) may be given
+    in place of creating one from brokers and consumer_group.
+    """
+
+    # a Kafka topic has no end (see pytimeseries.tsk.replay.ReplayReader)
+    finished = False
 
     def __init__(self, topic_prefix, channel, consumer_group, brokers,
-                 partition=None, reset_offsets=False, commit_offsets=True):
+                 partition=None, reset_offsets=False, commit_offsets=True,
+                 consumer=None):
         if sys.version_info[0] == 2:
             self.channel = channel
         else:
@@ -55,19 +218,29 @@ class TskReader:
         self.topic_name = ".".join([topic_prefix, channel])
         self.consumer_group = ".".join([consumer_group, self.topic_name])
         self.partition = partition
+        self.commit_offsets = commit_offsets
         conf = {
             'bootstrap.servers': brokers,
             'group.id': self.consumer_group,
             'default.topic.config': {'auto.offset.reset': 'earliest'},
             'heartbeat.interval.ms': 60000,
             'api.version.request': True,
-            'enable.auto.commit': commit_offsets,
+            # offsets are committed explicitly (see commit)
+            'enable.auto.commit': False,
+            'enable.partition.eof': True,
         }
-        self.kc = confluent_kafka.Consumer(conf)
+        if consumer is None:
+            import confluent_kafka
+            consumer = confluent_kafka.Consumer(conf)
+        self.kc = consumer
 
-        if self.partition:
-            topic_list = [confluent_kafka.TopicPartition(self.topic_name,
-                                                         self.partition)]
+        if self.partition is not None:
+            import confluent_kafka
+            partitions = self.partition
+            if isinstance(partitions, int):
+                partitions = [partitions]
+            topic_list = [confluent_kafka.TopicPartition(self.topic_name, p)
+                          for p in partitions]
             self.kc.assign(topic_list)
         else:
             self.kc.subscribe([self.topic_name])
@@ -82,13 +255,33 @@ class TskReader:
     def poll(self, time):
         return self.kc.poll(time)
 
-    def handle_msg(self, msgbuf, msg_cb, kv_cb):
+    def consume_batch(self, max_messages, timeout):
+        """
+        Consume up to max_messages messages, waiting at most timeout seconds.
+
+        :return: list of messages (may be empty if the timeout expired)
+        """
+        return self.kc.consume(num_messages=max_messages, timeout=timeout)
+
+    def commit(self):
+        """
+        Asynchronously commit the offsets of all messages consumed so far.
+        """
+        if not self.commit_offsets:
+            return
+        try:
+            self.kc.commit(asynchronous=True)
+        except _kafka_exception() as e:
+            # nothing consumed since the last commit
+            if e.args[0].code() != _kafka_error()._NO_OFFSET:
+                raise
+
+    def _check_header(self, msgbuf):
         try:
             msg_time, version, channel, offset = self._parse_header(msgbuf)
         except struct.error:
             raise RuntimeError("malformed Kafka message")
 
-        msgbuflen = len(msgbuf)
         if version != TSKBATCH_VERSION:
             raise RuntimeError("Kafka message with version %d "
                 "(expected %d)" % (version, TSKBATCH_VERSION))
@@ -96,25 +289,64 @@ class TskReader:
             raise RuntimeError("Kafka message with channel %s "
                 "(expected %s)" % (channel, self.channel))
 
+        return msg_time, version, channel, offset
+
+    def handle_msg(self, msgbuf, msg_cb, kv_cb, key_views=False):
+        """
+        Decode a TSKBATCH message, calling kv_cb for each key/value.
+
+        If key_views is True, keys are passed to kv_cb as (read-only)
+        memoryviews into msgbuf rather than copied into new bytes objects.
+        The KeyPackage key methods accept these directly; use bytes(key)
+        where a copy of the key is needed.
+        """
+        msg_time, version, channel, offset = self._check_header(msgbuf)
+        msgbuflen = len(msgbuf)
+
         if msg_cb != None:
             msg_cb(msg_time, version, channel, msgbuf, msgbuflen)
 
+        if key_views:
+            msgbuf = memoryview(msgbuf)
+
         while offset < msgbuflen:
             try:
                 key, val, offset = self._parse_kv(msgbuf, offset)
             except struct.error:
-                raise RuntimeEerror("Could not parse Kafka key/value")
+                raise RuntimeError("Could not parse Kafka key/value")
             kv_cb(key, val)
 
+    def apply_msg(self, msgbuf, msg_cb):
+        """
+        Decode a TSKBATCH message directly into a KeyPackage.
+
+        Unlike handle_msg, the key/values are decoded by the extension
+        without a Python callback per key/value. msg_cb is called with the
+        message header and must return the KeyPackage to write the
+        key/values into (or None to skip them).
+
+        :return: number of key/values written
+        """
+        msg_time, version, channel, _ = self._check_header(msgbuf)
+
+        kp = msg_cb(msg_time, version, channel, msgbuf, len(msgbuf))
+        if kp is None:
+            return 0
+
+        _, kv_cnt = kp.apply_tskbatch(msgbuf, self.channel)
+        return kv_cnt
+
     # Parse 2-byte network-order length and a bytestring of that length.
     # Return the bytestring and the new offset.
     @staticmethod
     def _parse_bytestr(msgbuf, offset):
-        (blen,) = struct.unpack_from("!H", msgbuf, offset)
+        (blen,) = U16.unpack_from(msgbuf, offset)
         offset += 2
-        (bstr,) = struct.unpack_from("!%ds" % blen, msgbuf, offset)
-        offset += blen
-        return bstr, offset
+        end = offset + blen
+        if end > len(msgbuf):
+            raise struct.error("bytestring extends past the end of the buffer")
+        # a slice of a memoryview does not copy
+        return msgbuf[offset:end], end
 
     @staticmethod
     def _parse_header(msgbuf):
@@ -131,36 +363,151 @@ class TskReader:
     def _parse_kv(self, msgbuf, offset):
         key, offset = TskReader._parse_bytestr(msgbuf, offset)
 
-        (val, ) = struct.unpack_from("!Q", msgbuf, offset)
+        (val, ) = U64.unpack_from(msgbuf, offset)
         offset += 8
 
         return key, val, offset
 
 
+class LpfReader(TskReader):
+    """
+    Reads InfluxDB line protocol (LPF) messages, each holding one or more
+    newline-separated points, from Kafka.
+
+    Points are bucketed into intervals of the given length (in seconds),
+    and each field is written to the key
+    [key_prefix.]measurement[.tag.value...].field (see
+    KeyPackage.apply_lpf).
+    """
+
+    def __init__(self, topic_prefix, channel, consumer_group, brokers,
+                 partition=None, reset_offsets=False, commit_offsets=True,
+                 interval=60, key_prefix=None, invalid_counter=None,
+                 consumer=None):
+        TskReader.__init__(self, topic_prefix, channel, consumer_group,
+                           brokers, partition, reset_offsets, commit_offsets,
+                           consumer)
+        import _pytimeseries
+        self.lpf_times = _pytimeseries.lpf_times
+        self.lpf_decode = _pytimeseries.lpf_decode
+        self.interval = interval
+        self.key_prefix = key_prefix.encode() if key_prefix else b""
+        # number of malformed lines and field values that cannot be stored
+        if invalid_counter is None:
+            invalid_counter = pytimeseries.tsk.stats.Counter(
+                "invalid_value_cnt")
+        self.invalid_counter = invalid_counter
+
+    def handle_msg(self, msgbuf, msg_cb, kv_cb, key_views=False):
+        """
+        Decode an LPF message, calling kv_cb for each key/value.
+
+        msg_cb (if given) is called (with a version of None) for each
+        interval that the points of the message fall in, before kv_cb is
+        called for the key/values of that interval. Keys are always bytes
+        (key_views is accepted for compatibility with TskReader).
+        """
+        now = int(time.time())
+        kvs, invalid = self.lpf_decode(msgbuf, self.interval,
+                                       self.key_prefix, now=now)
+        self.invalid_counter.value += invalid
+
+        by_time = collections.OrderedDict()
+        for (msg_time, key, val) in kvs:
+            by_time.setdefault(msg_time, []).append((key, val))
+        for msg_time, time_kvs in by_time.items():
+            if msg_cb is not None:
+                msg_cb(msg_time, None, self.channel, msgbuf, len(msgbuf))
+            for (key, val) in time_kvs:
+                kv_cb(key, val)
+
+    def apply_msg(self, msgbuf, msg_cb):
+        """
+        Parse an LPF message directly into KeyPackages.
+
+        msg_cb is called (with a version of None) for each interval that the
+        points of the message fall in, and must return the KeyPackage to
+        write the values of that interval into (or None to skip them).
+
+        :return: number of values written
+        """
+        now = int(time.time())
+        times, invalid = self.lpf_times(msgbuf, self.interval, now)
+        self.invalid_counter.value += invalid
+
+        kv_cnt = 0
+        for msg_time in times:
+            kp = msg_cb(msg_time, None, self.channel, msgbuf, len(msgbuf))
+            if kp is not None:
+                kv_cnt += kp.apply_lpf(msgbuf, self.interval, msg_time,
+                                       self.key_prefix, now=now)
+        return kv_cnt
+
+
 class Proxy:
 
     def __init__(self, config_file, reset_offsets,
-                 partition=None, instance=None):
+                 partition=None, instance=None, stats_queue=None,
+                 replay=None, rate=None, record=None):
         self.config_file = os.path.expanduser(config_file)
+        # a single partition number or a list of partitions
         self.partition = partition
         self.instance = instance
+        # if set, stats are sent to a supervisor through this queue
+        self.stats_queue = stats_queue
 
         self.config = None
         self._load_config()
 
+        # stats are created up front so that the hot paths only do integer
+        # adds on pre-resolved counters
+        self.stats = pytimeseries.tsk.stats.StatsRegistry()
+        self.stat_messages = self.stats.counter("messages_cnt")
+        self.stat_bytes = self.stats.counter("messages_bytes")
+        self.stat_late_messages = self.stats.counter("late_messages_cnt")
+        self.stat_flushes = self.stats.counter("flush_cnt")
+        self.stat_flushed_keys = self.stats.counter("flushed_key_cnt")
+        self.stat_evicted_keys = self.stats.counter("evicted_key_cnt")
+        self.stat_invalid_values = self.stats.counter("invalid_value_cnt")
+        # size of the most recently flushed KP, and its number of enabled keys
+        self.stat_kp_keys = self.stats.gauge("kp_key_cnt")
+        self.stat_kp_live_keys = self.stats.gauge("kp_live_key_cnt")
+        self.decode_latency = self.stats.histogram("latency.decode")
+        self.flush_latency = self.stats.histogram("latency.flush")
+        self.poll_latency = self.stats.histogram("latency.poll")
+        # flush durations reported by the flusher threads
+        self.flush_times = collections.deque(maxlen=10000)
+
         # initialize libtimeseries
-        self.ts = None
-        self.kp = None
-        self.current_time = None
+        self.flusher = None
+        # per-backend stats (with parallel_backends)
+        self.backend_stats = None
+        # open intervals: KP and the (wall-clock) time of the last message,
+        # by interval time
+        self.intervals = {}
+        self.interval_updated = {}
+        self.reorder_window = 1
+        self.reorder_grace = 0
+        self.evict_idle = 0
+        self.max_keys = 0
+        self.evict_min_fraction = 0
+        # most recent interval flushed
+        self.watermark = None
+        # (time, KP) of data received for an interval that has already been
+        # flushed (see _is_late), which is flushed on its own at the end of
+        # each batch
+        self.late = None
         self._init_timeseries()
 
-        self.tsk_reader = TskReader(
-            self.config.get('kafka', 'topic_prefix'),
-            self.config.get('kafka', 'channel'),
-            self.config.get('kafka', 'consumer_group'),
-            self.config.get('kafka', 'brokers'),
-            self.partition,
-            reset_offsets)
+        self.tsk_reader = self._new_reader(reset_offsets, replay, rate)
+        # if set, consumed messages are also written to this recording
+        self.recorder = None
+        if record:
+            from pytimeseries.tsk.replay import TskRecorder
+            self.recorder = TskRecorder(record)
+        # partitions we have seen messages for, and those that are at EOF
+        self.partitions = set()
+        self.eof_partitions = set()
 
         # set up stats (needs kafka to be init first)
         self.stats_ts = None
@@ -174,7 +521,41 @@ class Proxy:
         signal.signal(signal.SIGINT, self._stop_handler)
         signal.signal(signal.SIGHUP, self._hup_handler)
 
+    def _new_reader(self, reset_offsets, replay, rate):
+        msg_format = self.config.get('kafka', 'format', fallback='tsk')
+        if msg_format not in ('tsk', 'lpf'):
+            raise ValueError("Unknown message format '%s' (expected tsk or "
+                             "lpf)" % msg_format)
+        if msg_format == 'lpf':
+            if replay:
+                raise ValueError("Only TSKBATCH messages can be replayed")
+            return LpfReader(
+                self.config.get('kafka', 'topic_prefix'),
+                self.config.get('kafka', 'channel'),
+                self.config.get('kafka', 'consumer_group'),
+                self.config.get('kafka', 'brokers'),
+                self.partition,
+                reset_offsets,
+                interval=self.config.getint('kafka', 'lpf_interval',
+                                            fallback=60),
+                key_prefix=self.config.get('kafka', 'lpf_key_prefix',
+                                           fallback=None),
+                invalid_counter=self.stat_invalid_values)
+        if replay:
+            # imported here, since it depends on this module
+            from pytimeseries.tsk.replay import ReplayReader
+            return ReplayReader(replay, self.config.get('kafka', 'channel'),
+                                rate)
+        return TskReader(
+            self.config.get('kafka', 'topic_prefix'),
+            self.config.get('kafka', 'channel'),
+            self.config.get('kafka', 'consumer_group'),
+            self.config.get('kafka', 'brokers'),
+            self.partition,
+            reset_offsets)
+
     def _load_config(self):
+        import configparser
         self.config = configparser.ConfigParser()
         self.config.readfp(open(self.config_file))
         # configure_logging MUST come before any calls to logging
@@ -182,76 +563,228 @@ class Proxy:
 
     def _configure_logging(self):
         part_name = 'ALL'
-        if self.partition is not None:
+        if isinstance(self.partition, int):
             part_name = str(self.partition)
+        elif self.partition is not None:
+            part_name = ",".join([str(p) for p in self.partition])
+        # force, since supervised workers inherit the supervisor's logging
         logging.basicConfig(level=self.config.get('logging', 'loglevel'),
                             format='%(asctime)s|TSK|PART-' + part_name
                                    + '|%(levelname)s: %(message)s',
-                            datefmt='%Y-%m-%d %H:%M:%S')
+                            datefmt='%Y-%m-%d %H:%M:%S',
+                            force=True)
 
-    def _init_timeseries(self):
-        logging.info("Initializing PyTimeseries")
-        self.ts = _pytimeseries.Timeseries()
-        for name in self.config.get('timeseries', 'backends').split(','):
+    def _backend_names(self):
+        return self.config.get('timeseries', 'backends').split(',')
+
+    def _new_timeseries(self, backends=None):
+        import _pytimeseries
+        ts = _pytimeseries.Timeseries()
+        for name in backends or self._backend_names():
             logging.info("Enabling timeseries backend '%s'" % name)
-            be = self.ts.get_backend_by_name(name)
+            be = ts.get_backend_by_name(name)
             if not be:
                 raise ValueError("Could not enable TS backend %s" % name)
             opts = self.config.get('timeseries', name + '-opts')
-            self.ts.enable_backend(be, opts)
-        self.kp = self.ts.new_keypackage(reset=False, disable=True)
+            ts.enable_backend(be, opts)
+        return ts
+
+    def _init_timeseries(self):
+        logging.info("Initializing PyTimeseries")
+        queue_depth = self.config.getint('timeseries', 'flush_queue_depth',
+                                         fallback=0)
+        threads = self.config.getint('timeseries', 'flush_threads',
+                                     fallback=1)
+        if queue_depth:
+            logging.info("Flushing in the background (queue depth: %d, "
+                         "threads: %d)" % (queue_depth, threads))
+        else:
+            threads = 1
+        self.reorder_window = self.config.getint('timeseries',
+                                                 'reorder_window', fallback=1)
+        self.reorder_grace = self.config.getint('timeseries', 'reorder_grace',
+                                                fallback=0)
+        kp_opts = {
+            'aggregation': self.config.get('timeseries', 'aggregation',
+                                           fallback='set'),
+        }
+        if self.config.getboolean('timeseries', 'delta_flush',
+                                  fallback=False):
+            problem = _delta_flush_problem(self.config)
+            if problem:
+                raise ValueError(problem)
+            kp_opts['delta'] = True
+            kp_opts['full_every'] = self.config.getint(
+                'timeseries', 'full_flush_every', fallback=0)
+            logging.info("Only flushing changed values (full flush every "
+                         "%d intervals)" % kp_opts['full_every'])
+        self.evict_idle = self.config.getint('timeseries', 'evict_idle',
+                                             fallback=0)
+        self.max_keys = self.config.getint('timeseries', 'max_keys',
+                                           fallback=0)
+        self.evict_min_fraction = self.config.getfloat(
+            'timeseries', 'evict_min_fraction', fallback=0.1)
+        if not 0 <= self.evict_min_fraction < 1:
+            raise ValueError("evict_min_fraction must be at least 0 and less "
+                             "than 1")
+        if self.evict_idle or self.max_keys:
+            logging.info("Evicting keys idle for more than %ds (max keys: %d)"
+                         % (self.evict_idle, self.max_keys))
+        self.key_cache = self.config.get('timeseries', 'key_cache',
+                                         fallback=None)
+        if self.key_cache:
+            self.key_cache = os.path.expanduser(self.key_cache)
+            if os.path.exists(self.key_cache):
+                logging.info("Preloading keys from %s" % self.key_cache)
+                kp_opts['preload'] = self.key_cache
+        self.kp_opts = kp_opts
+        self.flush_queue_depth = queue_depth
+        self.flush_threads = threads
+        self.parallel_backends = self.config.getboolean(
+            'timeseries', 'parallel_backends', fallback=False)
+        if self.parallel_backends:
+            self.flush_queue_depth = max(queue_depth, 1)
+            logging.info("Flushing to each backend separately (queue depth: "
+                         "%d)" % self.flush_queue_depth)
+            self._init_backend_stats(self._backend_names())
+        # the backends are only enabled (by _start_flusher) once there is
+        # something to write to them
+
+    def _start_flusher(self):
+        if self.parallel_backends:
+            self.flusher = self._new_backend_flusher(
+                dict((name, self._new_timeseries([name]))
+                     for name in self._backend_names()),
+                self.flush_queue_depth, self.kp_opts)
+            return
+        # each flusher thread gets its own backend instances so that their
+        # flushes can run in parallel
+        self.flusher = self._new_flusher([self._new_timeseries()
+                                          for _ in range(self.flush_threads)],
+                                         self.flush_queue_depth, self.kp_opts)
+
+    def _new_flusher(self, timeseries, queue_depth, kp_opts):
+        return pytimeseries.tsk.flusher.Flusher(
+            timeseries, queue_depth, max_open=self.reorder_window,
+            on_flush=self.flush_times.append,
+            reset=False, disable=True, **kp_opts)
+
+    def _init_backend_stats(self, names):
+        # per-backend stats, reported by _update_backend_stats. These are
+        # created up front since stats cannot be added once bound to a KP.
+        self.backend_stats = {}
+        for name in names:
+            prefix = "backend.%s." % pytimeseries.utils.graphite_safe_node(
+                name)
+            self.backend_stats[name] = {
+                'flush_times': collections.deque(maxlen=10000),
+                'latency': self.stats.histogram(prefix + "latency.flush"),
+                'queue_depth': self.stats.gauge(prefix + "queue_depth"),
+                'dropped': self.stats.counter(prefix + "dropped_cnt"),
+                'failed': self.stats.counter(prefix + "failed_cnt"),
+                'last_dropped': 0,
+                'last_failed': 0,
+            }
+
+    def _new_backend_flusher(self, timeseries, queue_depth, kp_opts):
+        return pytimeseries.tsk.flusher.BackendFlusher(
+            timeseries, queue_depth, max_open=self.reorder_window,
+            on_flush=self._backend_flushed,
+            reset=False, disable=True, **kp_opts)
+
+    def _backend_flushed(self, name, seconds):
+        # called from the backend's flusher thread
+        self.backend_stats[name]['flush_times'].append(seconds)
+
+    def _update_backend_stats(self):
+        if self.flusher is None:
+            return
+        for backend in self.flusher.backends:
+            stats = self.backend_stats[backend.name]
+            while stats['flush_times']:
+                stats['latency'].observe(stats['flush_times'].popleft())
+            stats['queue_depth'].value = backend.pending
+            # the backend counters are updated by other threads, so only
+            # read them
+            dropped, failed = backend.dropped, backend.failed
+            stats['dropped'].value += dropped - stats['last_dropped']
+            stats['failed'].value += failed - stats['last_failed']
+            stats['last_dropped'], stats['last_failed'] = dropped, failed
+
+    def _key_cache_kp(self):
+        # the KP to save the key cache from, if any
+        if not self.key_cache or self.flusher is None or not self.flusher.kps:
+            return None
+        # every KP has seen (most of) the same keys, so save the largest
+        kp = max(self.flusher.kps, key=lambda kp: kp.size)
+        logging.info("Saving %d keys to %s" % (kp.size, self.key_cache))
+        return kp
+
+    def _save_key_cache(self):
+        kp = self._key_cache_kp()
+        if kp is not None:
+            kp.save_keys(self.key_cache)
 
     def _stats_interval_now(self):
-        return (time.time() // self.stats_interval) * self.stats_interval
+        return int(time.time() // self.stats_interval) * self.stats_interval
 
     def _init_stats(self):
         self.stats_interval = int(self.config.get('stats', 'interval'))
         if not self.stats_interval:
             return
         logging.info("Initializing Stats")
-        self.stats_ts = _pytimeseries.Timeseries()
+        self.stats_time = self._stats_interval_now()
+
+    def _stats_backend(self, ts):
         be_name = self.config.get('stats', 'ts_backend')
-        be = self.stats_ts.get_backend_by_name(be_name)
+        be = ts.get_backend_by_name(be_name)
         if not be:
             raise ValueError("Could not find TS backend %s" % be_name)
-        opts = self.config.get('stats', 'ts_opts')
+        return be, self.config.get('stats', 'ts_opts')
+
+    def _bind_stats(self):
+        self.stats.bind(self.stats_kp,
+                        lambda stat: stat_key(self.config, self.instance, stat))
+
+    def _start_stats(self):
+        # the stats backend is only enabled once the first stats are written
+        import _pytimeseries
+        self.stats_ts = _pytimeseries.Timeseries()
+        be, opts = self._stats_backend(self.stats_ts)
         if not self.stats_ts.enable_backend(be, opts):
-            raise RuntimeError("Could not enable stats TS backend %s" % be_name)
+            raise RuntimeError("Could not enable stats TS backend %s" %
+                               be.name)
         self.stats_kp = self.stats_ts.new_keypackage(reset=True, disable=False)
-        self.stats_time = self._stats_interval_now()
+        self._bind_stats()
 
-    def _inc_stat(self, stat, value):
+    def _collect_stats(self):
+        # returns the start of the current stats interval if the stats for
+        # the previous one are due to be flushed, None otherwise
         if not self.stats_interval:
-            return
-        if self.instance is not None:
-            stat = ".".join([
-                pytimeseries.utils.graphite_safe_node(self.instance),
-                stat
-            ])
-        key = ".".join([
-            STAT_METRIC_PFX,
-            pytimeseries.utils.graphite_safe_node(
-                self.config.get('kafka', 'consumer_group')),
-            pytimeseries.utils.graphite_safe_node(
-                self.config.get('kafka', 'topic_prefix')),
-            pytimeseries.utils.graphite_safe_node(
-                self.config.get('kafka', 'channel')),
-            stat
-        ])
-        idx = self.stats_kp.get_key(key)
-        if idx is None:
-            idx = self.stats_kp.add_key(key)
-        old = self.stats_kp.get(idx)
-        self.stats_kp.set(idx, old + value)
+            return None
+        now = self._stats_interval_now()
+        if now < (self.stats_time + self.stats_interval):
+            return None
+        logging.debug("Flushing stats at %d" % self.stats_time)
+        # deque.popleft is safe against the flusher threads appending
+        while self.flush_times:
+            self.flush_latency.observe(self.flush_times.popleft())
+        if self.backend_stats:
+            self._update_backend_stats()
+        return now
 
     def _maybe_flush_stats(self):
-        if not self.stats_interval:
+        now = self._collect_stats()
+        if now is None:
             return
-        now = self._stats_interval_now()
-        if now >= (self.stats_time + self.stats_interval):
-            logging.debug("Flushing stats at %d" % self.stats_time)
+        if self.stats_queue is not None:
+            self.stats_queue.put((self.stats_time, self.stats.snapshot()))
+        else:
+            if self.stats_kp is None:
+                self._start_stats()
+            self.stats.write(self.stats_kp)
             self.stats_kp.flush(self.stats_time)
-            self.stats_time = now
+        self.stats_time = now
 
     def _stop_handler(self, _signo, _stack_frame):
         logging.info("Caught signal, shutting down at next opportunity")
@@ -265,76 +798,180 @@ class Proxy:
         logging.error("NOT IMPLEMENTED")
         self.shutdown += 1
 
+    def _flush_interval(self, interval_time):
+        kp = self.intervals.pop(interval_time)
+        del self.interval_updated[interval_time]
+        logging.debug("Flushing KP at %d with %d keys enabled (%d total)" %
+                      (interval_time, kp.enabled_size, kp.size))
+        self.stat_flushes.value += 1
+        self.stat_flushed_keys.value += kp.enabled_size
+        self.stat_kp_keys.value = kp.size
+        self.stat_kp_live_keys.value = kp.enabled_size
+        self.flusher.submit(kp, interval_time)
+        if self.watermark is None or interval_time > self.watermark:
+            self.watermark = interval_time
+
+    def _flush_late(self):
+        late_time, kp = self.late
+        self.late = None
+        logging.debug("Flushing late data at %d with %d keys enabled" %
+                      (late_time, kp.enabled_size))
+        self.stat_flushes.value += 1
+        self.stat_flushed_keys.value += kp.enabled_size
+        self.flusher.submit(kp, late_time)
+
     def _maybe_flush(self, flush_time=None):
-        # if this is not our first message, and this time is different than
-        # the current time, we need to dump the KP
-        if not self.current_time:
-            self.current_time = flush_time
-        elif not flush_time or (flush_time != self.current_time):
-            # now flush the key package
-            logging.debug("Flushing KP at %d with %d keys enabled (%d total)" %
-                          (self.current_time, self.kp.enabled_size,
-                           self.kp.size))
-            self._inc_stat("flush_cnt", 1)
-            self._inc_stat("flushed_key_cnt", self.kp.enabled_size)
-            self.kp.flush(self.current_time)
-            # all keys are reset now
-            assert(self.kp.enabled_size == 0)
-            self.current_time = flush_time
+        # with no time given, flush all open intervals
+        if flush_time is None:
+            for interval_time in sorted(self.intervals):
+                self._flush_interval(interval_time)
+            return
+        # otherwise, make room for an interval for this time by flushing the
+        # oldest intervals, so that at most reorder_window remain open
+        while len(self.intervals) >= self.reorder_window:
+            self._flush_interval(min(self.intervals))
+
+    def _flush_idle_intervals(self):
+        if not self.reorder_grace:
+            return
+        idle = time.time() - self.reorder_grace
+        for interval_time in sorted(self.intervals):
+            if self.interval_updated[interval_time] < idle:
+                logging.debug("No data for %d in %ds" %
+                              (interval_time, self.reorder_grace))
+                self._flush_interval(interval_time)
+
+    def _evict_keys(self, kp, interval_time):
+        # the KP is empty (between intervals), so compacting its indices
+        # does not affect any caller. Activity is measured in interval time,
+        # which is the same for every KP in the pool.
+        evicted = kp.evict(self.evict_idle, self.max_keys, now=interval_time,
+                           min_fraction=self.evict_min_fraction)
+        if evicted:
+            logging.debug("Evicted %d keys (%d remaining)" %
+                          (evicted, kp.size))
+            self.stat_evicted_keys.value += evicted
+
+    def _is_late(self, msg_time):
+        # data for an interval that has already been flushed, or that is
+        # older than every open interval while the window is full (a newer
+        # interval, which may still be receiving data, is never flushed to
+        # make room for an older one)
+        if self.watermark is not None and msg_time <= self.watermark:
+            return True
+        return len(self.intervals) >= self.reorder_window and \
+            msg_time < min(self.intervals)
 
     def _msg_cb(self, msg_time, version, channel, msgbuf, msgbuflen):
-        self._maybe_flush(msg_time)
-        self._inc_stat("messages_cnt", 1)
-        self._inc_stat("messages_bytes", msgbuflen)
-
-    def _kv_cb(self, key, val):
-        idx = self.kp.get_key(key)
-        if idx is None:
-            idx = self.kp.add_key(key)
-        else:
-            self.kp.enable_key(idx)
-        self.kp.set(idx, val)
+        kp = self.intervals.get(msg_time)
+        if kp is None and self._is_late(msg_time):
+            # this data is written in a separate (partial) flush, without
+            # taking the place of an open interval. The late KP is kept for
+            # the rest of the batch (see _handle_batch) unless the time
+            # changes.
+            self.stat_late_messages.value += 1
+            if self.late is not None and self.late[0] != msg_time:
+                self._flush_late()
+            if self.late is None:
+                kp = self.flusher.acquire_late()
+                if self.evict_idle or self.max_keys:
+                    self._evict_keys(kp, msg_time)
+                self.late = (msg_time, kp)
+            return self.late[1]
+        if kp is None:
+            self._maybe_flush(msg_time)
+            if self.flusher is None:
+                self._start_flusher()
+            # blocks if the flusher is falling behind
+            kp = self.flusher.acquire()
+            if self.evict_idle or self.max_keys:
+                self._evict_keys(kp, msg_time)
+            self.intervals[msg_time] = kp
+        self.interval_updated[msg_time] = time.time()
+        return kp
+
+    def _handle_batch(self, msgs):
+        """
+        Process a batch of messages.
+
+        :return: True if all partitions are now at EOF
+        """
+        for msg in msgs:
+            err = msg.error()
+            if not err:
+                msgbuf = msg.value()
+                self.stat_messages.value += 1
+                self.stat_bytes.value += len(msgbuf)
+                if self.recorder is not None:
+                    self.recorder.write(msgbuf)
+                start = time.perf_counter()
+                try:
+                    self.tsk_reader.apply_msg(msgbuf, self._msg_cb)
+                except RuntimeError as e:
+                    logging.error("Skipping " + str(e))
+                self.decode_latency.observe(time.perf_counter() - start)
+                self.eof_partitions.discard(msg.partition())
+                self.partitions.add(msg.partition())
+            elif err.code() == _kafka_error()._PARTITION_EOF:
+                self.eof_partitions.add(msg.partition())
+                self.partitions.add(msg.partition())
+            else:
+                logging.error("Unhandled Kafka error, shutting down")
+                logging.error(err)
+                self.shutdown = True
+                break
+        # late data is flushed once per batch, since each flush of the late
+        # KP has to wait for the previous one
+        if self.late is not None:
+            self._flush_late()
+        return self.eof_partitions == self.partitions
+
+    def _shutdown(self):
+        self._maybe_flush()
+        if self.flusher is not None:
+            self.flusher.close()
+        self._save_key_cache()
+        self.tsk_reader.commit()
+        self.tsk_reader.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        logging.info("Shutdown complete")
 
     def run(self):
         logging.info("TSK Proxy starting...")
+        batch_size = self.config.getint('kafka', 'batch_size',
+                                        fallback=1000)
         while True:
-            logging.info("Forcing a flush")
-            self._maybe_flush()
+            # open intervals are only flushed once they fall out of the
+            # reorder window or are idle, so that data that is still to come
+            # for them is not written in a separate flush
+            self._flush_idle_intervals()
             self._maybe_flush_stats()
+            if self.tsk_reader.finished:
+                logging.info("No more messages to replay")
+                self.shutdown = 1
             # if we have been asked to shut down, do it now
             if self.shutdown:
-                self._maybe_flush()
-                self.tsk_reader.close()
-                logging.info("Shutdown complete")
+                self._shutdown()
                 return
             # process some messages!
-            msg = self.tsk_reader.poll(10000)
-            eof_since_data = 0
-            while msg is not None:
-                if not msg.error():
-                    try:
-                        self.tsk_reader.handle_msg(msg.value(),
-                            self._msg_cb, self._kv_cb)
-                    except RuntimeError as e:
-                        logging.error("Skipping " + str(e))
-                    eof_since_data = 0
-                elif msg.error().code() == \
-                        confluent_kafka.KafkaError._PARTITION_EOF:
-                    # no new messages, wait a bit and then force a flush
-                    eof_since_data += 1
-                    if eof_since_data >= 10:
-                        break
-                else:
-                    logging.error("Unhandled Kafka error, shutting down")
-                    logging.error(msg.error())
-                    self.shutdown = True
-                if self.shutdown:
+            while not self.shutdown:
+                start = time.perf_counter()
+                msgs = self.tsk_reader.consume_batch(batch_size, 10)
+                self.poll_latency.observe(time.perf_counter() - start)
+                if not msgs:
                     break
-                msg = self.tsk_reader.poll(10000)
+                at_eof = self._handle_batch(msgs)
+                self.tsk_reader.commit()
+                self._flush_idle_intervals()
                 self._maybe_flush_stats()
+                if at_eof:
+                    # no new messages for now
+                    break
 
 
 def main():
+    import argparse
     parser = argparse.ArgumentParser(description="""
     Connects to a TimeSeries Kafka cluster and proxies metrics to other
     libtimeseries backends
@@ -355,8 +992,91 @@ def main():
                         required=False,
                         help='The name of this instance (default: unset)')
 
+    parser.add_argument('-a',  '--asyncio',
+                        action='store_true', required=False,
+                        help='Run the proxy on an asyncio event loop')
+
+    parser.add_argument('--replay', nargs='+', metavar='FILE',
+                        required=False, default=None,
+                        help='Read messages from the given recordings '
+                             '(see --record) rather than from Kafka, and '
+                             'exit once they have all been processed')
+
+    parser.add_argument('--rate',
+                        required=False, default=None, type=float,
+                        help='Maximum number of messages per second to '
+                             'replay (default: no limit)')
+
+    parser.add_argument('--record', metavar='FILE',
+                        required=False, default=None,
+                        help='Also write the messages consumed to the given '
+                             'file (gzip or zstd compressed if it ends with '
+                             '.gz or .zst)')
+
+    parser.add_argument('-w',  '--workers',
+                        required=False, default=None, type=int,
+                        help='Number of worker processes to supervise '
+                             '(default: one per partition)')
+
+    parser.add_argument('-P',  '--partitions',
+                        required=False, default=None,
+                        help='Partitions to distribute across the worker '
+                             'processes (e.g. 0-31 or 0,2,4-7)')
+
+    parser.add_argument('--check-config',
+                        action='store_true', required=False,
+                        help='Check the configuration file and exit, '
+                             'without connecting to Kafka or enabling any '
+                             'backend')
+
+    parser.add_argument('--check-backends',
+                        action='store_true', required=False,
+                        help='With --check-config, also check that the '
+                             'backends exist in libtimeseries')
+
     opts = vars(parser.parse_args())
+    check_backends = opts.pop('check_backends')
+    if check_backends and not opts['check_config']:
+        parser.error("--check-backends can only be used with "
+                     "--check-config")
+    if opts.pop('check_config'):
+        problems = check_config(opts['config_file'], check_backends)
+        for problem in problems:
+            sys.stderr.write("%s: %s\n" % (opts['config_file'], problem))
+        sys.exit(1 if problems else 0)
+    use_asyncio = opts.pop('asyncio')
+    if opts['rate'] is not None and not opts['replay']:
+        parser.error("--rate can only be used with --replay")
+
+    if opts['workers'] is not None or opts['partitions'] is not None:
+        if (opts['partition'] is not None or use_asyncio or
+                opts['replay'] or opts['record']):
+            parser.error("--partition, --asyncio, --replay and --record "
+                         "cannot be used with --workers or --partitions")
+        for opt in ('partition', 'replay', 'rate', 'record'):
+            del opts[opt]
+        # imported here, since it depends on this module
+        import pytimeseries.tsk.supervisor
+        if opts['partitions'] is not None:
+            try:
+                opts['partitions'] = \
+                    pytimeseries.tsk.supervisor.parse_partitions(
+                        opts['partitions'])
+            except ValueError as e:
+                parser.error("Invalid --partitions: %s" % e)
+        supervisor = pytimeseries.tsk.supervisor.Supervisor(**opts)
+        supervisor.run()
+        return
 
+    del opts['workers']
+    del opts['partitions']
+    if use_asyncio:
+        # imported here, since it depends on this module
+        import asyncio
+        from pytimeseries.tsk.aio import AsyncProxy
+        proxy = AsyncProxy(**opts)
+        asyncio.run(proxy.run())
+        return
     proxy = Proxy(**opts)
     proxy.run()
 
@@ -0,0 +1,243 @@
+#
+# Copyright (C) 2017 The Regents of the University of California.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+Recording TSKBATCH messages to files and replaying them through the proxy.
+
+A recording is a sequence of messages, each preceded by its length (as a
+4-byte network-order integer). Files may be compressed with gzip (.gz) or,
+if the zstandard package is installed, zstd (.zst).
+"""
+
+import gzip
+import logging
+import mmap
+import os
+import struct
+import time
+import pytimeseries.tsk.proxy
+
+LENGTH = struct.Struct("!L")
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("zstd recordings need the zstandard package")
+    return zstandard
+
+
+class ReplayMessage:
+    """
+    A recorded message, with the subset of the confluent_kafka.Message
+    interface used by the proxy.
+    """
+
+    __slots__ = ('_value', )
+
+    def __init__(self, value):
+        self._value = value
+
+    def value(self):
+        return self._value
+
+    def error(self):
+        return None
+
+    def partition(self):
+        return 0
+
+
+class ReplayReader(pytimeseries.tsk.proxy.TskReader):
+    """
+    Reads recorded TSKBATCH messages from files, in order, in place of
+    Kafka.
+
+    Files are memory-mapped. Messages of uncompressed files are returned as
+    memoryviews into the mapping, so they are not copied. If rate is given,
+    at most that many messages are returned per second.
+    """
+
+    def __init__(self, paths, channel, rate=None):
+        self.channel = bytes(channel, 'ascii')
+        self.paths = list(paths)
+        self.rate = rate
+        self.start_time = None
+        self.msg_cnt = 0
+        # current file: its mapping, and either a view over it (with the
+        # offset of the next message) or a decompressing reader
+        self.path = None
+        self.mm = None
+        self.view = None
+        self.offset = 0
+        self.stream = None
+        self.finished = False
+
+    def _open_next(self):
+        self._close_file()
+        if not self.paths:
+            self.finished = True
+            return False
+        self.path = self.paths.pop(0)
+        logging.info("Replaying messages from %s" % self.path)
+        with open(self.path, 'rb') as fh:
+            if os.fstat(fh.fileno()).st_size == 0:
+                # empty files cannot be mapped (and have no messages)
+                return self._open_next()
+            self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic = self.mm[:4]
+        if magic.startswith(GZIP_MAGIC):
+            self.stream = gzip.GzipFile(fileobj=self.mm, mode='rb')
+        elif magic == ZSTD_MAGIC:
+            self.stream = _zstandard().ZstdDecompressor().stream_reader(
+                self.mm)
+        else:
+            self.view = memoryview(self.mm)
+            self.offset = 0
+        return True
+
+    def _close_file(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        # messages that are still referenced keep the mapping alive, so it
+        # is unmapped when they (and the view) are released
+        self.view = None
+        self.mm = None
+
+    def _truncated(self):
+        # the messages read so far are still used (e.g. the last recording
+        # of a proxy that was killed)
+        logging.error("Skipping truncated message at the end of %s" %
+                      self.path)
+        return None
+
+    def _next_msg(self):
+        """Get the next message of the current file, or None at its end."""
+        if self.view is not None:
+            if self.offset >= len(self.view):
+                return None
+            end = self.offset + LENGTH.size
+            if end > len(self.view):
+                return self._truncated()
+            (length, ) = LENGTH.unpack_from(self.view, self.offset)
+            if end + length > len(self.view):
+                return self._truncated()
+            self.offset = end + length
+            return self.view[end:self.offset]
+        hdr = self.stream.read(LENGTH.size)
+        if not hdr:
+            return None
+        if len(hdr) != LENGTH.size:
+            return self._truncated()
+        (length, ) = LENGTH.unpack(hdr)
+        msg = self.stream.read(length)
+        if len(msg) != length:
+            return self._truncated()
+        return msg
+
+    def close(self):
+        self._close_file()
+
+    def poll(self, time):
+        msgs = self.consume_batch(1, time)
+        return msgs[0] if msgs else None
+
+    def consume_batch(self, max_messages, timeout):
+        """
+        Read up to max_messages messages.
+
+        :return: list of messages (empty if none are due within timeout
+                 when throttled, and once all files have been read)
+        """
+        if self.rate:
+            max_messages = self._throttle(max_messages, timeout)
+        msgs = []
+        while len(msgs) < max_messages:
+            if self.mm is None and not self._open_next():
+                break
+            msg = self._next_msg()
+            if msg is None:
+                self._close_file()
+                continue
+            msgs.append(ReplayMessage(msg))
+        self.msg_cnt += len(msgs)
+        return msgs
+
+    def _due(self):
+        return int((time.time() - self.start_time) * self.rate) - self.msg_cnt
+
+    def _throttle(self, max_messages, timeout):
+        # wait (for at most timeout) until at least one more message is due,
+        # then allow as many messages as are due
+        if self.start_time is None:
+            self.start_time = time.time()
+        due = self._due()
+        if due <= 0:
+            wait = ((self.msg_cnt + 1) / self.rate -
+                    (time.time() - self.start_time))
+            time.sleep(min(wait, timeout))
+            # the sleep may have been cut short by the timeout
+            due = self._due()
+        return max(0, min(max_messages, due))
+
+    def commit(self):
+        pass
+
+
+class TskRecorder:
+    """
+    Writes TSKBATCH messages to a recording file (compressed according to
+    its extension: .gz or .zst).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.msg_cnt = 0
+        if path.endswith('.gz'):
+            self.fh = gzip.open(path, 'wb')
+        elif path.endswith('.zst'):
+            self.raw = open(path, 'wb')
+            self.fh = _zstandard().ZstdCompressor().stream_writer(self.raw)
+        else:
+            self.fh = open(path, 'wb')
+        logging.info("Recording messages to %s" % path)
+
+    def write(self, msgbuf):
+        self.fh.write(LENGTH.pack(len(msgbuf)))
+        self.fh.write(msgbuf)
+        self.msg_cnt += 1
+
+    def close(self):
+        self.fh.close()
+        if self.path.endswith('.zst'):
+            self.raw.close()
+        logging.info("Recorded %d messages to %s" %
+                     (self.msg_cnt, self.path))
@@ -0,0 +1,161 @@
+#
+# Copyright (C) 2017 The Regents of the University of California.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+import array
+import bisect
+
+# upper bounds (in microseconds) of the latency histogram buckets
+LATENCY_BOUNDS_US = (10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000,
+                     500000, 1000000, 5000000)
+
+
+class Counter:
+    """
+    A stat that is incremented in place.
+
+    Hot paths should update value directly (counter.value += n) rather than
+    looking the counter up by name.
+    """
+
+    __slots__ = ('name', 'value')
+
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+
+
+class Gauge(Counter):
+    """
+    A stat that is set (rather than incremented) and keeps its value when
+    the stats are reported.
+    """
+
+    __slots__ = ()
+
+
+class Histogram:
+    """
+    A latency histogram with fixed buckets.
+
+    Each bucket counts the observations that are greater than the previous
+    bound and at most its own bound (the last bucket has no upper bound).
+    The buckets, the number of observations and their sum (in microseconds)
+    are all counters, so histograms from several processes can be merged by
+    adding them up.
+    """
+
+    __slots__ = ('name', 'bounds', 'buckets', 'count', 'sum')
+
+    def __init__(self, name, bounds=LATENCY_BOUNDS_US):
+        self.name = name
+        self.bounds = tuple(bounds)
+        self.buckets = [Counter("%s.bucket_%dus" % (name, bound))
+                        for bound in self.bounds]
+        self.buckets.append(Counter("%s.bucket_inf" % name))
+        self.count = Counter("%s.count" % name)
+        self.sum = Counter("%s.sum_us" % name)
+
+    @property
+    def counters(self):
+        return self.buckets + [self.count, self.sum]
+
+    def observe(self, seconds):
+        """Record a latency (in seconds)."""
+        usec = int(seconds * 1000000)
+        self.buckets[bisect.bisect_left(self.bounds, usec)].value += 1
+        self.count.value += 1
+        self.sum.value += usec
+
+
+class StatsRegistry:
+    """
+    The set of stats reported by a process.
+
+    All stats are created up front (with counter, gauge and histogram), after
+    which the registry can be bound to a KeyPackage: the key of every stat
+    is added to the KP once, and write() then copies the current values into
+    the KP with a single set_many call.
+    """
+
+    def __init__(self):
+        self.counters = []
+        self.indices = None
+
+    def counter(self, name):
+        counter = Counter(name)
+        self.counters.append(counter)
+        return counter
+
+    def gauge(self, name):
+        gauge = Gauge(name)
+        self.counters.append(gauge)
+        return gauge
+
+    def histogram(self, name, bounds=LATENCY_BOUNDS_US):
+        histogram = Histogram(name, bounds)
+        self.counters.extend(histogram.counters)
+        return histogram
+
+    def bind(self, kp, key_fn):
+        """
+        Add the keys of all stats to the given KeyPackage.
+
+        :param kp: KeyPackage that the stats will be written to
+        :param key_fn: function that returns the full metric key (str) of
+                       the stat with the given name
+        """
+        keys = [key_fn(c.name).encode() for c in self.counters]
+        kp.upsert_many(keys, [0] * len(keys))
+        self.indices = array.array('Q', [kp.get_key(key) for key in keys])
+
+    def values(self):
+        return array.array('Q', [c.value for c in self.counters])
+
+    def reset(self):
+        for c in self.counters:
+            if not isinstance(c, Gauge):
+                c.value = 0
+
+    def write(self, kp):
+        """Copy the current values into the bound KeyPackage and reset."""
+        kp.set_many(self.indices, self.values())
+        self.reset()
+
+    def snapshot(self):
+        """
+        Get the non-zero counter values and the gauge values, by stat name,
+        and reset. These are kept apart since, when merging the stats of
+        several processes, counters are added up but gauges are not.
+
+        :return: (counters, gauges) tuple of dicts
+        """
+        counters = dict((c.name, c.value) for c in self.counters
+                        if c.value and not isinstance(c, Gauge))
+        gauges = dict((c.name, c.value) for c in self.counters
+                      if isinstance(c, Gauge))
+        self.reset()
+        return counters, gauges
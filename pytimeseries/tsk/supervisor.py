@@ -0,0 +1,268 @@
+#
+# Copyright (C) 2017 The Regents of the University of California.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+import configparser
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+import pytimeseries.tsk.proxy
+
+# maximum delay before restarting a worker that keeps failing
+RESTART_DELAY_MAX = 60
+
+
+def parse_partitions(spec):
+    """
+    Parse a partition list such as "0-31" or "0,2,4-7".
+
+    :param spec: string
+    :return: sorted list of partition numbers
+    """
+    partitions = set()
+    for part in spec.split(','):
+        part = part.strip()
+        if '-' in part:
+            first, last = part.split('-', 1)
+            partitions.update(range(int(first), int(last) + 1))
+        elif part:
+            partitions.add(int(part))
+    if not partitions:
+        raise ValueError("Empty partition list '%s'" % spec)
+    return sorted(partitions)
+
+
+def _run_worker(config_file, reset_offsets, partition, instance, stats_queue):
+    proxy = pytimeseries.tsk.proxy.Proxy(config_file, reset_offsets,
+                                         partition=partition,
+                                         instance=instance,
+                                         stats_queue=stats_queue)
+    proxy.run()
+
+
+class Worker:
+
+    def __init__(self, partition):
+        self.partition = partition
+        self.process = None
+        self.start_time = 0
+        self.restarts = 0
+        self.restart_time = 0
+        # stopped to pick up a new configuration, so to be restarted at once
+        self.reloading = False
+
+
+class Supervisor:
+    """
+    Runs several TSK proxies in worker processes, restarting any that exit.
+
+    Stats are reported by the workers to the supervisor, which sums their
+    counters (and takes the largest value of each gauge) and writes them
+    under a single instance name.
+
+    On SIGHUP, the workers are restarted one at a time, so that they pick up
+    any changes to the configuration file (the supervisor's own settings are
+    not reloaded).
+    """
+
+    def __init__(self, config_file, reset_offsets, instance=None,
+                 workers=None, partitions=None):
+        self.config_file = os.path.expanduser(config_file)
+        self.reset_offsets = reset_offsets
+        self.instance = instance
+
+        self.config = configparser.ConfigParser()
+        self.config.read_file(open(self.config_file))
+        logging.basicConfig(level=self.config.get('logging', 'loglevel'),
+                            format='%(asctime)s|TSK|SUPERVISOR'
+                                   '|%(levelname)s: %(message)s',
+                            datefmt='%Y-%m-%d %H:%M:%S')
+
+        # assign partitions to workers
+        if partitions is None:
+            # let the consumer group balance the partitions
+            self.workers = [Worker(None) for _ in range(workers or 1)]
+        else:
+            if not workers:
+                workers = len(partitions)
+            workers = min(workers, len(partitions))
+            self.workers = [Worker(partitions[i::workers])
+                            for i in range(workers)]
+
+        # workers are spawned rather than forked so that they do not
+        # inherit the state of our stats backend
+        self.mp = multiprocessing.get_context('spawn')
+        self.stats_queue = self.mp.Queue()
+        self.stats_interval = int(self.config.get('stats', 'interval'))
+        self.stats_ts = None
+        self.stats_kp = None
+        # merged (counters, gauges), by time
+        self.stats = {}
+        self._init_stats()
+
+        self.shutdown = 0
+        # workers still to be restarted for a reload
+        self.reload_queue = []
+        signal.signal(signal.SIGTERM, self._stop_handler)
+        signal.signal(signal.SIGINT, self._stop_handler)
+        signal.signal(signal.SIGHUP, self._hup_handler)
+
+    def _init_stats(self):
+        if not self.stats_interval:
+            return
+        import _pytimeseries
+        self.stats_ts = _pytimeseries.Timeseries()
+        be_name = self.config.get('stats', 'ts_backend')
+        be = self.stats_ts.get_backend_by_name(be_name)
+        if not be:
+            raise ValueError("Could not find TS backend %s" % be_name)
+        opts = self.config.get('stats', 'ts_opts')
+        if not self.stats_ts.enable_backend(be, opts):
+            raise RuntimeError("Could not enable stats TS backend %s" % be_name)
+        self.stats_kp = self.stats_ts.new_keypackage(reset=True, disable=True)
+
+    def _signal_workers(self, signo):
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                os.kill(worker.process.pid, signo)
+
+    def _stop_handler(self, _signo, _stack_frame):
+        logging.info("Caught signal, stopping workers")
+        self.shutdown += 1
+        self._signal_workers(signal.SIGTERM)
+
+    def _hup_handler(self, _signo, _stack_frame):
+        # workers treat HUP as a request to shut down, so rather than
+        # forwarding it, restart them (see _reload_workers)
+        logging.info("Caught HUP, restarting workers to reload the "
+                     "configuration")
+        self.reload_queue = list(self.workers)
+
+    def _reload_workers(self):
+        # one at a time, so that the other workers keep consuming
+        if any(worker.reloading for worker in self.workers):
+            return
+        while self.reload_queue:
+            worker = self.reload_queue.pop(0)
+            if worker.process is not None and worker.process.is_alive():
+                logging.info("Restarting worker %s" % worker.process.name)
+                worker.reloading = True
+                os.kill(worker.process.pid, signal.SIGTERM)
+                return
+
+    def _start_worker(self, worker):
+        part_name = 'ALL'
+        if worker.partition is not None:
+            part_name = ",".join([str(p) for p in worker.partition])
+        logging.info("Starting worker for partitions %s" % part_name)
+        worker.start_time = time.time()
+        worker.process = self.mp.Process(
+            target=_run_worker,
+            args=(self.config_file, self.reset_offsets, worker.partition,
+                  self.instance, self.stats_queue),
+            name="tsk-proxy-%s" % part_name)
+        worker.process.start()
+
+    def _check_workers(self):
+        now = time.time()
+        for worker in self.workers:
+            proc = worker.process
+            if proc.is_alive():
+                continue
+            if worker.reloading:
+                proc.join()
+                worker.reloading = False
+                self._start_worker(worker)
+            elif worker.restart_time == 0:
+                logging.error("Worker %s exited with code %s" %
+                              (proc.name, proc.exitcode))
+                proc.join()
+                # back off if the worker keeps exiting
+                if now - worker.start_time > RESTART_DELAY_MAX:
+                    worker.restarts = 0
+                delay = min(2 ** worker.restarts, RESTART_DELAY_MAX)
+                worker.restarts += 1
+                worker.restart_time = now + delay
+            elif now >= worker.restart_time:
+                worker.restart_time = 0
+                self._start_worker(worker)
+
+    def _handle_stats(self, timeout):
+        try:
+            stats_time, (counters, gauges) = \
+                self.stats_queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+        merged_counters, merged_gauges = \
+            self.stats.setdefault(stats_time, ({}, {}))
+        for stat, value in counters.items():
+            merged_counters[stat] = merged_counters.get(stat, 0) + value
+        # gauges (e.g. KP sizes) are not meaningful when summed
+        for stat, value in gauges.items():
+            merged_gauges[stat] = max(merged_gauges.get(stat, 0), value)
+
+    def _maybe_flush_stats(self, force=False):
+        if not self.stats_interval:
+            return
+        # give every worker a full interval to report
+        horizon = time.time() - 2 * self.stats_interval
+        for stats_time in sorted(self.stats):
+            if not force and stats_time > horizon:
+                break
+            counters, values = self.stats.pop(stats_time)
+            values.update(counters)
+            keys = [pytimeseries.tsk.proxy.stat_key(self.config,
+                                                    self.instance, stat)
+                    .encode() for stat in values]
+            logging.debug("Flushing stats at %d" % stats_time)
+            self.stats_kp.upsert_many(keys, list(values.values()))
+            self.stats_kp.flush(stats_time)
+
+    def run(self):
+        logging.info("TSK Proxy supervisor starting %d workers..." %
+                     len(self.workers))
+        for worker in self.workers:
+            self._start_worker(worker)
+
+        while not self.shutdown:
+            self._handle_stats(1)
+            self._maybe_flush_stats()
+            if not self.shutdown:
+                self._check_workers()
+                self._reload_workers()
+
+        logging.info("Waiting for workers to shut down")
+        for worker in self.workers:
+            while worker.process.is_alive():
+                self._handle_stats(1)
+            worker.process.join()
+        while not self.stats_queue.empty():
+            self._handle_stats(0)
+        self._maybe_flush_stats(force=True)
+        logging.info("Shutdown complete")
@@ -0,0 +1,230 @@
+#
+# Copyright (C) 2017 The Regents of the University of California.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import logging
+import struct
+import pytimeseries.tsk.proxy
+
+# default maximum size of a TSKBATCH message (librdkafka's default
+# message.max.bytes is 1000000, which also covers the Kafka framing)
+DEFAULT_MAX_MSG_SIZE = 900000
+
+# version, time and channel length
+_HEADER = struct.Struct("!BLH")
+
+_VALUE = struct.Struct("!Q")
+
+
+class TskWriter:
+    """
+    Writes key/values to Kafka as TSKBATCH messages.
+
+    Key/values are packed into a preallocated buffer until either the
+    message reaches max_msg_size or a key/value for a different time is
+    written, at which point the message is produced (asynchronously) to the
+    topic for the channel. Keys must be bytes.
+
+    Delivery reports are handled by on_delivery (called as
+    on_delivery(err, msg) from produce(), poll() or flush()), or, by
+    default, counted in delivered_cnt and failed_cnt and logged on failure.
+
+    A producer (with the interface of confluent_kafka.Producer) may be given
+    in place of creating one from brokers and producer_conf.
+    """
+
+    def __init__(self, topic_prefix, channel, brokers,
+                 max_msg_size=DEFAULT_MAX_MSG_SIZE, producer_conf=None,
+                 on_delivery=None, producer=None):
+        if isinstance(channel, bytes):
+            self.channel = channel
+            channel = channel.decode('ascii')
+        else:
+            self.channel = channel.encode('ascii')
+        self.topic_name = ".".join([topic_prefix, channel])
+
+        self.header_len = (pytimeseries.tsk.proxy.HEADER_MAGIC_LEN +
+                           _HEADER.size + len(self.channel))
+        if max_msg_size <= self.header_len:
+            raise ValueError("max_msg_size must be larger than %d bytes" %
+                             self.header_len)
+        self.max_msg_size = max_msg_size
+        self.buf = bytearray(max_msg_size)
+        self.buf[:pytimeseries.tsk.proxy.HEADER_MAGIC_LEN] = \
+            pytimeseries.tsk.proxy.TSKBATCH_MAGIC
+
+        # packers for key/value records, by key length
+        self.kv_structs = {}
+
+        # the message being filled
+        self.time = None
+        self.offset = 0
+        self.kv_cnt = 0
+
+        self.msg_cnt = 0
+        self.delivered_cnt = 0
+        self.failed_cnt = 0
+        self.on_delivery = on_delivery or self._on_delivery
+        # set once the producer has rejected a memoryview of the buffer
+        self.copy_payload = False
+
+        if producer is not None:
+            self.producer = producer
+            return
+        conf = {
+            'bootstrap.servers': brokers,
+            # let librdkafka batch messages on the way out
+            'queue.buffering.max.ms': 100,
+            'message.max.bytes': max(max_msg_size + 1024, 1000000),
+        }
+        if producer_conf:
+            conf.update(producer_conf)
+        # imported here so that only producers load librdkafka
+        import confluent_kafka
+        self.producer = confluent_kafka.Producer(conf)
+
+    def _on_delivery(self, err, msg):
+        if err is None:
+            self.delivered_cnt += 1
+        else:
+            self.failed_cnt += 1
+            logging.error("Failed to deliver TSKBATCH message: %s" % err)
+
+    def _kv_struct(self, key_len):
+        kv_struct = self.kv_structs.get(key_len)
+        if kv_struct is None:
+            if key_len > 0xffff:
+                raise ValueError("Keys must be at most 65535 bytes long")
+            kv_struct = struct.Struct("!H%dsQ" % key_len)
+            if self.header_len + kv_struct.size > self.max_msg_size:
+                raise ValueError("Key of %d bytes does not fit in a message "
+                                 "of max_msg_size %d" %
+                                 (key_len, self.max_msg_size))
+            self.kv_structs[key_len] = kv_struct
+        return kv_struct
+
+    def _start(self, time):
+        self.time = time
+        offset = pytimeseries.tsk.proxy.HEADER_MAGIC_LEN
+        _HEADER.pack_into(self.buf, offset,
+                          pytimeseries.tsk.proxy.TSKBATCH_VERSION, time,
+                          len(self.channel))
+        offset += _HEADER.size
+        self.buf[offset:offset + len(self.channel)] = self.channel
+        self.offset = offset + len(self.channel)
+        self.kv_cnt = 0
+
+    def _produce(self):
+        if not self.kv_cnt:
+            return
+        # librdkafka copies the payload, so the buffer can be reused at once
+        value = memoryview(self.buf)[:self.offset]
+        if self.copy_payload:
+            value = bytes(value)
+        while True:
+            try:
+                self.producer.produce(self.topic_name, value,
+                                      on_delivery=self.on_delivery)
+                break
+            except BufferError:
+                # the local queue is full: wait for some deliveries
+                self.producer.poll(1)
+            except TypeError:
+                # confluent_kafka only accepts read-only buffers (bytes), so
+                # copy the payload from now on
+                if self.copy_payload:
+                    raise
+                self.copy_payload = True
+                value = bytes(value)
+        self.producer.poll(0)
+        self.msg_cnt += 1
+        self.kv_cnt = 0
+        self.offset = self.header_len
+
+    def write(self, time, key, value):
+        """
+        Write a single key/value for the given time.
+        """
+        kv_struct = self._kv_struct(len(key))
+        if time != self.time:
+            self._produce()
+            self._start(time)
+        elif self.offset + kv_struct.size > self.max_msg_size:
+            self._produce()
+        kv_struct.pack_into(self.buf, self.offset, len(key), key, value)
+        self.offset += kv_struct.size
+        self.kv_cnt += 1
+
+    def write_many(self, time, keys, values):
+        """
+        Write key/values for the given time.
+
+        :param keys: sequence of keys (bytes)
+        :param values: sequence of values, e.g. a list of ints, an
+                       array.array('Q') or a NumPy uint64 array
+        """
+        if len(keys) != len(values):
+            raise ValueError("keys and values must have the same length")
+        if time != self.time:
+            self._produce()
+            self._start(time)
+        buf = self.buf
+        max_size = self.max_msg_size
+        kv_structs = self.kv_structs
+        offset = self.offset
+        cnt = self.kv_cnt
+        try:
+            for key, value in zip(keys, values):
+                key_len = len(key)
+                kv_struct = (kv_structs.get(key_len) or
+                             self._kv_struct(key_len))
+                if offset + kv_struct.size > max_size:
+                    self.offset = offset
+                    self.kv_cnt = cnt
+                    self._produce()
+                    offset = self.offset
+                    cnt = 0
+                kv_struct.pack_into(buf, offset, key_len, key, int(value))
+                offset += kv_struct.size
+                cnt += 1
+        finally:
+            # keep the key/values packed so far (e.g. if a key is too long
+            # or a value is not an integer)
+            self.offset = offset
+            self.kv_cnt = cnt
+
+    def poll(self, timeout=0):
+        """Serve delivery reports."""
+        return self.producer.poll(timeout)
+
+    def flush(self, timeout=-1):
+        """
+        Produce the current message and wait for all messages to be
+        delivered.
+
+        :return: number of messages still waiting to be delivered
+        """
+        self._produce()
+        return self.producer.flush(timeout)
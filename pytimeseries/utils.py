@@ -24,6 +24,29 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 
+import functools
+
+# maximum number of distinct components remembered by the cached
+# (batch) variants below
+GRAPHITE_CACHE_SIZE = 65536
+
+try:
+    _GRAPHITE_SAFE_TABLE = str.maketrans({'.': '-', '/': '_'})
+except AttributeError:
+    # Python 2 (str.translate cannot map to a string there)
+    _GRAPHITE_SAFE_TABLE = None
+
+try:
+    # typed, so that e.g. 1 and 1.0 (which are equal, but not as strings)
+    # are cached separately
+    _graphite_cache = functools.lru_cache(maxsize=GRAPHITE_CACHE_SIZE,
+                                          typed=True)
+except AttributeError:
+    # Python 2 has no lru_cache, so the results are not cached
+    def _graphite_cache(fn):
+        return fn
+
+
 def graphite_safe_node(key):
     """
     Convert a string into a graphite-safe node key. 
@@ -32,7 +55,9 @@ def graphite_safe_node(key):
     :param key: string
     :return: graphite-safe string
     """
-    return str(key).replace('.', '-').replace('/', '_')
+    if _GRAPHITE_SAFE_TABLE is None:
+        return str(key).replace('.', '-').replace('/', '_')
+    return str(key).translate(_GRAPHITE_SAFE_TABLE)
 
 
 def graphite_safe_ip(ip_addr):
@@ -57,3 +82,83 @@ def graphite_safe_pfx(pfx):
     :return: charthouse-formatted prefix node
     """
     return '__PFX_' + graphite_safe_node(str(pfx))
+
+
+@_graphite_cache
+def _cached_safe_node(key):
+    return graphite_safe_node(key)
+
+
+@_graphite_cache
+def _cached_safe_node_bytes(key):
+    return _cached_safe_node(key).encode()
+
+
+@_graphite_cache
+def _cached_safe_ip(ip_addr):
+    return '__IP_' + _cached_safe_node(str(ip_addr))
+
+
+@_graphite_cache
+def _cached_safe_pfx(pfx):
+    return '__PFX_' + _cached_safe_node(str(pfx))
+
+
+def _encode_all(strs, encode):
+    if encode:
+        return [s.encode() for s in strs]
+    return strs
+
+
+def graphite_safe_nodes(keys, encode=False):
+    """
+    Batch version of graphite_safe_node. Results for repeated keys are
+    cached.
+
+    :param keys: iterable of strings (or other values, e.g. ints)
+    :param encode: return bytes rather than strings
+    :return: list of graphite-safe strings (or bytes)
+    """
+    if encode:
+        return [_cached_safe_node_bytes(k) for k in keys]
+    return [_cached_safe_node(k) for k in keys]
+
+
+def graphite_safe_ips(ip_addrs, encode=False):
+    """
+    Batch version of graphite_safe_ip. Results for repeated addresses are
+    cached.
+
+    :param ip_addrs: iterable of IP addresses
+    :param encode: return bytes rather than strings
+    :return: list of charthouse-formatted IP nodes
+    """
+    return _encode_all([_cached_safe_ip(ip) for ip in ip_addrs], encode)
+
+
+def graphite_safe_pfxs(pfxs, encode=False):
+    """
+    Batch version of graphite_safe_pfx. Results for repeated prefixes are
+    cached.
+
+    :param pfxs: iterable of prefixes
+    :param encode: return bytes rather than strings
+    :return: list of charthouse-formatted prefix nodes
+    """
+    return _encode_all([_cached_safe_pfx(pfx) for pfx in pfxs], encode)
+
+
+def graphite_key(nodes, prefix=None):
+    """
+    Build a metric key from the given components, each of which is made
+    graphite-safe (with caching). The result can be passed directly to
+    KeyPackage.add_key.
+
+    :param nodes: iterable of key components
+    :param prefix: dotted string prepended to the key as-is (optional)
+    :return: key as bytes
+    """
+    key = b".".join([_cached_safe_node_bytes(n) for n in nodes])
+    if prefix:
+        return prefix.encode() + b"." + key
+    return key
@@ -31,7 +31,10 @@ _pytimeseries_module = Extension("_pytimeseries",
                                  sources=["src/_pytimeseries_module.c",
                                           "src/_pytimeseries_timeseries.c",
                                           "src/_pytimeseries_backend.c",
-                                          "src/_pytimeseries_kp.c"])
+                                          "src/_pytimeseries_kp.c",
+                                          "src/_pytimeseries_utils.c",
+                                          "src/_pytimeseries_lpf.c",
+                                          "src/_pytimeseries_keystore.c"])
 
 setup(name="pytimeseries",
       description="A Python interface to libtimeseries",
@@ -55,5 +58,6 @@ setup(name="pytimeseries",
       entry_points={'console_scripts': [
           'pytsk-proxy=pytimeseries.tsk.proxy:main'
       ]},
-      install_requires=['confluent-kafka']
+      install_requires=['confluent-kafka'],
+      extras_require={'zstd': ['zstandard']}
       )
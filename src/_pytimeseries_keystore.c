@@ -0,0 +1,204 @@
+/*
+ * Copyright (C) 2016 The Regents of the University of California.
+ *
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions are met:
+ *
+ * 1. Redistributions of source code must retain the above copyright notice,
+ *    this list of conditions and the following disclaimer.
+ *
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions and the following disclaimer in the documentation
+ *    and/or other materials provided with the distribution.
+ *
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ * ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+ * LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+ * CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ * SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+ * INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+ * CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ * POSSIBILITY OF SUCH DAMAGE.
+ */
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+
+#include "_pytimeseries_keystore.h"
+
+/* Keys are front-coded in blocks of KS_BLOCK_KEYS keys: the first key of a
+   block is stored in full, and each of the others as the length of the
+   prefix it shares with the previous key, followed by the remaining suffix.
+   Lengths are stored as varints. Dotted graphite keys share most of their
+   prefix with their neighbours, so this stores a fraction of the key bytes,
+   and only one offset per block. */
+#define KS_BLOCK_KEYS 16
+
+struct pyts_keystore {
+  /* front-coded keys */
+  uint8_t *data;
+  size_t data_len;
+  size_t data_alloc;
+
+  /* offset of each block in data */
+  size_t *blocks;
+  size_t blocks_alloc;
+
+  size_t cnt;
+  size_t max_len;
+
+  /* the last key appended (to front-code the next one against) */
+  char *last;
+  size_t last_len;
+  size_t last_alloc;
+};
+
+pyts_keystore_t *
+pyts_keystore_init(void)
+{
+  return calloc(1, sizeof(pyts_keystore_t));
+}
+
+void
+pyts_keystore_free(pyts_keystore_t **ks)
+{
+  if (*ks == NULL) {
+    return;
+  }
+  free((*ks)->data);
+  free((*ks)->blocks);
+  free((*ks)->last);
+  free(*ks);
+  *ks = NULL;
+}
+
+/* make sure the given array can hold at least need bytes */
+static int
+grow(void **ptr, size_t *alloc, size_t need)
+{
+  size_t new_alloc = *alloc ? *alloc : 1024;
+  void *new_ptr;
+
+  if (need <= *alloc) {
+    return 0;
+  }
+  while (new_alloc < need) {
+    new_alloc *= 2;
+  }
+  if ((new_ptr = realloc(*ptr, new_alloc)) == NULL) {
+    return -1;
+  }
+  *ptr = new_ptr;
+  *alloc = new_alloc;
+  return 0;
+}
+
+static size_t
+put_varint(uint8_t *p, size_t val)
+{
+  size_t n = 0;
+
+  while (val >= 0x80) {
+    p[n++] = (uint8_t)(val | 0x80);
+    val >>= 7;
+  }
+  p[n++] = (uint8_t)val;
+  return n;
+}
+
+static const uint8_t *
+get_varint(const uint8_t *p, size_t *val)
+{
+  size_t v = 0;
+  int shift = 0;
+
+  while (*p & 0x80) {
+    v |= (size_t)(*p++ & 0x7f) << shift;
+    shift += 7;
+  }
+  *val = v | ((size_t)*p++ << shift);
+  return p;
+}
+
+long
+pyts_keystore_append(pyts_keystore_t *ks, const char *key, size_t len)
+{
+  size_t shared = 0;
+  uint8_t *p;
+
+  if (ks->cnt % KS_BLOCK_KEYS == 0) {
+    if (grow((void **)&ks->blocks, &ks->blocks_alloc,
+             (ks->cnt / KS_BLOCK_KEYS + 1) * sizeof(size_t)) != 0) {
+      return -1;
+    }
+    ks->blocks[ks->cnt / KS_BLOCK_KEYS] = ks->data_len;
+  } else {
+    while (shared < len && shared < ks->last_len &&
+           key[shared] == ks->last[shared]) {
+      shared++;
+    }
+  }
+
+  /* two varints of at most 10 bytes each */
+  if (grow((void **)&ks->data, &ks->data_alloc,
+           ks->data_len + 20 + len - shared) != 0 ||
+      grow((void **)&ks->last, &ks->last_alloc, len + 1) != 0) {
+    return -1;
+  }
+
+  p = ks->data + ks->data_len;
+  p += put_varint(p, shared);
+  p += put_varint(p, len - shared);
+  memcpy(p, key + shared, len - shared);
+  ks->data_len = (p - ks->data) + len - shared;
+
+  memcpy(ks->last + shared, key + shared, len - shared);
+  ks->last[len] = '\0';
+  ks->last_len = len;
+
+  if (len > ks->max_len) {
+    ks->max_len = len;
+  }
+
+  return ks->cnt++;
+}
+
+size_t
+pyts_keystore_size(pyts_keystore_t *ks)
+{
+  return ks->cnt;
+}
+
+size_t
+pyts_keystore_max_len(pyts_keystore_t *ks)
+{
+  return ks->max_len;
+}
+
+size_t
+pyts_keystore_get(pyts_keystore_t *ks, size_t idx, char *buf)
+{
+  const uint8_t *p = ks->data + ks->blocks[idx / KS_BLOCK_KEYS];
+  size_t i, shared, suffix, len = 0;
+
+  /* decode the block up to the key, each key on top of the previous one */
+  for (i = idx - idx % KS_BLOCK_KEYS; i <= idx; i++) {
+    p = get_varint(p, &shared);
+    p = get_varint(p, &suffix);
+    memcpy(buf + shared, p, suffix);
+    p += suffix;
+    len = shared + suffix;
+  }
+  buf[len] = '\0';
+  return len;
+}
+
+size_t
+pyts_keystore_mem(pyts_keystore_t *ks)
+{
+  return sizeof(pyts_keystore_t) + ks->data_alloc + ks->blocks_alloc +
+         ks->last_alloc;
+}
@@ -0,0 +1,80 @@
+/*
+ * Copyright (C) 2016 The Regents of the University of California.
+ *
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions are met:
+ *
+ * 1. Redistributions of source code must retain the above copyright notice,
+ *    this list of conditions and the following disclaimer.
+ *
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions and the following disclaimer in the documentation
+ *    and/or other materials provided with the distribution.
+ *
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ * ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+ * LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+ * CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ * SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+ * INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+ * CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ * POSSIBILITY OF SUCH DAMAGE.
+ */
+
+#ifndef ___pytimeseries_keystore_H
+#define ___pytimeseries_keystore_H
+
+#include <stddef.h>
+
+/** Append-only store of the keys of a KeyPackage, in index order.
+ *
+ * libtimeseries does not expose the keys of a Key Package, so we keep our
+ * own copy (e.g. to save them to a file). Keys are prefix-compressed, so a
+ * key is decoded (along with up to 15 of the keys before it) when it is
+ * copied out. The store does not need the GIL.
+ */
+typedef struct pyts_keystore pyts_keystore_t;
+
+/** Create a new (empty) key store
+ *
+ * @return pointer to the key store, or NULL if out of memory
+ */
+pyts_keystore_t *pyts_keystore_init(void);
+
+/** Free the given key store */
+void pyts_keystore_free(pyts_keystore_t **ks);
+
+/** Append a key to the store
+ *
+ * @param ks            pointer to the key store
+ * @param key           key to append (need not be NUL-terminated)
+ * @param len           length of the key
+ * @return the index of the key, or -1 if out of memory
+ */
+long pyts_keystore_append(pyts_keystore_t *ks, const char *key, size_t len);
+
+/** Get the number of keys in the store */
+size_t pyts_keystore_size(pyts_keystore_t *ks);
+
+/** Get the length of the longest key in the store */
+size_t pyts_keystore_max_len(pyts_keystore_t *ks);
+
+/** Copy the key with the given index into the given buffer
+ *
+ * The buffer is also used to decode the keys the key is compressed against.
+ *
+ * @param ks            pointer to the key store
+ * @param idx           index of the key
+ * @param buf           buffer to copy the (NUL-terminated) key into. Must be
+ *                      at least pyts_keystore_max_len(ks) + 1 bytes long
+ * @return the length of the key
+ */
+size_t pyts_keystore_get(pyts_keystore_t *ks, size_t idx, char *buf);
+
+/** Get the number of bytes of memory used by the store */
+size_t pyts_keystore_mem(pyts_keystore_t *ks);
+
+#endif /* ___pytimeseries_keystore_H */
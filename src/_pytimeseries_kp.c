@@ -26,154 +26,1943 @@
 #include <Python.h>
 #include "pyutils.h"
 
+#include <errno.h>
+#include <fcntl.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <time.h>
+#include <unistd.h>
+
 #include <timeseries.h>
 
 #include "_pytimeseries_kp.h"
+#include "_pytimeseries_lpf.h"
+#include "_pytimeseries_utils.h"
+
+#define KeyPackageDocstring                                             \
+  "Timeseries KeyPackage object\n\n"                                    \
+  "A KeyPackage may be used from any thread, but by only one thread at " \
+  "a time. flush and resolve release the GIL while the backends do "     \
+  "their I/O; any other call on the same KeyPackage made during that "   \
+  "time raises RuntimeError. Other KeyPackages (e.g. one being filled "  \
+  "while this one is flushed) can be used freely in the meantime, as "   \
+  "can views (see values_view) of this one."
+
+/* Fail if a blocking call is in progress on this KP in another thread */
+#define KP_CHECK_IDLE(self)                                             \
+  do {                                                                  \
+    if ((self)->busy) {                                                 \
+      PyErr_SetString(PyExc_RuntimeError,                               \
+                      "KeyPackage is being used by another thread");    \
+      return NULL;                                                      \
+    }                                                                   \
+  } while (0)
+
+/* Fail if the given key index is out of range */
+#define KP_CHECK_INDEX(self, idx)                                       \
+  do {                                                                  \
+    if ((idx) < 0 || (size_t)(idx) >= kp_size(self)) {                  \
+      PyErr_SetString(PyExc_IndexError, "key index out of range");      \
+      return NULL;                                                      \
+    }                                                                   \
+  } while (0)
+
+#define KeyPackageTypeName "_pytimeseries.KeyPackage"
+
+#define KeyPackageBufferTypeName "_pytimeseries.KeyPackageBuffer"
+
+#define KeyPackageKeyIterTypeName "_pytimeseries.KeyPackageKeyIter"
+
+/* Bitmap helpers (for the flushed bitmap) */
+#define BITMAP_WORDS(n) (((n) + 63) / 64)
+#define BITMAP_TEST(bm, i) (((bm)[(i) / 64] >> ((i) % 64)) & 1)
+#define BITMAP_SET(bm, i) ((bm)[(i) / 64] |= (uint64_t)1 << ((i) % 64))
+
+/* kp_add_key error codes */
+#define KP_ADD_ERR_FAILED -1
+#define KP_ADD_ERR_EXPORTS -2
+
+static void
+KeyPackage_dealloc(KeyPackageObject *self)
+{
+  if (self->kp != NULL) {
+    timeseries_kp_free(&self->kp);
+  }
+
+  free(self->keybuf);
+  self->keybuf = NULL;
+
+  pyts_keystore_free(&self->keys);
+
+  free(self->values);
+  self->values = NULL;
+  free(self->enabled);
+  self->enabled = NULL;
+  free(self->last_values);
+  self->last_values = NULL;
+  free(self->flushed);
+  self->flushed = NULL;
+  free(self->written);
+  self->written = NULL;
+  free(self->last_active);
+  self->last_active = NULL;
+
+  if (self->TS != NULL) {
+    Py_DECREF(self->TS);
+    self->TS = NULL;
+  }
+
+  Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static int
+KeyPackage_init(KeyPackageObject *self,
+	       PyObject *args, PyObject *kwds)
+{
+  return 0;
+}
+
+/* Number of keys in the KP */
+static size_t
+kp_size(KeyPackageObject *self)
+{
+  return pyts_keystore_size(self->keys);
+}
+
+/* Grow the given bitmap from old_alloc to alloc bits, clearing the new
+   bits. Returns 0 if successful, -1 otherwise. */
+static int
+bitmap_grow(uint64_t **bm, size_t old_alloc, size_t alloc)
+{
+  uint64_t *grown;
+
+  if ((grown = realloc(*bm, BITMAP_WORDS(alloc) * sizeof(uint64_t))) == NULL) {
+    return -1;
+  }
+  memset(grown + BITMAP_WORDS(old_alloc), 0,
+         (BITMAP_WORDS(alloc) - BITMAP_WORDS(old_alloc)) * sizeof(uint64_t));
+  *bm = grown;
+  return 0;
+}
+
+/* Grow the delta mode arrays from old_alloc to alloc keys. Returns 0 if
+   successful, -1 otherwise. Does not need the GIL. */
+static int
+kp_alloc_delta(KeyPackageObject *self, size_t old_alloc, size_t alloc)
+{
+  uint64_t *last_values;
+
+  if ((last_values = realloc(self->last_values,
+                             alloc * sizeof(uint64_t))) == NULL) {
+    return -1;
+  }
+  self->last_values = last_values;
+  return bitmap_grow(&self->flushed, old_alloc, alloc);
+}
+
+/* Make room for at least the given number of keys. Returns 0 if successful,
+   or a KP_ADD_ERR_* error code. Does not need the GIL. */
+static int
+kp_reserve(KeyPackageObject *self, size_t cnt)
+{
+  size_t alloc = self->alloc ? self->alloc : 1024;
+  uint64_t *values;
+  uint8_t *enabled;
+  uint32_t *last_active;
+
+  if (cnt <= self->alloc) {
+    return 0;
+  }
+  /* exported buffers would be left pointing at freed memory */
+  if (self->exports > 0) {
+    return KP_ADD_ERR_EXPORTS;
+  }
+  while (alloc < cnt) {
+    alloc *= 2;
+  }
+  if ((values = realloc(self->values, alloc * sizeof(uint64_t))) == NULL) {
+    return KP_ADD_ERR_FAILED;
+  }
+  self->values = values;
+  if ((enabled = realloc(self->enabled, alloc)) == NULL) {
+    return KP_ADD_ERR_FAILED;
+  }
+  self->enabled = enabled;
+  if ((last_active = realloc(self->last_active,
+                             alloc * sizeof(uint32_t))) == NULL) {
+    return KP_ADD_ERR_FAILED;
+  }
+  self->last_active = last_active;
+  if (bitmap_grow(&self->written, self->alloc, alloc) != 0) {
+    return KP_ADD_ERR_FAILED;
+  }
+  if (self->delta && kp_alloc_delta(self, self->alloc, alloc) != 0) {
+    return KP_ADD_ERR_FAILED;
+  }
+  self->alloc = alloc;
+  return 0;
+}
+
+/* Add a key to the KP (and to our copy of the keys). Returns the index of the
+   key, or a KP_ADD_ERR_* error code on failure. Does not need the GIL. */
+static int
+kp_add_key(KeyPackageObject *self, const char *key)
+{
+  int idx;
+  int rc;
+
+  if ((rc = kp_reserve(self, kp_size(self) + 1)) != 0) {
+    return rc;
+  }
+  if ((idx = timeseries_kp_add_key(self->kp, key)) < 0 ||
+      pyts_keystore_append(self->keys, key, strlen(key)) != idx) {
+    return KP_ADD_ERR_FAILED;
+  }
+
+  /* new keys are enabled */
+  self->values[idx] = 0;
+  self->enabled[idx] = 1;
+  self->last_active[idx] = self->last_time;
+
+  return idx;
+}
+
+/* Set the Python exception for the given kp_add_key error */
+static void
+kp_set_add_error(int rc, const char *key)
+{
+  if (rc == KP_ADD_ERR_EXPORTS) {
+    PyErr_SetString(PyExc_BufferError,
+                    "Existing exports of data: KeyPackage cannot grow "
+                    "(see reserve)");
+  } else {
+    PyErr_Format(PyExc_RuntimeError, "Failed to add key '%s'", key);
+  }
+}
+
+/* Allocate the scratch key buffer if needed. Returns 0 if successful, -1
+   (with a Python exception set) otherwise. */
+static int
+kp_init_keybuf(KeyPackageObject *self)
+{
+  if (self->keybuf == NULL &&
+      (self->keybuf = malloc(TSKBATCH_KEY_LEN_MAX + 1)) == NULL) {
+    PyErr_NoMemory();
+    return -1;
+  }
+  return 0;
+}
+
+/* Get a NUL-terminated key from the given object: either a bytes object
+   (used in place), or length bytes (-1 for all) at offset in any object
+   supporting the buffer protocol, which are copied into the scratch key
+   buffer. Returns NULL (with a Python exception set) on error. */
+static const char *
+kp_get_key_arg(KeyPackageObject *self, PyObject *obj, Py_ssize_t offset,
+               Py_ssize_t length)
+{
+  Py_buffer buf;
+  const char *key = NULL;
+
+  if (PyBytes_Check(obj) && offset == 0 && length < 0) {
+    return pyts_get_bytestr(obj, NULL);
+  }
+
+  if (PyObject_GetBuffer(obj, &buf, PyBUF_SIMPLE) != 0) {
+    return NULL;
+  }
+  if (length < 0) {
+    length = buf.len - offset;
+  }
+  if (offset < 0 || length < 0 || offset > buf.len - length) {
+    PyErr_SetString(PyExc_ValueError, "key offset/length out of range");
+  } else if (length > TSKBATCH_KEY_LEN_MAX) {
+    PyErr_Format(PyExc_ValueError, "keys must be at most %d bytes",
+                 TSKBATCH_KEY_LEN_MAX);
+  } else if (memchr((char *)buf.buf + offset, '\0', length) != NULL) {
+    PyErr_SetString(PyExc_ValueError, "embedded null byte");
+  } else if (kp_init_keybuf(self) == 0) {
+    memcpy(self->keybuf, (char *)buf.buf + offset, length);
+    self->keybuf[length] = '\0';
+    key = self->keybuf;
+  }
+  PyBuffer_Release(&buf);
+
+  return key;
+}
+
+static PyObject *
+KeyPackage_add_key(KeyPackageObject *self, PyObject *args, PyObject *kwds)
+{
+  static char *kwlist[] = {
+    "key", //
+    "offset", //
+    "length", //
+    NULL //
+  };
+  PyObject *key_obj;
+  Py_ssize_t offset = 0;
+  Py_ssize_t length = -1;
+  const char *key;
+  int idx;
+
+  KP_CHECK_IDLE(self);
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|nn", kwlist,
+                                   &key_obj, &offset, &length) ||
+      (key = kp_get_key_arg(self, key_obj, offset, length)) == NULL) {
+    return NULL;
+  }
+
+  if ((idx = kp_add_key(self, key)) < 0) {
+    kp_set_add_error(idx, key);
+    return NULL;
+  }
+
+  return Py_BuildValue("i", idx);
+}
+
+static PyObject *
+KeyPackage_get_key(KeyPackageObject *self, PyObject *args, PyObject *kwds)
+{
+  static char *kwlist[] = {
+    "key", //
+    "offset", //
+    "length", //
+    NULL //
+  };
+  PyObject *key_obj;
+  Py_ssize_t offset = 0;
+  Py_ssize_t length = -1;
+  const char *key;
+  int idx;
+
+  KP_CHECK_IDLE(self);
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|nn", kwlist,
+                                   &key_obj, &offset, &length) ||
+      (key = kp_get_key_arg(self, key_obj, offset, length)) == NULL) {
+    return NULL;
+  }
+
+  if ((idx = timeseries_kp_get_key(self->kp, key)) < 0) {
+    /* not a fatal error, just means the key does not exist */
+    Py_RETURN_NONE;
+  }
+
+  return Py_BuildValue("i", idx);
+}
+
+static PyObject *
+KeyPackage_disable_key(KeyPackageObject *self, PyObject *args)
+{
+  int idx;
+
+  KP_CHECK_IDLE(self);
+
+  if (!PyArg_ParseTuple(args, "i", &idx)) {
+    return NULL;
+  }
+
+  KP_CHECK_INDEX(self, idx);
+  self->enabled[idx] = 0;
+
+  Py_RETURN_NONE;
+}
+
+static PyObject *
+KeyPackage_enable_key(KeyPackageObject *self, PyObject *args)
+{
+  int idx;
+
+  KP_CHECK_IDLE(self);
+
+  if (!PyArg_ParseTuple(args, "i", &idx)) {
+    return NULL;
+  }
+
+  KP_CHECK_INDEX(self, idx);
+  self->enabled[idx] = 1;
+
+  Py_RETURN_NONE;
+}
+
+static PyObject *
+KeyPackage_get(KeyPackageObject *self, PyObject *args)
+{
+  int idx;
+  unsigned long long val;
+
+  KP_CHECK_IDLE(self);
+
+  if (!PyArg_ParseTuple(args, "i", &idx)) {
+    return NULL;
+  }
+
+  KP_CHECK_INDEX(self, idx);
+  val = self->values[idx];
+
+  return Py_BuildValue("K", val);
+}
+
+static const char *kp_agg_names[] = {"set", "add", "max", "min", NULL};
+
+/* Get the KP_AGG_* aggregation with the given name (or the default if the
+   name is NULL). Returns -1 (with a Python exception set) if the name is
+   unknown. */
+static int
+kp_parse_agg(KeyPackageObject *self, const char *name)
+{
+  int i;
+
+  if (name == NULL) {
+    return self->agg;
+  }
+  for (i = 0; kp_agg_names[i] != NULL; i++) {
+    if (strcmp(name, kp_agg_names[i]) == 0) {
+      return i;
+    }
+  }
+  PyErr_Format(PyExc_ValueError,
+               "Unknown aggregation '%s' (expected set, add, max or min)",
+               name);
+  return -1;
+}
+
+/* Write a value to the given key, combining it with the value already
+   written in this interval (if any). Does not need the GIL. */
+static inline void
+kp_write(KeyPackageObject *self, size_t idx, uint64_t val, int agg)
+{
+  uint64_t cur;
+
+  if (agg != KP_AGG_SET && BITMAP_TEST(self->written, idx)) {
+    cur = self->values[idx];
+    switch (agg) {
+    case KP_AGG_ADD:
+      val += cur;
+      break;
+    case KP_AGG_MAX:
+      if (cur > val) {
+        val = cur;
+      }
+      break;
+    case KP_AGG_MIN:
+      if (cur < val) {
+        val = cur;
+      }
+      break;
+    }
+  }
+  self->values[idx] = val;
+  BITMAP_SET(self->written, idx);
+}
+
+static PyObject *
+KeyPackage_set(KeyPackageObject *self, PyObject *args, PyObject *kwds)
+{
+  static char *kwlist[] = {
+    "idx", //
+    "val", //
+    "agg", //
+    NULL //
+  };
+  int idx;
+  unsigned long long val;
+  const char *agg_name = NULL;
+  int agg;
+
+  KP_CHECK_IDLE(self);
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "iK|z", kwlist,
+                                   &idx, &val, &agg_name) ||
+      (agg = kp_parse_agg(self, agg_name)) < 0) {
+    return NULL;
+  }
+
+  KP_CHECK_INDEX(self, idx);
+  kp_write(self, idx, val, agg);
+
+  Py_RETURN_NONE;
+}
+
+/* Look up the given key, adding it if it does not exist, and make sure it is
+   enabled. Returns the index of the key, or a KP_ADD_ERR_* error code on
+   failure. Does not need the GIL. */
+static int
+kp_upsert_key(KeyPackageObject *self, const char *key, int *added)
+{
+  int idx;
+
+  if ((idx = timeseries_kp_get_key(self->kp, key)) < 0) {
+    if ((idx = kp_add_key(self, key)) < 0) {
+      return idx;
+    }
+    (*added)++;
+  } else {
+    self->enabled[idx] = 1;
+  }
+
+  return idx;
+}
+
+static PyObject *
+KeyPackage_upsert_many(KeyPackageObject *self, PyObject *args, PyObject *kwds)
+{
+  static char *kwlist[] = {
+    "keys", //
+    "values", //
+    "agg", //
+    NULL //
+  };
+  const char *agg_name = NULL;
+  int agg;
+  PyObject *keys_obj;
+  PyObject *vals_obj;
+  PyObject *keys = NULL;
+  pyts_u64_array_t vals;
+  Py_ssize_t i, len;
+  const char *key;
+  uint64_t val;
+  int idx;
+  int added = 0;
+
+  KP_CHECK_IDLE(self);
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO|z", kwlist,
+                                   &keys_obj, &vals_obj, &agg_name) ||
+      (agg = kp_parse_agg(self, agg_name)) < 0) {
+    return NULL;
+  }
+
+  if ((keys = PySequence_Fast(keys_obj, "keys must be a sequence")) == NULL) {
+    return NULL;
+  }
+  if (pyts_u64_array_init(&vals, vals_obj, "values must be a sequence") != 0) {
+    Py_DECREF(keys);
+    return NULL;
+  }
+
+  len = PySequence_Fast_GET_SIZE(keys);
+  if (len != vals.len) {
+    PyErr_SetString(PyExc_ValueError,
+                    "keys and values must have the same length");
+    goto err;
+  }
+
+  for (i = 0; i < len; i++) {
+    if ((key = kp_get_key_arg(self, PySequence_Fast_GET_ITEM(keys, i),
+                              0, -1)) == NULL ||
+        pyts_u64_array_get(&vals, i, &val) != 0) {
+      goto err;
+    }
+    if ((idx = kp_upsert_key(self, key, &added)) < 0) {
+      kp_set_add_error(idx, key);
+      goto err;
+    }
+    kp_write(self, idx, val, agg);
+  }
+
+  pyts_u64_array_free(&vals);
+  Py_DECREF(keys);
+  return Py_BuildValue("i", added);
+
+ err:
+  pyts_u64_array_free(&vals);
+  Py_DECREF(keys);
+  return NULL;
+}
+
+static PyObject *
+KeyPackage_set_many(KeyPackageObject *self, PyObject *args, PyObject *kwds)
+{
+  static char *kwlist[] = {
+    "indices", //
+    "values", //
+    "agg", //
+    NULL //
+  };
+  const char *agg_name = NULL;
+  int agg;
+  PyObject *idxs_obj;
+  PyObject *vals_obj;
+  pyts_u64_array_t idxs;
+  pyts_u64_array_t vals;
+  Py_ssize_t i;
+  uint64_t idx, val;
+  uint64_t size;
+
+  KP_CHECK_IDLE(self);
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO|z", kwlist,
+                                   &idxs_obj, &vals_obj, &agg_name) ||
+      (agg = kp_parse_agg(self, agg_name)) < 0) {
+    return NULL;
+  }
+
+  if (pyts_u64_array_init(&idxs, idxs_obj,
+                          "indices must be a sequence") != 0) {
+    return NULL;
+  }
+  if (pyts_u64_array_init(&vals, vals_obj, "values must be a sequence") != 0) {
+    pyts_u64_array_free(&idxs);
+    return NULL;
+  }
+
+  if (idxs.len != vals.len) {
+    PyErr_SetString(PyExc_ValueError,
+                    "indices and values must have the same length");
+    goto err;
+  }
+
+  size = kp_size(self);
+  for (i = 0; i < idxs.len; i++) {
+    if (pyts_u64_array_get(&idxs, i, &idx) != 0 ||
+        pyts_u64_array_get(&vals, i, &val) != 0) {
+      goto err;
+    }
+    if (idx >= size) {
+      PyErr_SetString(PyExc_IndexError, "key index out of range");
+      goto err;
+    }
+    kp_write(self, idx, val, agg);
+  }
+
+  pyts_u64_array_free(&vals);
+  pyts_u64_array_free(&idxs);
+  Py_RETURN_NONE;
+
+ err:
+  pyts_u64_array_free(&vals);
+  pyts_u64_array_free(&idxs);
+  return NULL;
+}
+
+/* Read big-endian (network order) integers */
+#define GET_BE16(p) ((uint16_t)(((uint16_t)(p)[0] << 8) | (p)[1]))
+#define GET_BE32(p)                                                     \
+  (((uint32_t)(p)[0] << 24) | ((uint32_t)(p)[1] << 16) |                \
+   ((uint32_t)(p)[2] << 8) | (uint32_t)(p)[3])
+#define GET_BE64(p)                                                     \
+  (((uint64_t)GET_BE32(p) << 32) | (uint64_t)GET_BE32((p) + 4))
+
+enum {
+  TSKBATCH_OK = 0,
+  TSKBATCH_ERR_MALFORMED,
+  TSKBATCH_ERR_MAGIC,
+  TSKBATCH_ERR_VERSION,
+  TSKBATCH_ERR_CHANNEL,
+  TSKBATCH_ERR_ADD,
+  TSKBATCH_ERR_EXPORTS,
+};
+
+/* Decode the TSKBATCH message in the given buffer and upsert all of its
+   key/values into the KP. Does not need the GIL. */
+static int
+kp_apply_tskbatch(KeyPackageObject *self, const uint8_t *buf, size_t len,
+                  const char *channel, size_t channel_len, int agg,
+                  uint32_t *time, uint8_t *version, Py_ssize_t *cnt)
+{
+  size_t offset = 0;
+  uint16_t slen;
+  uint64_t val;
+  int idx;
+  int added = 0;
+
+  /* header: magic, version, time, channel */
+  if (len < TSKBATCH_MAGIC_LEN + 1 + 4 + 2) {
+    return TSKBATCH_ERR_MALFORMED;
+  }
+  if (memcmp(buf, TSKBATCH_MAGIC, TSKBATCH_MAGIC_LEN) != 0) {
+    return TSKBATCH_ERR_MAGIC;
+  }
+  offset += TSKBATCH_MAGIC_LEN;
+
+  *version = buf[offset];
+  offset += 1;
+  if (*version != TSKBATCH_VERSION) {
+    return TSKBATCH_ERR_VERSION;
+  }
+
+  *time = GET_BE32(buf + offset);
+  offset += 4;
+
+  slen = GET_BE16(buf + offset);
+  offset += 2;
+  if (offset + slen > len) {
+    return TSKBATCH_ERR_MALFORMED;
+  }
+  if (slen != channel_len || memcmp(buf + offset, channel, slen) != 0) {
+    return TSKBATCH_ERR_CHANNEL;
+  }
+  offset += slen;
+
+  /* key/value records */
+  *cnt = 0;
+  while (offset < len) {
+    if (offset + 2 > len) {
+      return TSKBATCH_ERR_MALFORMED;
+    }
+    slen = GET_BE16(buf + offset);
+    offset += 2;
+    if (offset + slen + 8 > len || memchr(buf + offset, '\0', slen) != NULL) {
+      return TSKBATCH_ERR_MALFORMED;
+    }
+    /* libtimeseries needs a NUL-terminated key */
+    memcpy(self->keybuf, buf + offset, slen);
+    self->keybuf[slen] = '\0';
+    offset += slen;
+
+    val = GET_BE64(buf + offset);
+    offset += 8;
+
+    if ((idx = kp_upsert_key(self, self->keybuf, &added)) < 0) {
+      return idx == KP_ADD_ERR_EXPORTS ?
+        TSKBATCH_ERR_EXPORTS : TSKBATCH_ERR_ADD;
+    }
+    kp_write(self, idx, val, agg);
+    (*cnt)++;
+  }
+
+  return TSKBATCH_OK;
+}
+
+static PyObject *
+KeyPackage_apply_tskbatch(KeyPackageObject *self, PyObject *args,
+                          PyObject *kwds)
+{
+  static char *kwlist[] = {
+    "buf", //
+    "channel", //
+    "agg", //
+    NULL //
+  };
+  const char *agg_name = NULL;
+  int agg;
+  Py_buffer buf;
+  const char *channel;
+  uint32_t time = 0;
+  uint8_t version = 0;
+  Py_ssize_t cnt = 0;
+  int rc;
+
+  KP_CHECK_IDLE(self);
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, PT_BUFFER PT_BYTESTR "|z",
+                                   kwlist, &buf, &channel, &agg_name)) {
+    return NULL;
+  }
+  if ((agg = kp_parse_agg(self, agg_name)) < 0) {
+    PyBuffer_Release(&buf);
+    return NULL;
+  }
+
+  if (kp_init_keybuf(self) != 0) {
+    PyBuffer_Release(&buf);
+    return NULL;
+  }
+
+  /* the buffer is pinned by the view, so decode it without the GIL */
+  self->busy = 1;
+  Py_BEGIN_ALLOW_THREADS
+  rc = kp_apply_tskbatch(self, buf.buf, buf.len, channel, strlen(channel),
+                         agg, &time, &version, &cnt);
+  Py_END_ALLOW_THREADS
+  self->busy = 0;
+
+  PyBuffer_Release(&buf);
+
+  switch (rc) {
+  case TSKBATCH_OK:
+    return Py_BuildValue("In", time, cnt);
+
+  case TSKBATCH_ERR_MAGIC:
+    PyErr_SetString(PyExc_RuntimeError, "Kafka message with invalid magic");
+    return NULL;
+
+  case TSKBATCH_ERR_VERSION:
+    PyErr_Format(PyExc_RuntimeError,
+                 "Kafka message with version %d (expected %d)",
+                 (int)version, TSKBATCH_VERSION);
+    return NULL;
+
+  case TSKBATCH_ERR_CHANNEL:
+    PyErr_Format(PyExc_RuntimeError,
+                 "Kafka message with unexpected channel (expected %s)",
+                 channel);
+    return NULL;
+
+  case TSKBATCH_ERR_ADD:
+  case TSKBATCH_ERR_EXPORTS:
+    kp_set_add_error(rc == TSKBATCH_ERR_ADD ?
+                     KP_ADD_ERR_FAILED : KP_ADD_ERR_EXPORTS, self->keybuf);
+    return NULL;
+
+  default:
+    PyErr_SetString(PyExc_RuntimeError, "malformed Kafka message");
+    return NULL;
+  }
+}
+
+/* State of apply_lpf */
+struct lpf_ctx {
+  KeyPackageObject *self;
+  uint32_t time;
+  const char *prefix;
+  size_t prefix_len;
+  int agg;
+  Py_ssize_t cnt;
+};
+
+enum {
+  LPF_ERR_ADD = 1,
+  LPF_ERR_EXPORTS,
+};
+
+static int
+lpf_apply_cb(void *vctx, const pyts_lpf_point_t *point,
+             const char *field, size_t field_len, uint64_t value)
+{
+  struct lpf_ctx *ctx = vctx;
+  int idx, added = 0;
+
+  if (point->time != ctx->time) {
+    return 0;
+  }
+  if (pyts_lpf_build_key(ctx->self->keybuf, TSKBATCH_KEY_LEN_MAX,
+                         ctx->prefix, ctx->prefix_len, point,
+                         field, field_len) < 0) {
+    /* key too long */
+    return 0;
+  }
+  if ((idx = kp_upsert_key(ctx->self, ctx->self->keybuf, &added)) < 0) {
+    return idx == KP_ADD_ERR_EXPORTS ? LPF_ERR_EXPORTS : LPF_ERR_ADD;
+  }
+  kp_write(ctx->self, idx, value, ctx->agg);
+  ctx->cnt++;
+  return 0;
+}
+
+static PyObject *
+KeyPackage_apply_lpf(KeyPackageObject *self, PyObject *args, PyObject *kwds)
+{
+  static char *kwlist[] = {
+    "buf", //
+    "interval", //
+    "time", //
+    "prefix", //
+    "agg", //
+    "now", //
+    NULL //
+  };
+  struct lpf_ctx ctx;
+  const char *agg_name = NULL;
+  Py_buffer buf;
+  unsigned int interval;
+  unsigned int now = 0;
+  size_t invalid = 0;
+  int rc;
+
+  KP_CHECK_IDLE(self);
+
+  memset(&ctx, 0, sizeof(ctx));
+  ctx.self = self;
+  ctx.prefix = "";
+  if (!PyArg_ParseTupleAndKeywords(args, kwds,
+                                   PT_BUFFER "II|" PT_BYTESTR "zI", kwlist,
+                                   &buf, &interval, &ctx.time, &ctx.prefix,
+                                   &agg_name, &now)) {
+    return NULL;
+  }
+  ctx.prefix_len = strlen(ctx.prefix);
+  if (interval == 0) {
+    PyErr_SetString(PyExc_ValueError, "interval must be positive");
+  } else if (ctx.prefix_len >= TSKBATCH_KEY_LEN_MAX) {
+    PyErr_SetString(PyExc_ValueError, "prefix is too long");
+  }
+  if (PyErr_Occurred() || (ctx.agg = kp_parse_agg(self, agg_name)) < 0 ||
+      kp_init_keybuf(self) != 0) {
+    PyBuffer_Release(&buf);
+    return NULL;
+  }
+
+  self->busy = 1;
+  Py_BEGIN_ALLOW_THREADS
+  rc = pyts_lpf_parse(buf.buf, buf.len, interval,
+                      now != 0 ? now : time(NULL), lpf_apply_cb, &ctx,
+                      &invalid);
+  Py_END_ALLOW_THREADS
+  self->busy = 0;
+
+  PyBuffer_Release(&buf);
+
+  if (rc != 0) {
+    kp_set_add_error(rc == LPF_ERR_ADD ?
+                     KP_ADD_ERR_FAILED : KP_ADD_ERR_EXPORTS, self->keybuf);
+    return NULL;
+  }
+
+  return Py_BuildValue("n", ctx.cnt);
+}
+
+/* Key snapshot file format (all integers in native byte order):
+     header (struct keys_file_hdr)
+     uint64_t offsets[cnt] -- offset of each key in the key data
+     char data[data_len]   -- NUL-terminated keys, back to back */
+#define KEYS_FILE_MAGIC "PYTSKEYS"
+#define KEYS_FILE_VERSION 1
+#define KEYS_FILE_BOM 0x01020304
+
+struct keys_file_hdr {
+  char magic[8];
+  uint32_t version;
+  uint32_t bom;
+  uint64_t cnt;
+  uint64_t data_len;
+};
+
+enum {
+  KEYS_FILE_OK = 0,
+  KEYS_FILE_ERR_OS = -1,
+  KEYS_FILE_ERR_FORMAT = -2,
+  KEYS_FILE_ERR_ADD = -3,
+  KEYS_FILE_ERR_EXPORTS = -4,
+};
+
+/* Write all keys to the given file. Does not need the GIL. */
+static int
+kp_save_keys(KeyPackageObject *self, const char *path)
+{
+  struct keys_file_hdr hdr;
+  char *tmp_path = NULL;
+  char *key = NULL;
+  FILE *fh = NULL;
+  uint64_t offset = 0;
+  size_t i, len;
+  int err;
+
+  memset(&hdr, 0, sizeof(hdr));
+  memcpy(hdr.magic, KEYS_FILE_MAGIC, sizeof(hdr.magic));
+  hdr.version = KEYS_FILE_VERSION;
+  hdr.bom = KEYS_FILE_BOM;
+  hdr.cnt = pyts_keystore_size(self->keys);
+
+  /* write to a temporary file that is then moved into place, so that the
+     snapshot is replaced atomically */
+  if ((tmp_path = malloc(strlen(path) + 5)) == NULL ||
+      (key = malloc(pyts_keystore_max_len(self->keys) + 1)) == NULL) {
+    errno = ENOMEM;
+    goto err;
+  }
+  sprintf(tmp_path, "%s.tmp", path);
+  if ((fh = fopen(tmp_path, "wb")) == NULL) {
+    goto err;
+  }
+
+  /* the header and offsets, which gives us the length of the data */
+  if (fseek(fh, sizeof(hdr), SEEK_SET) != 0) {
+    goto err;
+  }
+  for (i = 0; i < hdr.cnt; i++) {
+    len = pyts_keystore_get(self->keys, i, key);
+    if (fwrite(&offset, sizeof(offset), 1, fh) != 1) {
+      goto err;
+    }
+    offset += len + 1;
+  }
+  hdr.data_len = offset;
+  for (i = 0; i < hdr.cnt; i++) {
+    len = pyts_keystore_get(self->keys, i, key);
+    if (fwrite(key, 1, len + 1, fh) != len + 1) {
+      goto err;
+    }
+  }
+  if (fseek(fh, 0, SEEK_SET) != 0 || fwrite(&hdr, sizeof(hdr), 1, fh) != 1) {
+    goto err;
+  }
+
+  if (fclose(fh) != 0) {
+    fh = NULL;
+    goto err;
+  }
+  fh = NULL;
+  if (rename(tmp_path, path) != 0) {
+    goto err;
+  }
+
+  free(key);
+  free(tmp_path);
+  return KEYS_FILE_OK;
+
+ err:
+  err = errno;
+  if (fh != NULL) {
+    fclose(fh);
+  }
+  if (tmp_path != NULL) {
+    unlink(tmp_path);
+  }
+  free(key);
+  free(tmp_path);
+  errno = err;
+  return KEYS_FILE_ERR_OS;
+}
+
+/* Add (disabled) all keys from the given file that are not already in the
+   KP. Does not need the GIL. */
+static int
+kp_load_keys(KeyPackageObject *self, const char *path, int *added)
+{
+  struct keys_file_hdr *hdr;
+  struct stat st;
+  const uint8_t *map = MAP_FAILED;
+  const uint64_t *offsets;
+  const char *data;
+  const char *key;
+  uint64_t i;
+  int fd, idx;
+  int rc = KEYS_FILE_ERR_FORMAT;
+  int err;
+
+  if ((fd = open(path, O_RDONLY)) < 0 || fstat(fd, &st) != 0) {
+    goto err_os;
+  }
+  if ((size_t)st.st_size < sizeof(struct keys_file_hdr)) {
+    goto out;
+  }
+  if ((map = mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE, fd, 0)) ==
+      MAP_FAILED) {
+    goto err_os;
+  }
+
+  hdr = (struct keys_file_hdr *)map;
+  if (memcmp(hdr->magic, KEYS_FILE_MAGIC, sizeof(hdr->magic)) != 0 ||
+      hdr->version != KEYS_FILE_VERSION || hdr->bom != KEYS_FILE_BOM ||
+      hdr->cnt > ((uint64_t)st.st_size - sizeof(*hdr)) / sizeof(uint64_t) ||
+      hdr->data_len != (uint64_t)st.st_size - sizeof(*hdr) -
+                       hdr->cnt * sizeof(uint64_t)) {
+    goto out;
+  }
+  offsets = (const uint64_t *)(map + sizeof(*hdr));
+  data = (const char *)(offsets + hdr->cnt);
+
+  for (i = 0; i < hdr->cnt; i++) {
+    if (offsets[i] >= hdr->data_len ||
+        memchr(data + offsets[i], '\0', hdr->data_len - offsets[i]) == NULL) {
+      goto out;
+    }
+    key = data + offsets[i];
+    if (timeseries_kp_get_key(self->kp, key) >= 0) {
+      continue;
+    }
+    if ((idx = kp_add_key(self, key)) < 0) {
+      rc = idx == KP_ADD_ERR_EXPORTS ?
+        KEYS_FILE_ERR_EXPORTS : KEYS_FILE_ERR_ADD;
+      goto out;
+    }
+    /* keys are enabled when they are given a value */
+    self->enabled[idx] = 0;
+    (*added)++;
+  }
+  rc = KEYS_FILE_OK;
+
+ out:
+  if (map != MAP_FAILED) {
+    munmap((void *)map, st.st_size);
+  }
+  close(fd);
+  return rc;
+
+ err_os:
+  err = errno;
+  if (map != MAP_FAILED) {
+    munmap((void *)map, st.st_size);
+  }
+  if (fd >= 0) {
+    close(fd);
+  }
+  errno = err;
+  return KEYS_FILE_ERR_OS;
+}
+
+static PyObject *
+KeyPackage_save_keys(KeyPackageObject *self, PyObject *args)
+{
+  const char *path;
+  int rc;
+
+  KP_CHECK_IDLE(self);
+
+  if (!PyArg_ParseTuple(args, "s", &path)) {
+    return NULL;
+  }
+
+  self->busy = 1;
+  Py_BEGIN_ALLOW_THREADS
+  rc = kp_save_keys(self, path);
+  Py_END_ALLOW_THREADS
+  self->busy = 0;
+
+  if (rc != KEYS_FILE_OK) {
+    return PyErr_SetFromErrnoWithFilename(PyExc_IOError, path);
+  }
+
+  Py_RETURN_NONE;
+}
+
+/* Load keys from the given file and resolve them */
+static int
+kp_load_resolve_keys(KeyPackageObject *self, const char *path, int *added)
+{
+  TimeseriesObject *ts = (TimeseriesObject *)self->TS;
+  int rc;
+
+  self->busy = 1;
+  Py_BEGIN_ALLOW_THREADS
+  rc = kp_load_keys(self, path, added);
+  Py_END_ALLOW_THREADS
+  if (rc == KEYS_FILE_OK && *added > 0) {
+    /* do the (potentially slow) backend key resolution now, rather than at
+       the first flush */
+    TS_BLOCKING_CALL(ts, timeseries_kp_resolve(self->kp));
+  }
+  self->busy = 0;
+
+  switch (rc) {
+  case KEYS_FILE_OK:
+    return 0;
+  case KEYS_FILE_ERR_OS:
+    PyErr_SetFromErrnoWithFilename(PyExc_IOError, path);
+    return -1;
+  case KEYS_FILE_ERR_ADD:
+    PyErr_SetString(PyExc_RuntimeError, "Failed to add key");
+    return -1;
+  case KEYS_FILE_ERR_EXPORTS:
+    kp_set_add_error(KP_ADD_ERR_EXPORTS, NULL);
+    return -1;
+  default:
+    PyErr_Format(PyExc_ValueError, "Invalid key snapshot file '%s'", path);
+    return -1;
+  }
+}
+
+static PyObject *
+KeyPackage_load_keys(KeyPackageObject *self, PyObject *args)
+{
+  const char *path;
+  int added = 0;
+
+  KP_CHECK_IDLE(self);
+
+  if (!PyArg_ParseTuple(args, "s", &path)) {
+    return NULL;
+  }
+
+  if (kp_load_resolve_keys(self, path, &added) != 0) {
+    return NULL;
+  }
+
+  return Py_BuildValue("i", added);
+}
+
+struct evict_cand {
+  uint32_t idle;
+  size_t idx;
+};
+
+/* most idle first, then oldest key first */
+static int
+evict_cand_cmp(const void *a, const void *b)
+{
+  const struct evict_cand *ca = a;
+  const struct evict_cand *cb = b;
+
+  if (ca->idle != cb->idle) {
+    return ca->idle > cb->idle ? -1 : 1;
+  }
+  return ca->idx < cb->idx ? -1 : (ca->idx > cb->idx);
+}
+
+/* Number of seconds the given key has been idle for at the given time (keys
+   that have not been through a flush yet are never idle) */
+#define KP_IDLE(self, i, now)                                                 \
+  ((self)->last_active[i] == 0 || (self)->last_active[i] >= (now) ?          \
+   0 : (now) - (self)->last_active[i])
+
+/* Mark (in the given bitmap) the keys that have been idle for more than
+   max_idle seconds as of the given time (if max_idle is non-zero), and then,
+   if more than max_keys (if non-zero) remain, the least recently active keys
+   until at most max_keys * (1 - min_fraction) remain. Unless max_keys was
+   exceeded, nothing is marked if fewer than min_fraction of the keys would
+   be. Returns the number of keys marked, or -1 if out of memory. Does not
+   need the GIL. */
+static ssize_t
+kp_mark_evictions(KeyPackageObject *self, uint32_t max_idle, size_t max_keys,
+                  double min_fraction, uint32_t now, uint64_t *evict)
+{
+  size_t i, size = kp_size(self);
+  size_t cnt = 0, cand_cnt = 0;
+  size_t keep;
+  struct evict_cand *cands;
+
+  for (i = 0; i < size; i++) {
+    if (max_idle != 0 && KP_IDLE(self, i, now) > max_idle) {
+      BITMAP_SET(evict, i);
+      cnt++;
+    }
+  }
+  if (max_keys == 0 || size - cnt <= max_keys) {
+    if (cnt > 0 && cnt < min_fraction * size) {
+      /* not worth rebuilding the KP for yet */
+      memset(evict, 0, BITMAP_WORDS(size) * sizeof(uint64_t));
+      cnt = 0;
+    }
+    return cnt;
+  }
+  /* leave some room so that the next new keys do not each cause a rebuild */
+  keep = max_keys - (size_t)(min_fraction * max_keys);
+
+  /* LRU: evict the least recently active of the remaining keys */
+  if ((cands = malloc((size - cnt) * sizeof(struct evict_cand))) == NULL) {
+    return -1;
+  }
+  for (i = 0; i < size; i++) {
+    if (!BITMAP_TEST(evict, i)) {
+      cands[cand_cnt].idle = KP_IDLE(self, i, now);
+      cands[cand_cnt].idx = i;
+      cand_cnt++;
+    }
+  }
+  qsort(cands, cand_cnt, sizeof(struct evict_cand), evict_cand_cmp);
+  for (i = 0; cand_cnt - i > keep; i++) {
+    BITMAP_SET(evict, cands[i].idx);
+    cnt++;
+  }
+  free(cands);
+  return cnt;
+}
+
+/* Rebuild the KP without the keys marked in the given bitmap, compacting
+   the indices of the remaining keys (in order). If remap is non-NULL, it is
+   filled with the new index of each old key (-1 if evicted). Returns 0 if
+   successful, -1 otherwise (in which case the KP is unchanged). Does not
+   need the GIL. */
+static int
+kp_evict(KeyPackageObject *self, const uint64_t *evict, int64_t *remap)
+{
+  size_t i, j, len, size = kp_size(self);
+  timeseries_kp_t *kp = NULL;
+  pyts_keystore_t *keys = NULL;
+  uint64_t *written = NULL;
+  uint64_t *flushed = NULL;
+  char *key = NULL;
+  TimeseriesObject *ts = (TimeseriesObject *)self->TS;
+
+  if ((kp = timeseries_kp_init(ts->ts, self->flags)) == NULL ||
+      (keys = pyts_keystore_init()) == NULL ||
+      (key = malloc(pyts_keystore_max_len(self->keys) + 1)) == NULL ||
+      bitmap_grow(&written, 0, self->alloc) != 0 ||
+      (self->delta && bitmap_grow(&flushed, 0, self->alloc) != 0)) {
+    goto err;
+  }
+
+  /* add the remaining keys to a new libtimeseries KP */
+  for (i = 0, j = 0; i < size; i++) {
+    if (BITMAP_TEST(evict, i)) {
+      continue;
+    }
+    len = pyts_keystore_get(self->keys, i, key);
+    if (timeseries_kp_add_key(kp, key) != (int)j ||
+        pyts_keystore_append(keys, key, len) != (long)j) {
+      goto err;
+    }
+    j++;
+  }
+
+  /* and move their state down to their new index */
+  for (i = 0, j = 0; i < size; i++) {
+    if (BITMAP_TEST(evict, i)) {
+      if (remap != NULL) {
+        remap[i] = -1;
+      }
+      continue;
+    }
+    if (remap != NULL) {
+      remap[i] = j;
+    }
+    self->values[j] = self->values[i];
+    self->enabled[j] = self->enabled[i];
+    self->last_active[j] = self->last_active[i];
+    if (BITMAP_TEST(self->written, i)) {
+      BITMAP_SET(written, j);
+    }
+    if (self->delta) {
+      self->last_values[j] = self->last_values[i];
+      if (BITMAP_TEST(self->flushed, i)) {
+        BITMAP_SET(flushed, j);
+      }
+    }
+    j++;
+  }
+
+  timeseries_kp_free(&self->kp);
+  self->kp = kp;
+  pyts_keystore_free(&self->keys);
+  self->keys = keys;
+  free(self->written);
+  self->written = written;
+  if (self->delta) {
+    free(self->flushed);
+    self->flushed = flushed;
+  }
+  free(key);
+  return 0;
+
+ err:
+  if (kp != NULL) {
+    timeseries_kp_free(&kp);
+  }
+  pyts_keystore_free(&keys);
+  free(key);
+  free(written);
+  free(flushed);
+  return -1;
+}
+
+static PyObject *
+KeyPackage_evict(KeyPackageObject *self, PyObject *args, PyObject *kwds)
+{
+  static char *kwlist[] = {
+    "max_idle", //
+    "max_keys", //
+    "remap", //
+    "now", //
+    "min_fraction", //
+    NULL //
+  };
+  unsigned int max_idle;
+  Py_ssize_t max_keys = 0;
+  int want_remap = 0;
+  unsigned int now = 0;
+  double min_fraction = 0;
+  PyObject *remap_buf = NULL;
+  PyObject *remap_view = NULL;
+  PyObject *remap = NULL;
+  uint64_t *evict = NULL;
+  ssize_t cnt;
+  int rc = 0;
+
+  KP_CHECK_IDLE(self);
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "I|niId", kwlist,
+                                   &max_idle, &max_keys, &want_remap, &now,
+                                   &min_fraction)) {
+    return NULL;
+  }
+  if (max_keys < 0) {
+    PyErr_SetString(PyExc_ValueError, "max_keys must not be negative");
+    return NULL;
+  }
+  if (min_fraction < 0 || min_fraction >= 1) {
+    PyErr_SetString(PyExc_ValueError,
+                    "min_fraction must be at least 0 and less than 1");
+    return NULL;
+  }
+  if (now == 0) {
+    now = self->last_time;
+  }
+
+  if (bitmap_grow(&evict, 0, kp_size(self)) != 0) {
+    return PyErr_NoMemory();
+  }
+  if ((cnt = kp_mark_evictions(self, max_idle, max_keys, min_fraction, now,
+                               evict)) < 0) {
+    free(evict);
+    return PyErr_NoMemory();
+  }
+  if (cnt > 0 && self->exports > 0) {
+    free(evict);
+    PyErr_SetString(PyExc_BufferError,
+                    "Existing exports of data: cannot evict keys");
+    return NULL;
+  }
+
+  if (want_remap) {
+    if ((remap_buf = PyByteArray_FromStringAndSize(
+           NULL, kp_size(self) * sizeof(int64_t))) == NULL) {
+      free(evict);
+      return NULL;
+    }
+    if (cnt == 0) {
+      /* nothing moves */
+      int64_t *map = (int64_t *)PyByteArray_AS_STRING(remap_buf);
+      size_t i;
+      for (i = 0; i < kp_size(self); i++) {
+        map[i] = i;
+      }
+    }
+  }
+
+  if (cnt > 0) {
+    /* the keys of the new libtimeseries KP are resolved by the next flush
+       (or resolve) */
+    self->busy = 1;
+    Py_BEGIN_ALLOW_THREADS
+    rc = kp_evict(self, evict, remap_buf == NULL ? NULL :
+                  (int64_t *)PyByteArray_AS_STRING(remap_buf));
+    Py_END_ALLOW_THREADS
+    self->busy = 0;
+    self->key_gen++;
+  }
+  free(evict);
+
+  if (rc != 0) {
+    Py_XDECREF(remap_buf);
+    PyErr_SetString(PyExc_RuntimeError, "Failed to evict keys");
+    return NULL;
+  }
+
+  if (remap_buf == NULL) {
+    return Py_BuildValue("n", (Py_ssize_t)cnt);
+  }
+  if ((remap_view = PyMemoryView_FromObject(remap_buf)) != NULL) {
+    remap = PyObject_CallMethod(remap_view, "cast", "s", "q");
+  }
+  Py_DECREF(remap_buf);
+  Py_XDECREF(remap_view);
+  if (remap == NULL) {
+    return NULL;
+  }
+  return Py_BuildValue("nN", (Py_ssize_t)cnt, remap);
+}
+
+/* Check whether the keys of dst are the first keys of src. Does not need the
+   GIL. */
+static int
+kp_keys_prefix_of(KeyPackageObject *dst, KeyPackageObject *src)
+{
+  size_t i, size = kp_size(dst);
+  char *dkey = NULL, *skey = NULL;
+  int match = 0;
+
+  if (size > kp_size(src)) {
+    return 0;
+  }
+  if ((dkey = malloc(pyts_keystore_max_len(dst->keys) + 1)) == NULL ||
+      (skey = malloc(pyts_keystore_max_len(src->keys) + 1)) == NULL) {
+    goto done;
+  }
+  for (i = 0; i < size; i++) {
+    pyts_keystore_get(dst->keys, i, dkey);
+    pyts_keystore_get(src->keys, i, skey);
+    if (strcmp(dkey, skey) != 0) {
+      goto done;
+    }
+  }
+  match = 1;
+
+ done:
+  free(dkey);
+  free(skey);
+  return match;
+}
+
+/* Make dst (which must not have exported buffers) hold the same keys,
+   values and enabled flags as src. Returns 0 if successful, -1 otherwise.
+   Does not need the GIL. */
+static int
+kp_copy_from(KeyPackageObject *dst, KeyPackageObject *src)
+{
+  size_t i, size = kp_size(src);
+  uint64_t *all = NULL;
+  char *key = NULL;
+  int rc = -1;
+
+  if (dst->copy_uid != src->uid || dst->copy_gen != src->key_gen) {
+    /* we were last synced with another KP (or src has evicted keys since),
+       so start over unless our keys happen to match anyway (e.g. if both
+       were preloaded from the same file) */
+    if (!kp_keys_prefix_of(dst, src)) {
+      if (bitmap_grow(&all, 0, kp_size(dst)) != 0) {
+        goto done;
+      }
+      memset(all, 0xff, BITMAP_WORDS(kp_size(dst)) * sizeof(uint64_t));
+      if (kp_evict(dst, all, NULL) != 0) {
+        goto done;
+      }
+      dst->key_gen++;
+    }
+    dst->copy_uid = src->uid;
+    dst->copy_gen = src->key_gen;
+  }
+
+  /* add the keys that src has gained since the last copy */
+  if (kp_reserve(dst, size) != 0 ||
+      (key = malloc(pyts_keystore_max_len(src->keys) + 1)) == NULL) {
+    goto done;
+  }
+  for (i = kp_size(dst); i < size; i++) {
+    pyts_keystore_get(src->keys, i, key);
+    if (kp_add_key(dst, key) < 0) {
+      goto done;
+    }
+  }
+
+  memcpy(dst->values, src->values, size * sizeof(uint64_t));
+  memcpy(dst->enabled, src->enabled, size);
+  memcpy(dst->written, src->written, BITMAP_WORDS(size) * sizeof(uint64_t));
+  rc = 0;
+
+ done:
+  free(all);
+  free(key);
+  return rc;
+}
+
+static PyObject *
+KeyPackage_copy_from(KeyPackageObject *self, PyObject *args)
+{
+  KeyPackageObject *src;
+  int rc;
+
+  KP_CHECK_IDLE(self);
+
+  if (!PyArg_ParseTuple(args, "O!", _pytimeseries_kp_get_KeyPackageType(),
+                        &src)) {
+    return NULL;
+  }
+  KP_CHECK_IDLE(src);
+  if (src == self) {
+    PyErr_SetString(PyExc_ValueError, "Cannot copy a KeyPackage into itself");
+    return NULL;
+  }
+  if (self->exports > 0) {
+    PyErr_SetString(PyExc_BufferError,
+                    "Existing exports of data: cannot copy into KeyPackage");
+    return NULL;
+  }
+
+  self->busy = 1;
+  src->busy = 1;
+  Py_BEGIN_ALLOW_THREADS
+  rc = kp_copy_from(self, src);
+  Py_END_ALLOW_THREADS
+  self->busy = 0;
+  src->busy = 0;
+
+  if (rc != 0) {
+    PyErr_SetString(PyExc_RuntimeError, "Failed to copy KeyPackage");
+    return NULL;
+  }
+
+  Py_RETURN_NONE;
+}
+
+static PyObject *
+KeyPackage_resolve(KeyPackageObject *self)
+{
+  TimeseriesObject *ts = (TimeseriesObject *)self->TS;
+  int rc;
+
+  KP_CHECK_IDLE(self);
+
+  self->busy = 1;
+  TS_BLOCKING_CALL(ts, rc = timeseries_kp_resolve(self->kp));
+  self->busy = 0;
+
+  if (rc < 0) {
+    PyErr_SetString(PyExc_RuntimeError, "Failed to resolve keys");
+    return NULL;
+  }
+
+  Py_RETURN_NONE;
+}
 
-#define KeyPackageDocstring "Timeseries KeyPackage object"
+/* Copy our values into the libtimeseries KP, to be flushed. In delta mode,
+   enabled keys whose value has not changed since they were last written are
+   skipped (unless this is a full flush). Needs the GIL, since another thread
+   may be writing through a view. Returns the number of keys written. */
+static size_t
+kp_flush_begin(KeyPackageObject *self, uint32_t time)
+{
+  size_t i, size = kp_size(self);
+  size_t written = 0;
+  int full = !self->delta ||
+    (self->full_every != 0 && self->flush_cnt % self->full_every == 0);
 
-#define KeyPackageTypeName "_pytimeseries.KeyPackage"
+  for (i = 0; i < size; i++) {
+    /* keys that have not been through a flush yet are timed from this one
+       (late data may be flushed at an earlier time than a key was last
+       active at) */
+    if ((self->enabled[i] || BITMAP_TEST(self->written, i) ||
+         self->last_active[i] == 0) && self->last_active[i] < time) {
+      self->last_active[i] = time;
+    }
+    if (self->enabled[i] &&
+        (full || !BITMAP_TEST(self->flushed, i) ||
+         self->last_values[i] != self->values[i])) {
+      timeseries_kp_enable_key(self->kp, i);
+      timeseries_kp_set(self->kp, i, self->values[i]);
+      written++;
+    } else {
+      timeseries_kp_disable_key(self->kp, i);
+    }
+  }
 
-static void
-KeyPackage_dealloc(KeyPackageObject *self)
-{
-  if (self->kp != NULL) {
-    timeseries_kp_free(&self->kp);
+  /* the keys that were skipped already have these values. If the flush
+     fails, kp_flush_end clears the flushed bitmap, so that nothing is
+     skipped by the next flush. */
+  if (self->delta) {
+    for (i = 0; i < size; i++) {
+      if (self->enabled[i]) {
+        self->last_values[i] = self->values[i];
+        BITMAP_SET(self->flushed, i);
+      }
+    }
   }
+  memset(self->written, 0, BITMAP_WORDS(size) * sizeof(uint64_t));
 
-  if (self->TS != NULL) {
-    Py_DECREF(self->TS);
-    self->TS = NULL;
+  /* mirror what libtimeseries does to its own copy after a flush */
+  if (self->flags & TIMESERIES_KP_RESET) {
+    memset(self->values, 0, size * sizeof(uint64_t));
+  }
+  if (self->flags & TIMESERIES_KP_DISABLE) {
+    memset(self->enabled, 0, size);
   }
 
-  Py_TYPE(self)->tp_free((PyObject*)self);
+  return written;
 }
 
-static int
-KeyPackage_init(KeyPackageObject *self,
-	       PyObject *args, PyObject *kwds)
+/* Finish a flush started by kp_flush_begin, once the backends are done with
+   it (rc is the result of timeseries_kp_flush) */
+static void
+kp_flush_end(KeyPackageObject *self, uint32_t time, size_t written, int rc)
 {
-  return 0;
+  if (rc != 0) {
+    memset(self->flushed, 0, BITMAP_WORDS(kp_size(self)) * sizeof(uint64_t));
+    return;
+  }
+  self->flush_cnt++;
+  self->flushed_size = written;
+  if (time > self->last_time) {
+    self->last_time = time;
+  }
 }
 
 static PyObject *
-KeyPackage_add_key(KeyPackageObject *self, PyObject *args)
+KeyPackage_flush(KeyPackageObject *self, PyObject *args)
 {
-  const char *key;
-  int idx;
+  TimeseriesObject *ts = (TimeseriesObject *)self->TS;
+  unsigned int time;
+  size_t written;
+  int rc;
 
-  if (!PyArg_ParseTuple(args, PT_BYTESTR, &key)) {
+  if (!PyArg_ParseTuple(args, "I", &time)) {
     return NULL;
   }
 
-  if ((idx = timeseries_kp_add_key(self->kp, key)) < 0) {
+  KP_CHECK_IDLE(self);
+
+  /* the values are copied into the libtimeseries KP (and then reset) with
+     the GIL held, and the GIL is only released while the backends write
+     that copy, so that values written through a view (see values_view) by
+     another thread in the meantime are left for the next flush rather than
+     racing this one */
+  written = kp_flush_begin(self, time);
+  self->busy = 1;
+  TS_BLOCKING_CALL(ts, rc = timeseries_kp_flush(self->kp, time));
+  self->busy = 0;
+  kp_flush_end(self, time, written, rc);
+
+  if (rc != 0) {
+    PyErr_SetString(PyExc_RuntimeError, "Failed to flush keys");
     return NULL;
   }
 
-  return Py_BuildValue("i", idx);
+  Py_RETURN_NONE;
 }
 
-static PyObject *
-KeyPackage_get_key(KeyPackageObject *self, PyObject *args)
-{
-  const char *key;
-  int idx;
+/* Exporter for the values and enabled arrays of a KP. Each memoryview
+   returned by values_view/enabled_view owns one of these, which keeps the KP
+   alive and stops it from growing (and so reallocating the arrays) while the
+   view exists. */
+typedef struct {
+  PyObject_HEAD
 
-  if (!PyArg_ParseTuple(args, PT_BYTESTR, &key)) {
-    return NULL;
-  }
+  KeyPackageObject *kp;
 
-  if ((idx = timeseries_kp_get_key(self->kp, key)) < 0) {
-    /* not a fatal error, just means the key does not exist */
-    Py_RETURN_NONE;
-  }
+  /* struct format of the items ("Q" for values, "B" for the enabled mask) */
+  char *format;
 
-  return Py_BuildValue("i", idx);
+  /* number of items (i.e. the KP size when the view was created) */
+  Py_ssize_t shape[1];
+} KeyPackageBufferObject;
+
+static void
+KeyPackageBuffer_dealloc(KeyPackageBufferObject *self)
+{
+  Py_XDECREF(self->kp);
+  Py_TYPE(self)->tp_free((PyObject*)self);
 }
 
-static PyObject *
-KeyPackage_disable_key(KeyPackageObject *self, PyObject *args)
+static int
+KeyPackageBuffer_getbuffer(KeyPackageBufferObject *self, Py_buffer *view,
+                           int flags)
 {
-  int idx;
+  int is_values = self->format[0] == 'Q';
+  Py_ssize_t itemsize = is_values ? sizeof(uint64_t) : sizeof(uint8_t);
+  void *buf = is_values ? (void *)self->kp->values : (void *)self->kp->enabled;
 
-  if (!PyArg_ParseTuple(args, "i", &idx)) {
-    return NULL;
+  if (PyBuffer_FillInfo(view, (PyObject *)self, buf, self->shape[0] * itemsize,
+                        0, flags) != 0) {
+    return -1;
   }
+  view->itemsize = itemsize;
+  view->format = (flags & PyBUF_FORMAT) ? self->format : NULL;
+  view->ndim = 1;
+  view->shape = (flags & PyBUF_ND) ? self->shape : NULL;
+  view->strides = (flags & PyBUF_STRIDES) ? &view->itemsize : NULL;
 
-  timeseries_kp_disable_key(self->kp, idx);
+  self->kp->exports++;
+  return 0;
+}
 
-  Py_RETURN_NONE;
+static void
+KeyPackageBuffer_releasebuffer(KeyPackageBufferObject *self, Py_buffer *view)
+{
+  self->kp->exports--;
 }
 
+static PyBufferProcs KeyPackageBuffer_as_buffer = {
+#if PY_MAJOR_VERSION < 3
+  0,                                           /* bf_getreadbuffer */
+  0,                                           /* bf_getwritebuffer */
+  0,                                           /* bf_getsegcount */
+  0,                                           /* bf_getcharbuffer */
+#endif
+  (getbufferproc)KeyPackageBuffer_getbuffer,   /* bf_getbuffer */
+  (releasebufferproc)KeyPackageBuffer_releasebuffer, /* bf_releasebuffer */
+};
+
+#if PY_MAJOR_VERSION < 3
+#define KP_BUFFER_TPFLAGS (Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_NEWBUFFER)
+#else
+#define KP_BUFFER_TPFLAGS Py_TPFLAGS_DEFAULT
+#endif
+
+static PyTypeObject KeyPackageBufferType = {
+  PyVarObject_HEAD_INIT(NULL, 0)
+  KeyPackageBufferTypeName,       /* tp_name */
+  sizeof(KeyPackageBufferObject), /* tp_basicsize */
+  0,                                    /* tp_itemsize */
+  (destructor)KeyPackageBuffer_dealloc, /* tp_dealloc */
+  0,                                    /* tp_print */
+  0,                                    /* tp_getattr */
+  0,                                    /* tp_setattr */
+  0,                                    /* tp_compare */
+  0,                                    /* tp_repr */
+  0,                                    /* tp_as_number */
+  0,                                    /* tp_as_sequence */
+  0,                                    /* tp_as_mapping */
+  0,                                    /* tp_hash */
+  0,                                    /* tp_call */
+  0,                                    /* tp_str */
+  0,                                    /* tp_getattro */
+  0,                                    /* tp_setattro */
+  &KeyPackageBuffer_as_buffer,          /* tp_as_buffer */
+  KP_BUFFER_TPFLAGS,                    /* tp_flags */
+  "KeyPackage value buffer",            /* tp_doc */
+};
+
+/* Create a memoryview over the values or enabled array */
 static PyObject *
-KeyPackage_enable_key(KeyPackageObject *self, PyObject *args)
+kp_new_view(KeyPackageObject *self, char *format)
 {
-  int idx;
+  KeyPackageBufferObject *exporter;
+  PyObject *view;
 
-  if (!PyArg_ParseTuple(args, "i", &idx)) {
+  KP_CHECK_IDLE(self);
+
+  if (PyType_Ready(&KeyPackageBufferType) < 0) {
     return NULL;
   }
+  exporter = PyObject_New(KeyPackageBufferObject, &KeyPackageBufferType);
+  if (exporter == NULL) {
+    return NULL;
+  }
+  exporter->kp = self;
+  Py_INCREF(self);
+  exporter->format = format;
+  exporter->shape[0] = kp_size(self);
 
-  timeseries_kp_enable_key(self->kp, idx);
+  /* the memoryview holds the only reference to the exporter */
+  view = PyMemoryView_FromObject((PyObject *)exporter);
+  Py_DECREF(exporter);
+  return view;
+}
 
-  Py_RETURN_NONE;
+static PyObject *
+KeyPackage_values_view(KeyPackageObject *self)
+{
+  return kp_new_view(self, "Q");
 }
 
 static PyObject *
-KeyPackage_get(KeyPackageObject *self, PyObject *args)
+KeyPackage_enabled_view(KeyPackageObject *self)
 {
-  int idx;
-  unsigned long long val;
+  return kp_new_view(self, "B");
+}
 
-  if (!PyArg_ParseTuple(args, "i", &idx)) {
-    return NULL;
-  }
+/* Iterator over the keys of a KP, in index order, returned by keys(). Keys
+   are decoded from the key store one at a time. */
+typedef struct {
+  PyObject_HEAD
 
-  val = timeseries_kp_get(self->kp, idx);
+  KeyPackageObject *kp;
 
-  return Py_BuildValue("K", val);
+  /* index of the next key, and key_gen of the KP when iteration started */
+  size_t idx;
+  unsigned long key_gen;
+
+  /* buffer to decode keys into */
+  char *buf;
+  size_t buf_len;
+} KeyPackageKeyIterObject;
+
+static void
+KeyPackageKeyIter_dealloc(KeyPackageKeyIterObject *self)
+{
+  Py_XDECREF(self->kp);
+  free(self->buf);
+  Py_TYPE(self)->tp_free((PyObject*)self);
 }
 
 static PyObject *
-KeyPackage_set(KeyPackageObject *self, PyObject *args)
+KeyPackageKeyIter_next(KeyPackageKeyIterObject *self)
 {
-  int idx;
-  unsigned long long val;
+  KeyPackageObject *kp = self->kp;
+  size_t max_len, len;
+  char *buf;
+
+  KP_CHECK_IDLE(kp);
 
-  if (!PyArg_ParseTuple(args, "iK", &idx, &val)) {
+  if (kp->key_gen != self->key_gen) {
+    PyErr_SetString(PyExc_RuntimeError,
+                    "keys were evicted during iteration");
+    return NULL;
+  }
+  if (self->idx >= kp_size(kp)) {
     return NULL;
   }
 
-  timeseries_kp_set(self->kp, idx, val);
+  /* keys may have been added since the last call */
+  max_len = pyts_keystore_max_len(kp->keys);
+  if (max_len + 1 > self->buf_len) {
+    if ((buf = realloc(self->buf, max_len + 1)) == NULL) {
+      return PyErr_NoMemory();
+    }
+    self->buf = buf;
+    self->buf_len = max_len + 1;
+  }
 
-  Py_RETURN_NONE;
+  len = pyts_keystore_get(kp->keys, self->idx++, self->buf);
+  return PyBytes_FromStringAndSize(self->buf, len);
 }
 
+static PyTypeObject KeyPackageKeyIterType = {
+  PyVarObject_HEAD_INIT(NULL, 0)
+  KeyPackageKeyIterTypeName,            /* tp_name */
+  sizeof(KeyPackageKeyIterObject),      /* tp_basicsize */
+  0,                                    /* tp_itemsize */
+  (destructor)KeyPackageKeyIter_dealloc, /* tp_dealloc */
+  0,                                    /* tp_print */
+  0,                                    /* tp_getattr */
+  0,                                    /* tp_setattr */
+  0,                                    /* tp_compare */
+  0,                                    /* tp_repr */
+  0,                                    /* tp_as_number */
+  0,                                    /* tp_as_sequence */
+  0,                                    /* tp_as_mapping */
+  0,                                    /* tp_hash */
+  0,                                    /* tp_call */
+  0,                                    /* tp_str */
+  0,                                    /* tp_getattro */
+  0,                                    /* tp_setattro */
+  0,                                    /* tp_as_buffer */
+  Py_TPFLAGS_DEFAULT,                   /* tp_flags */
+  "KeyPackage key iterator",            /* tp_doc */
+  0,                                    /* tp_traverse */
+  0,                                    /* tp_clear */
+  0,                                    /* tp_richcompare */
+  0,                                    /* tp_weaklistoffset */
+  PyObject_SelfIter,                    /* tp_iter */
+  (iternextfunc)KeyPackageKeyIter_next, /* tp_iternext */
+};
+
 static PyObject *
-KeyPackage_resolve(KeyPackageObject *self)
+KeyPackage_keys(KeyPackageObject *self, PyObject *args, PyObject *kwds)
 {
-  if (timeseries_kp_resolve(self->kp) < 0) {
-    PyErr_SetString(PyExc_RuntimeError, "Failed to resolve keys");
+  static char *kwlist[] = {
+    "start", // index of the first key (optional)
+    NULL
+  };
+  Py_ssize_t start = 0;
+  KeyPackageKeyIterObject *iter;
+
+  KP_CHECK_IDLE(self);
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "|n", kwlist, &start)) {
+    return NULL;
+  }
+  if (start < 0) {
+    PyErr_SetString(PyExc_ValueError, "start must not be negative");
     return NULL;
   }
 
-  Py_RETURN_NONE;
+  if (PyType_Ready(&KeyPackageKeyIterType) < 0) {
+    return NULL;
+  }
+  iter = PyObject_New(KeyPackageKeyIterObject, &KeyPackageKeyIterType);
+  if (iter == NULL) {
+    return NULL;
+  }
+  iter->kp = self;
+  Py_INCREF(self);
+  iter->idx = start;
+  iter->key_gen = self->key_gen;
+  iter->buf = NULL;
+  iter->buf_len = 0;
+
+  return (PyObject *)iter;
 }
 
 static PyObject *
-KeyPackage_flush(KeyPackageObject *self, PyObject *args)
+KeyPackage_reserve(KeyPackageObject *self, PyObject *args)
 {
-  unsigned int time;
+  Py_ssize_t cnt;
+  int rc;
 
-  if (!PyArg_ParseTuple(args, "I", &time)) {
+  KP_CHECK_IDLE(self);
+
+  if (!PyArg_ParseTuple(args, "n", &cnt)) {
     return NULL;
   }
-
-  if (timeseries_kp_flush(self->kp, time) < 0) {
-    PyErr_SetString(PyExc_RuntimeError, "Failed to flush keys");
+  if (cnt < 0) {
+    PyErr_SetString(PyExc_ValueError, "number of keys must be positive");
     return NULL;
   }
 
+  if ((rc = kp_reserve(self, cnt)) != 0) {
+    if (rc == KP_ADD_ERR_EXPORTS) {
+      kp_set_add_error(rc, NULL);
+      return NULL;
+    }
+    return PyErr_NoMemory();
+  }
+
   Py_RETURN_NONE;
 }
 
@@ -182,15 +1971,17 @@ static PyMethodDef KeyPackage_methods[] = {
   {
     "add_key",
     (PyCFunction)KeyPackage_add_key,
-    METH_VARARGS,
-    "Add a metric key"
+    METH_VARARGS | METH_KEYWORDS,
+    "Add a metric key. The key may be bytes or any buffer (e.g. a "
+    "memoryview), optionally with the offset and length of the key in it"
   },
 
   {
     "get_key",
     (PyCFunction)KeyPackage_get_key,
-    METH_VARARGS,
-    "Get index of the given key"
+    METH_VARARGS | METH_KEYWORDS,
+    "Get index of the given key (bytes or any buffer, optionally with the "
+    "offset and length of the key in it), or None if it does not exist"
   },
 
   {
@@ -217,22 +2008,143 @@ static PyMethodDef KeyPackage_methods[] = {
   {
     "set",
     (PyCFunction)KeyPackage_set,
+    METH_VARARGS | METH_KEYWORDS,
+    "Set the current value of the given key (combined with the value "
+    "already written in this interval according to agg, which defaults to "
+    "the KP's aggregation)"
+  },
+
+  {
+    "upsert_many",
+    (PyCFunction)KeyPackage_upsert_many,
+    METH_VARARGS | METH_KEYWORDS,
+    "Add (or enable) each of the given keys (bytes or buffers) and set its "
+    "value (see set for agg). Returns the number of keys that were added"
+  },
+
+  {
+    "set_many",
+    (PyCFunction)KeyPackage_set_many,
+    METH_VARARGS | METH_KEYWORDS,
+    "Set the current values of the keys with the given indices (see set for "
+    "agg)"
+  },
+
+  {
+    "apply_tskbatch",
+    (PyCFunction)KeyPackage_apply_tskbatch,
+    METH_VARARGS | METH_KEYWORDS,
+    "Decode a TSKBATCH message for the given channel and upsert all of its "
+    "key/values (see set for agg). Returns a (time, key/value count) tuple"
+  },
+
+  {
+    "apply_lpf",
+    (PyCFunction)KeyPackage_apply_lpf,
+    METH_VARARGS | METH_KEYWORDS,
+    "Parse a (newline-separated) InfluxDB line protocol payload and upsert "
+    "the field values of the points in the interval starting at time (with "
+    "interval in seconds; see lpf_times), see set for agg. Points without "
+    "a timestamp are at now (default: the current time). Each field is "
+    "written to the key [prefix.]measurement[.tag.value...].field, with "
+    "every component made graphite-safe (keys longer than 65535 "
+    "bytes are skipped). Returns the number of values written"
+  },
+
+  {
+    "save_keys",
+    (PyCFunction)KeyPackage_save_keys,
+    METH_VARARGS,
+    "Save all keys to the given (memory-mappable) snapshot file"
+  },
+
+  {
+    "load_keys",
+    (PyCFunction)KeyPackage_load_keys,
+    METH_VARARGS,
+    "Add (disabled) and resolve all keys from the given snapshot file. "
+    "Returns the number of keys that were added"
+  },
+
+  {
+    "values_view",
+    (PyCFunction)KeyPackage_values_view,
+    METH_NOARGS,
+    "Get a writable memoryview (format 'Q') over the current values of all "
+    "keys. The KP cannot grow beyond its reserved size while views exist. "
+    "Values written while the KP is being flushed by another thread are "
+    "left for the next flush"
+  },
+
+  {
+    "enabled_view",
+    (PyCFunction)KeyPackage_enabled_view,
+    METH_NOARGS,
+    "Get a writable memoryview (format 'B') over the enabled flag of all "
+    "keys. The KP cannot grow beyond its reserved size while views exist. "
+    "Flags set while the KP is being flushed by another thread are left for "
+    "the next flush"
+  },
+
+  {
+    "reserve",
+    (PyCFunction)KeyPackage_reserve,
+    METH_VARARGS,
+    "Preallocate space for the given number of keys, so that keys can be "
+    "added while views exist"
+  },
+
+  {
+    "keys",
+    (PyCFunction)KeyPackage_keys,
+    METH_VARARGS | METH_KEYWORDS,
+    "Get an iterator over the keys (as bytes), in index order, optionally "
+    "starting at the given index. Raises RuntimeError if keys are evicted "
+    "during iteration"
+  },
+
+  {
+    "copy_from",
+    (PyCFunction)KeyPackage_copy_from,
     METH_VARARGS,
-    "Set the current value of the given key"
+    "Make this KeyPackage hold the same keys, values and enabled flags as "
+    "the given one (e.g. to flush the same data to another Timeseries). "
+    "Only the keys added since the last copy are added, as long as keys are "
+    "not evicted from the source"
+  },
+
+  {
+    "evict",
+    (PyCFunction)KeyPackage_evict,
+    METH_VARARGS | METH_KEYWORDS,
+    "Remove the keys that have not been enabled or written by a flush in "
+    "the max_idle seconds (0 to disable) before now (by default, the latest "
+    "time flushed), then the least recently active keys until at most "
+    "max_keys (0 for no limit) remain. Since the KP has to be rebuilt, "
+    "nothing is removed unless at least min_fraction of the keys are idle or "
+    "max_keys is exceeded, in which case keys are removed until at most "
+    "max_keys * (1 - min_fraction) remain. The indices of the remaining "
+    "keys are compacted. Returns the number of keys evicted, or, if remap "
+    "is True, a (count, mapping) tuple, where mapping is a memoryview giving "
+    "the new index of each old index (-1 if evicted)"
   },
 
   {
     "resolve",
     (PyCFunction)KeyPackage_resolve,
     METH_NOARGS,
-    "Force backends to resolve all keys in the key package"
+    "Force backends to resolve all keys in the key package "
+    "(releases the GIL)"
   },
 
   {
     "flush",
     (PyCFunction)KeyPackage_flush,
     METH_VARARGS,
-    "Flush the current values to all enabled backends"
+    "Flush the current values to all enabled backends "
+    "(releases the GIL while the backends write them). The values (and "
+    "enabled flags) are reset, as configured, before the GIL is released, "
+    "even if the flush then fails"
   },
 
   {NULL}  /* Sentinel */
@@ -242,14 +2154,80 @@ static PyMethodDef KeyPackage_methods[] = {
 static PyObject *
 KeyPackage_get_size(KeyPackageObject *self, void *closure)
 {
-  return Py_BuildValue("i", timeseries_kp_size(self->kp));
+  KP_CHECK_IDLE(self);
+  return Py_BuildValue("n", (Py_ssize_t)kp_size(self));
 }
 
 /* enabled size */
 static PyObject *
 KeyPackage_get_enabled_size(KeyPackageObject *self, void *closure)
 {
-  return Py_BuildValue("i", timeseries_kp_enabled_size(self->kp));
+  size_t i, size;
+  Py_ssize_t cnt = 0;
+
+  KP_CHECK_IDLE(self);
+  size = kp_size(self);
+  for (i = 0; i < size; i++) {
+    cnt += self->enabled[i] != 0;
+  }
+  return Py_BuildValue("n", cnt);
+}
+
+/* flushed size */
+static PyObject *
+KeyPackage_get_flushed_size(KeyPackageObject *self, void *closure)
+{
+  KP_CHECK_IDLE(self);
+  return Py_BuildValue("n", (Py_ssize_t)self->flushed_size);
+}
+
+/* delta */
+static PyObject *
+KeyPackage_get_delta(KeyPackageObject *self, void *closure)
+{
+  return PyBool_FromLong(self->delta);
+}
+
+/* full every */
+static PyObject *
+KeyPackage_get_full_every(KeyPackageObject *self, void *closure)
+{
+  return Py_BuildValue("I", self->full_every);
+}
+
+/* aggregation */
+static PyObject *
+KeyPackage_get_aggregation(KeyPackageObject *self, void *closure)
+{
+  return Py_BuildValue("s", kp_agg_names[self->agg]);
+}
+
+static int
+KeyPackage_set_aggregation_attr(KeyPackageObject *self, PyObject *value,
+                                void *closure)
+{
+  PyObject *bytes;
+  int rc;
+
+  if (value == NULL) {
+    PyErr_SetString(PyExc_TypeError, "Cannot delete the aggregation");
+    return -1;
+  }
+  if (PyBytes_Check(value)) {
+    Py_INCREF(value);
+    bytes = value;
+  } else if ((bytes = PyUnicode_AsASCIIString(value)) == NULL) {
+    return -1;
+  }
+  rc = KeyPackage_set_aggregation((PyObject *)self, PyBytes_AsString(bytes));
+  Py_DECREF(bytes);
+  return rc;
+}
+
+static PyObject *
+KeyPackage_get_key_store_bytes(KeyPackageObject *self, void *closure)
+{
+  return PyLong_FromSize_t(pyts_keystore_mem(self->keys));
 }
 
 static PyGetSetDef KeyPackage_getsetters[] = {
@@ -268,6 +2246,44 @@ static PyGetSetDef KeyPackage_getsetters[] = {
     NULL
   },
 
+  {
+    "flushed_size",
+    (getter)KeyPackage_get_flushed_size, NULL,
+    "Number of keys written by the last flush",
+    NULL
+  },
+
+  {
+    "delta",
+    (getter)KeyPackage_get_delta, NULL,
+    "Whether only changed values are written when flushing",
+    NULL
+  },
+
+  {
+    "aggregation",
+    (getter)KeyPackage_get_aggregation,
+    (setter)KeyPackage_set_aggregation_attr,
+    "How values written to a key within an interval are combined: 'set' "
+    "(the last value wins), 'add', 'max' or 'min'",
+    NULL
+  },
+
+  {
+    "full_every",
+    (getter)KeyPackage_get_full_every, NULL,
+    "In delta mode, number of flushes between full flushes (0 for never)",
+    NULL
+  },
+
+  {
+    "key_store_bytes",
+    (getter)KeyPackage_get_key_store_bytes, NULL,
+    "Number of bytes of memory used by the (prefix-compressed) copy of the "
+    "keys kept by the KeyPackage",
+    NULL
+  },
+
   {NULL} /* Sentinel */
 };
 
@@ -317,8 +2333,11 @@ PyTypeObject *_pytimeseries_kp_get_KeyPackageType()
   return &KeyPackageType;
 }
 
+/* source of KeyPackage uids (only used with the GIL held) */
+static unsigned long kp_next_uid = 0;
+
 /* only available to c code */
-PyObject *KeyPackage_new(PyObject *TS, timeseries_kp_t *kp)
+PyObject *KeyPackage_new(PyObject *TS, timeseries_kp_t *kp, int flags)
 {
   KeyPackageObject *self;
 
@@ -328,9 +2347,49 @@ PyObject *KeyPackage_new(PyObject *TS, timeseries_kp_t *kp)
   }
 
   self->kp = kp;
+  self->flags = flags;
+  self->uid = ++kp_next_uid;
 
   self->TS = TS;
   Py_INCREF(self->TS);
 
+  if ((self->keys = pyts_keystore_init()) == NULL ||
+      kp_reserve(self, 1) != 0) {
+    Py_DECREF(self);
+    return PyErr_NoMemory();
+  }
+
   return (PyObject *)self;
 }
+
+int KeyPackage_preload(PyObject *self, const char *path)
+{
+  int added = 0;
+
+  return kp_load_resolve_keys((KeyPackageObject *)self, path, &added);
+}
+
+int KeyPackage_set_delta(PyObject *self, unsigned int full_every)
+{
+  KeyPackageObject *kp = (KeyPackageObject *)self;
+
+  if (kp_alloc_delta(kp, 0, kp->alloc) != 0) {
+    PyErr_NoMemory();
+    return -1;
+  }
+  kp->delta = 1;
+  kp->full_every = full_every;
+  return 0;
+}
+
+int KeyPackage_set_aggregation(PyObject *self, const char *agg)
+{
+  KeyPackageObject *kp = (KeyPackageObject *)self;
+  int mode;
+
+  if ((mode = kp_parse_agg(kp, agg)) < 0) {
+    return -1;
+  }
+  kp->agg = mode;
+  return 0;
+}
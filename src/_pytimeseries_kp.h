@@ -31,14 +31,32 @@
 
 #include <timeseries.h>
 
+#include "_pytimeseries_keystore.h"
 #include "_pytimeseries_timeseries.h"
 
 #if PY_MAJOR_VERSION >= 3
  #define PT_BYTESTR "y"
+ #define PT_BUFFER "y*"
 #else
  #define PT_BYTESTR "s"
+ #define PT_BUFFER "s*"
 #endif
 
+/* How a value written to a key is combined with the value already written
+   to it in the current interval */
+enum {
+  KP_AGG_SET = 0,
+  KP_AGG_ADD,
+  KP_AGG_MAX,
+  KP_AGG_MIN,
+};
+
+/* TSKBATCH message format */
+#define TSKBATCH_MAGIC "TSKBATCH"
+#define TSKBATCH_MAGIC_LEN 8
+#define TSKBATCH_VERSION 0
+#define TSKBATCH_KEY_LEN_MAX 65535
+
 typedef struct {
   PyObject_HEAD
 
@@ -48,12 +66,90 @@ typedef struct {
   /* Parent Timeseries object (we have a reference to it) */
   PyObject *TS;
 
+  /* Set while a blocking call runs on this KP without the GIL */
+  int busy;
+
+  /* Scratch buffer for NUL-terminating keys decoded from messages */
+  char *keybuf;
+
+  /* Our copy of the keys in the KP */
+  pyts_keystore_t *keys;
+
+  /* Current value and enabled flag of each key. These are authoritative (so
+     that they can be exposed as buffers) and are copied into the
+     libtimeseries KP when it is flushed. */
+  uint64_t *values;
+  uint8_t *enabled;
+  size_t alloc;
+
+  /* Number of buffers currently exported by values_view/enabled_view */
+  Py_ssize_t exports;
+
+  /* TIMESERIES_KP_* flags the KP was created with */
+  int flags;
+
+  /* Delta mode: only keys whose value changed since they were last flushed
+     are written, with a full flush every full_every flushes (if non-zero).
+     last_values holds the last value written for each key and flushed is a
+     bitmap of the keys that have been written at least once. */
+  int delta;
+  unsigned int full_every;
+  uint64_t *last_values;
+  uint64_t *flushed;
+
+  /* Default aggregation (KP_AGG_*), and a bitmap of the keys that have been
+     written since the last flush (the first write in an interval always
+     sets the value) */
+  int agg;
+  uint64_t *written;
+
+  /* Number of flushes, number of keys written by the last one, and the
+     latest time flushed (0 if none) */
+  unsigned long flush_cnt;
+  size_t flushed_size;
+  uint32_t last_time;
+
+  /* Latest flush time at which each key was enabled or written (or, for
+     keys that have not been yet, the latest flush time as of when they were
+     added, 0 if none), used to evict idle keys. Since this is a time rather
+     than a flush count, it stays meaningful when intervals are spread
+     across several KPs. */
+  uint32_t *last_active;
+
+  /* Unique ID of this KP, and number of times keys have been evicted from
+     it (so that copies can tell whether their keys are still in sync) */
+  unsigned long uid;
+  unsigned long key_gen;
+
+  /* KP (uid and key_gen) that this KP was last copied from with copy_from,
+     if its keys matched */
+  unsigned long copy_uid;
+  unsigned long copy_gen;
+
 } KeyPackageObject;
 
 /** Expose the KeypackageType structure */
 PyTypeObject *_pytimeseries_kp_get_KeyPackageType(void);
 
 /** Expose our new function as it is not exposed to Python */
-PyObject *KeyPackage_new(PyObject *TS, timeseries_kp_t *kp);
+PyObject *KeyPackage_new(PyObject *TS, timeseries_kp_t *kp, int flags);
+
+/** Load the keys saved (by save_keys) in the given file into the given
+ * KeyPackage. Returns 0 if successful, -1 (with a Python exception set)
+ * otherwise.
+ */
+int KeyPackage_preload(PyObject *self, const char *path);
+
+/** Switch the given (empty) KeyPackage to delta mode, with a full flush
+ * every full_every flushes (0 for never). Returns 0 if successful, -1 (with
+ * a Python exception set) otherwise.
+ */
+int KeyPackage_set_delta(PyObject *self, unsigned int full_every);
+
+/** Set the default aggregation ("set", "add", "max" or "min") of the given
+ * KeyPackage. Returns 0 if successful, -1 (with a Python exception set)
+ * otherwise.
+ */
+int KeyPackage_set_aggregation(PyObject *self, const char *agg);
 
 #endif /* ___pytimeseries_kp_H */
@@ -0,0 +1,325 @@
+/*
+ * Copyright (C) 2016 The Regents of the University of California.
+ *
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions are met:
+ *
+ * 1. Redistributions of source code must retain the above copyright notice,
+ *    this list of conditions and the following disclaimer.
+ *
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions and the following disclaimer in the documentation
+ *    and/or other materials provided with the distribution.
+ *
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ * ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+ * LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+ * CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ * SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+ * INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+ * CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ * POSSIBILITY OF SUCH DAMAGE.
+ */
+
+#include <errno.h>
+#include <stdlib.h>
+#include <string.h>
+
+#include "_pytimeseries_lpf.h"
+
+/* longest numeric field value we parse */
+#define VALUE_LEN_MAX 63
+
+/* Find the first of the given characters in [p, end) that is not escaped
+   (with a backslash) and, if quoted is set, not within a double-quoted
+   string. Returns end if there is none. */
+static const char *
+find_unescaped(const char *p, const char *end, const char *chars, int quoted)
+{
+  int in_quotes = 0;
+
+  for (; p < end; p++) {
+    if (*p == '\\') {
+      p++;
+      continue;
+    }
+    if (quoted && *p == '"') {
+      in_quotes = !in_quotes;
+      continue;
+    }
+    if (!in_quotes && strchr(chars, *p) != NULL) {
+      return p;
+    }
+  }
+  return end;
+}
+
+/* Parse a field value. Returns 0 if it is a value that can be stored, -1
+   otherwise. */
+static int
+parse_value(const char *v, size_t len, uint64_t *value)
+{
+  char num[VALUE_LEN_MAX + 1];
+  char *endp;
+  double d;
+
+  if (len == 0 || len > VALUE_LEN_MAX || v[0] == '"' || v[0] == '-') {
+    /* empty, too long, a string or negative */
+    return -1;
+  }
+  switch (v[0]) {
+  case 't':
+  case 'T':
+    *value = 1;
+    return 0;
+  case 'f':
+  case 'F':
+    *value = 0;
+    return 0;
+  }
+
+  memcpy(num, v, len);
+  num[len] = '\0';
+  if (v[len - 1] == 'i' || v[len - 1] == 'u') {
+    /* (non-negative) integer */
+    num[len - 1] = '\0';
+    errno = 0;
+    *value = strtoull(num, &endp, 10);
+    return (endp == num || *endp != '\0' || errno != 0) ? -1 : 0;
+  }
+
+  d = strtod(num, &endp);
+  /* also rejects NaN */
+  if (endp == num || *endp != '\0' || !(d >= 0) ||
+      d >= 18446744073709551616.0) {
+    return -1;
+  }
+  *value = (uint64_t)d;
+  return 0;
+}
+
+/* Parse the timestamp of a point (if any) into the start of its interval.
+   Returns 0 if successful, -1 otherwise. */
+static int
+parse_time(const char *p, const char *end, uint32_t interval, uint32_t now,
+           uint32_t *time)
+{
+  uint64_t ns = 0;
+  uint64_t sec;
+
+  while (p < end && *p == ' ') {
+    p++;
+  }
+  if (p == end) {
+    sec = now;
+  } else {
+    for (; p < end; p++) {
+      if (*p < '0' || *p > '9' || ns > (UINT64_MAX - 9) / 10) {
+        return -1;
+      }
+      ns = ns * 10 + (*p - '0');
+    }
+    sec = ns / 1000000000;
+    if (sec > UINT32_MAX) {
+      return -1;
+    }
+  }
+  *time = sec - (sec % interval);
+  return 0;
+}
+
+int
+pyts_lpf_next_pair(const char **pos, const char *end,
+                   const char **key, size_t *key_len,
+                   const char **val, size_t *val_len)
+{
+  const char *item_end, *eq;
+
+  if (*pos >= end) {
+    return 0;
+  }
+  /* field values may be quoted strings containing commas */
+  item_end = find_unescaped(*pos, end, ",", 1);
+  eq = find_unescaped(*pos, item_end, "=", 0);
+  if (eq == *pos || eq == item_end) {
+    return -1;
+  }
+  *key = *pos;
+  *key_len = eq - *pos;
+  *val = eq + 1;
+  *val_len = item_end - (eq + 1);
+  *pos = item_end + 1;
+  return 1;
+}
+
+/* Parse a single line (without its newline). Returns 0 if it was parsed (or
+   is blank or a comment), -1 if it is malformed, or the non-zero value
+   returned by the callback. */
+static int
+parse_line(const char *p, const char *end, uint32_t interval, uint32_t now,
+           pyts_lpf_cb_t *cb, void *ctx, size_t *invalid)
+{
+  pyts_lpf_point_t point;
+  const char *series_end, *meas_end, *fields, *fields_end;
+  const char *pos, *k, *v;
+  size_t klen, vlen;
+  uint64_t value;
+  int rc;
+
+  if (end > p && end[-1] == '\r') {
+    end--;
+  }
+  if (p == end || *p == '#') {
+    return 0;
+  }
+
+  /* measurement and tags, up to the first unescaped space */
+  series_end = find_unescaped(p, end, " ", 0);
+  meas_end = find_unescaped(p, series_end, ",", 0);
+  if (series_end == end || meas_end == p) {
+    return -1;
+  }
+  point.meas = p;
+  point.meas_len = meas_end - p;
+  point.tags = meas_end < series_end ? meas_end + 1 : series_end;
+  point.tags_len = series_end - point.tags;
+
+  /* check the tags now, so that callbacks do not have to */
+  pos = point.tags;
+  while ((rc = pyts_lpf_next_pair(&pos, series_end, &k, &klen,
+                                  &v, &vlen)) == 1) {
+    if (vlen == 0) {
+      return -1;
+    }
+  }
+  if (rc < 0) {
+    return -1;
+  }
+
+  /* fields, up to the next space (outside of strings) */
+  fields = series_end + 1;
+  fields_end = find_unescaped(fields, end, " ", 1);
+  if (fields == fields_end ||
+      parse_time(fields_end, end, interval, now, &point.time) != 0) {
+    return -1;
+  }
+
+  pos = fields;
+  while ((rc = pyts_lpf_next_pair(&pos, fields_end, &k, &klen,
+                                  &v, &vlen)) == 1) {
+    if (parse_value(v, vlen, &value) != 0) {
+      (*invalid)++;
+      continue;
+    }
+    if ((rc = cb(ctx, &point, k, klen, value)) != 0) {
+      return rc;
+    }
+  }
+  return rc < 0 ? -1 : 0;
+}
+
+int
+pyts_lpf_parse(const char *buf, size_t len, uint32_t interval,
+               uint32_t now, pyts_lpf_cb_t *cb, void *ctx, size_t *invalid)
+{
+  const char *end = buf + len;
+  const char *eol;
+  int rc;
+
+  *invalid = 0;
+  while (buf < end) {
+    if ((eol = memchr(buf, '\n', end - buf)) == NULL) {
+      eol = end;
+    }
+    if ((rc = parse_line(buf, eol, interval, now, cb, ctx, invalid)) < 0) {
+      (*invalid)++;
+    } else if (rc > 0) {
+      return rc;
+    }
+    buf = eol + 1;
+  }
+  return 0;
+}
+
+ssize_t
+pyts_lpf_append_node(char *key, size_t len, size_t max_len,
+                     const char *comp, size_t comp_len)
+{
+  const char *end = comp + comp_len;
+  char c;
+
+  for (; comp < end; comp++) {
+    c = *comp;
+    if (c == '\\' && comp + 1 < end) {
+      c = *(++comp);
+    }
+    if (c == '\0' || len == max_len) {
+      return -1;
+    }
+    /* as pytimeseries.utils.graphite_safe_node */
+    switch (c) {
+    case '.':
+      c = '-';
+      break;
+    case '/':
+      c = '_';
+      break;
+    }
+    key[len++] = c;
+  }
+  return len;
+}
+
+ssize_t
+pyts_lpf_build_key(char *key, size_t max_len,
+                   const char *prefix, size_t prefix_len,
+                   const pyts_lpf_point_t *point,
+                   const char *field, size_t field_len)
+{
+  const char *pos = point->tags;
+  const char *tags_end = point->tags + point->tags_len;
+  const char *k, *v;
+  size_t klen, vlen;
+  ssize_t len = 0;
+
+  if (prefix_len > 0) {
+    if (prefix_len + 1 > max_len) {
+      return -1;
+    }
+    memcpy(key, prefix, prefix_len);
+    key[prefix_len] = '.';
+    len = prefix_len + 1;
+  }
+  if ((len = pyts_lpf_append_node(key, len, max_len,
+                                  point->meas, point->meas_len)) < 0) {
+    return -1;
+  }
+  /* the tags have already been checked by the parser */
+  while (pyts_lpf_next_pair(&pos, tags_end, &k, &klen, &v, &vlen) == 1) {
+    if ((size_t)len + 2 > max_len) {
+      return -1;
+    }
+    key[len++] = '.';
+    if ((len = pyts_lpf_append_node(key, len, max_len, k, klen)) < 0 ||
+        (size_t)len + 2 > max_len) {
+      return -1;
+    }
+    key[len++] = '.';
+    if ((len = pyts_lpf_append_node(key, len, max_len, v, vlen)) < 0) {
+      return -1;
+    }
+  }
+  if ((size_t)len + 2 > max_len) {
+    return -1;
+  }
+  key[len++] = '.';
+  if ((len = pyts_lpf_append_node(key, len, max_len,
+                                  field, field_len)) < 0) {
+    return -1;
+  }
+  key[len] = '\0';
+  return len;
+}
@@ -0,0 +1,142 @@
+/*
+ * Copyright (C) 2016 The Regents of the University of California.
+ *
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions are met:
+ *
+ * 1. Redistributions of source code must retain the above copyright notice,
+ *    this list of conditions and the following disclaimer.
+ *
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions and the following disclaimer in the documentation
+ *    and/or other materials provided with the distribution.
+ *
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ * ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+ * LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+ * CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ * SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+ * INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+ * CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ * POSSIBILITY OF SUCH DAMAGE.
+ */
+
+#ifndef ___pytimeseries_lpf_H
+#define ___pytimeseries_lpf_H
+
+#include <stddef.h>
+#include <stdint.h>
+#include <sys/types.h>
+
+/** Parser for InfluxDB line protocol (LPF) payloads.
+ *
+ * A payload holds newline-separated points of the form
+ * "measurement[,tag=value...] field=value[,field=value...] [timestamp]",
+ * with nanosecond timestamps. Points are bucketed into intervals, and each
+ * field with a value that can be stored in a Key Package (a non-negative
+ * integer or float, or a boolean) is passed to a callback. The parser does
+ * not need the GIL.
+ */
+
+/** A parsed point. Components point into the payload and are still
+ * escaped. */
+typedef struct {
+  /* measurement */
+  const char *meas;
+  size_t meas_len;
+
+  /* tag set (without the leading comma), may be empty */
+  const char *tags;
+  size_t tags_len;
+
+  /* start of the interval the point falls in */
+  uint32_t time;
+} pyts_lpf_point_t;
+
+/** Callback for each field of each point
+ *
+ * @param ctx           user context
+ * @param point         point that the field belongs to
+ * @param field         (escaped) field key
+ * @param field_len     length of the field key
+ * @param value         value of the field
+ * @return 0 to continue, or a positive value to stop parsing (and have
+ * pyts_lpf_parse return this value)
+ */
+typedef int (pyts_lpf_cb_t)(void *ctx, const pyts_lpf_point_t *point,
+                            const char *field, size_t field_len,
+                            uint64_t value);
+
+/** Parse the given payload
+ *
+ * @param buf           payload
+ * @param len           length of the payload
+ * @param interval      interval length (in seconds) to bucket points into
+ * @param now           time used for points without a timestamp
+ * @param cb            callback to call for each field value
+ * @param ctx           context passed to the callback
+ * @param invalid[out]  set to the number of malformed lines plus the number
+ *                      of field values that cannot be stored (e.g. strings)
+ * @return 0 if the whole payload was parsed, otherwise the positive value
+ * returned by the callback
+ */
+int pyts_lpf_parse(const char *buf, size_t len, uint32_t interval,
+                   uint32_t now, pyts_lpf_cb_t *cb, void *ctx,
+                   size_t *invalid);
+
+/** Get the next key=value pair of the given (tag or field) set
+ *
+ * @param pos[in,out]   position in the set (updated to the next pair)
+ * @param end           end of the set
+ * @param key[out]      set to the key of the pair
+ * @param key_len[out]  set to the length of the key
+ * @param val[out]      set to the value of the pair
+ * @param val_len[out]  set to the length of the value
+ * @return 1 if a pair was found, 0 at the end of the set, -1 if the set is
+ * malformed
+ */
+int pyts_lpf_next_pair(const char **pos, const char *end,
+                       const char **key, size_t *key_len,
+                       const char **val, size_t *val_len);
+
+/** Append an (escaped) component to a graphite key
+ *
+ * The component is unescaped and made graphite-safe, as by
+ * pytimeseries.utils.graphite_safe_node (periods are replaced by hyphens,
+ * slashes by underscores).
+ *
+ * @param key           key buffer
+ * @param len           current length of the key
+ * @param max_len       maximum length of the key
+ * @param comp          component to append
+ * @param comp_len      length of the component
+ * @return new length of the key, or -1 if it would be longer than max_len or
+ * the component contains a NUL byte
+ */
+ssize_t pyts_lpf_append_node(char *key, size_t len, size_t max_len,
+                             const char *comp, size_t comp_len);
+
+/** Build the graphite key of a field of a point
+ *
+ * The key is [prefix.]measurement[.tag.value...].field, with each component
+ * (other than the prefix) appended with pyts_lpf_append_node.
+ *
+ * @param key           key buffer (of at least max_len + 1 bytes)
+ * @param max_len       maximum length of the key
+ * @param prefix        prefix of the key, used as-is
+ * @param prefix_len    length of the prefix (0 for none)
+ * @param point         point that the field belongs to
+ * @param field         (escaped) field key
+ * @param field_len     length of the field key
+ * @return length of the (NUL-terminated) key, or -1 if it would be longer
+ * than max_len or a component contains a NUL byte
+ */
+ssize_t pyts_lpf_build_key(char *key, size_t max_len,
+                           const char *prefix, size_t prefix_len,
+                           const pyts_lpf_point_t *point,
+                           const char *field, size_t field_len);
+
+#endif /* ___pytimeseries_lpf_H */
@@ -29,9 +29,212 @@
 #include "_pytimeseries_timeseries.h"
 #include "_pytimeseries_backend.h"
 #include "_pytimeseries_kp.h"
+#include "_pytimeseries_lpf.h"
+
+#include <time.h>
+
+/* Context of lpf_times: the distinct interval times seen so far */
+struct lpf_times_ctx {
+  uint32_t *times;
+  size_t cnt;
+  size_t alloc;
+};
+
+static int
+lpf_times_cb(void *vctx, const pyts_lpf_point_t *point,
+             const char *field, size_t field_len, uint64_t value)
+{
+  struct lpf_times_ctx *ctx = vctx;
+  uint32_t *times;
+  size_t i;
+
+  /* payloads usually span very few intervals */
+  for (i = 0; i < ctx->cnt; i++) {
+    if (ctx->times[i] == point->time) {
+      return 0;
+    }
+  }
+  if (ctx->cnt == ctx->alloc) {
+    ctx->alloc = ctx->alloc == 0 ? 4 : ctx->alloc * 2;
+    if ((times = realloc(ctx->times,
+                         ctx->alloc * sizeof(uint32_t))) == NULL) {
+      return 1;
+    }
+    ctx->times = times;
+  }
+  ctx->times[ctx->cnt++] = point->time;
+  return 0;
+}
+
+static PyObject *
+lpf_times(PyObject *self, PyObject *args, PyObject *kwds)
+{
+  static char *kwlist[] = {
+    "buf", //
+    "interval", //
+    "now", //
+    NULL //
+  };
+  struct lpf_times_ctx ctx = {NULL, 0, 0};
+  Py_buffer buf;
+  unsigned int interval;
+  unsigned int now = 0;
+  size_t invalid = 0;
+  PyObject *times = NULL;
+  PyObject *time_obj;
+  size_t i;
+  int rc;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, PT_BUFFER "I|I", kwlist,
+                                   &buf, &interval, &now)) {
+    return NULL;
+  }
+  if (interval == 0) {
+    PyBuffer_Release(&buf);
+    PyErr_SetString(PyExc_ValueError, "interval must be positive");
+    return NULL;
+  }
+
+  Py_BEGIN_ALLOW_THREADS
+  rc = pyts_lpf_parse(buf.buf, buf.len, interval,
+                      now != 0 ? now : time(NULL), lpf_times_cb, &ctx,
+                      &invalid);
+  Py_END_ALLOW_THREADS
+  PyBuffer_Release(&buf);
+
+  if (rc != 0) {
+    PyErr_NoMemory();
+    goto done;
+  }
+  if ((times = PyList_New(ctx.cnt)) == NULL) {
+    goto done;
+  }
+  for (i = 0; i < ctx.cnt; i++) {
+    if ((time_obj = Py_BuildValue("I", ctx.times[i])) == NULL) {
+      Py_CLEAR(times);
+      goto done;
+    }
+    PyList_SET_ITEM(times, i, time_obj);
+  }
+
+ done:
+  free(ctx.times);
+  if (times == NULL) {
+    return NULL;
+  }
+  return Py_BuildValue("Nn", times, (Py_ssize_t)invalid);
+}
+
+/* Context of lpf_decode: the (time, key, value) tuples decoded so far */
+struct lpf_decode_ctx {
+  PyObject *kvs;
+  const char *prefix;
+  size_t prefix_len;
+  char *key;
+};
+
+static int
+lpf_decode_cb(void *vctx, const pyts_lpf_point_t *point,
+              const char *field, size_t field_len, uint64_t value)
+{
+  struct lpf_decode_ctx *ctx = vctx;
+  PyObject *kv;
+  ssize_t len;
+
+  if ((len = pyts_lpf_build_key(ctx->key, TSKBATCH_KEY_LEN_MAX,
+                                ctx->prefix, ctx->prefix_len, point,
+                                field, field_len)) < 0) {
+    /* key too long (as for KeyPackage.apply_lpf) */
+    return 0;
+  }
+  if ((kv = Py_BuildValue("INK", point->time,
+                          PyBytes_FromStringAndSize(ctx->key, len),
+                          (unsigned long long)value)) == NULL) {
+    return 1;
+  }
+  if (PyList_Append(ctx->kvs, kv) != 0) {
+    Py_DECREF(kv);
+    return 1;
+  }
+  Py_DECREF(kv);
+  return 0;
+}
+
+static PyObject *
+lpf_decode(PyObject *self, PyObject *args, PyObject *kwds)
+{
+  static char *kwlist[] = {
+    "buf", //
+    "interval", //
+    "prefix", //
+    "now", //
+    NULL //
+  };
+  struct lpf_decode_ctx ctx = {NULL, "", 0, NULL};
+  Py_buffer buf;
+  unsigned int interval;
+  unsigned int now = 0;
+  size_t invalid = 0;
+  int rc;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, PT_BUFFER "I|" PT_BYTESTR "I",
+                                   kwlist, &buf, &interval, &ctx.prefix,
+                                   &now)) {
+    return NULL;
+  }
+  ctx.prefix_len = strlen(ctx.prefix);
+  if (interval == 0) {
+    PyErr_SetString(PyExc_ValueError, "interval must be positive");
+  } else if (ctx.prefix_len >= TSKBATCH_KEY_LEN_MAX) {
+    PyErr_SetString(PyExc_ValueError, "prefix is too long");
+  } else if ((ctx.key = malloc(TSKBATCH_KEY_LEN_MAX + 1)) == NULL) {
+    PyErr_NoMemory();
+  } else {
+    ctx.kvs = PyList_New(0);
+  }
+  if (ctx.kvs == NULL) {
+    free(ctx.key);
+    PyBuffer_Release(&buf);
+    return NULL;
+  }
+
+  /* the callback creates Python objects, so this keeps the GIL */
+  rc = pyts_lpf_parse(buf.buf, buf.len, interval,
+                      now != 0 ? now : time(NULL), lpf_decode_cb, &ctx,
+                      &invalid);
+  free(ctx.key);
+  PyBuffer_Release(&buf);
+
+  if (rc != 0) {
+    Py_DECREF(ctx.kvs);
+    return NULL;
+  }
+  return Py_BuildValue("Nn", ctx.kvs, (Py_ssize_t)invalid);
+}
 
 static PyMethodDef module_methods[] = {
-    {NULL}  /* Sentinel */
+  {
+    "lpf_times",
+    (PyCFunction)lpf_times,
+    METH_VARARGS | METH_KEYWORDS,
+    "Get the start times of the intervals (of the given length, in seconds) "
+    "that the points of an InfluxDB line protocol payload fall in (see "
+    "KeyPackage.apply_lpf, including for now), in order of appearance, and "
+    "the number of malformed lines and field values that cannot be stored. "
+    "Returns a (times, invalid count) tuple"
+  },
+
+  {
+    "lpf_decode",
+    (PyCFunction)lpf_decode,
+    METH_VARARGS | METH_KEYWORDS,
+    "Decode an InfluxDB line protocol payload into the (time, key, value) "
+    "tuples that KeyPackage.apply_lpf would write (see there for interval, "
+    "prefix and now), in order of appearance. Returns a (tuples, invalid "
+    "count) tuple"
+  },
+
+  {NULL}  /* Sentinel */
 };
 
 #define ADD_OBJECT(modname, objname)                                             \
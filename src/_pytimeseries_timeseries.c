@@ -30,15 +30,15 @@
 
 #include "_pytimeseries_backend.h"
 #include "_pytimeseries_kp.h"
+#include "_pytimeseries_timeseries.h"
+#include "_pytimeseries_utils.h"
 
-typedef struct {
-  PyObject_HEAD
-
-  /* BGP Stream Instance Handle */
-  timeseries_t *ts;
-} TimeseriesObject;
-
-#define TimeseriesDocstring "Timeseries object"
+#define TimeseriesDocstring                                             \
+  "Timeseries object\n\n"                                               \
+  "Backend I/O (enable_backend, set_single, set_many and KeyPackage "   \
+  "flush and resolve) is done without holding the GIL, but is "          \
+  "serialized per Timeseries object. Use separate Timeseries objects "   \
+  "to write to backends from several threads in parallel."
 
 #define TimeseriesTypeName "_pytimeseries.Timeseries"
 
@@ -46,9 +46,16 @@ typedef struct {
 static void
 Timeseries_dealloc(TimeseriesObject *self)
 {
+  if (self->set_kp != NULL) {
+    timeseries_kp_free(&self->set_kp);
+  }
   if (self->ts != NULL) {
       timeseries_free(&self->ts);
   }
+  if (self->lock != NULL) {
+    PyThread_free_lock(self->lock);
+    self->lock = NULL;
+  }
   Py_TYPE(self)->tp_free((PyObject*)self);
 }
 
@@ -67,6 +74,11 @@ Timeseries_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
     return NULL;
   }
 
+  if ((self->lock = PyThread_allocate_lock()) == NULL) {
+    Py_DECREF(self);
+    return PyErr_NoMemory();
+  }
+
   return (PyObject *)self;
 }
 
@@ -83,6 +95,7 @@ Timeseries_enable_backend(TimeseriesObject *self, PyObject *args)
 {
   BackendObject *pybe = NULL;
   const char *optstr = NULL;
+  int rc;
 
   /* get the Backend argument */
   if (!PyArg_ParseTuple(args, "O!|s",
@@ -96,7 +109,8 @@ Timeseries_enable_backend(TimeseriesObject *self, PyObject *args)
     return NULL;
   }
 
-  if (timeseries_enable_backend(pybe->be, optstr) == 0) {
+  TS_BLOCKING_CALL(self, rc = timeseries_enable_backend(pybe->be, optstr));
+  if (rc == 0) {
     Py_RETURN_TRUE;
   }
 
@@ -177,12 +191,15 @@ Timeseries_set_single(TimeseriesObject *self, PyObject *args)
   const char *key;
   unsigned long long value;
   unsigned long time;
+  int rc;
 
   if (!PyArg_ParseTuple(args, PT_BYTESTR "Kk", &key, &value, &time)) {
     return NULL;
   }
 
-  if (timeseries_set_single(self->ts, key, value, time) != 0) {
+  TS_BLOCKING_CALL(self, rc = timeseries_set_single(self->ts, key, value,
+                                                    time));
+  if (rc != 0) {
     PyErr_SetString(PyExc_RuntimeError, "Failed to set single key");
     return NULL;
   }
@@ -190,6 +207,194 @@ Timeseries_set_single(TimeseriesObject *self, PyObject *args)
   Py_RETURN_NONE;
 }
 
+/* A point given to set_many */
+struct set_point {
+  uint32_t time;
+  /* position in the call, so that the last value for a key and time wins */
+  Py_ssize_t pos;
+  const char *key;
+  uint64_t value;
+};
+
+static int
+set_point_cmp(const void *a, const void *b)
+{
+  const struct set_point *pa = a;
+  const struct set_point *pb = b;
+
+  if (pa->time != pb->time) {
+    return pa->time < pb->time ? -1 : 1;
+  }
+  return pa->pos < pb->pos ? -1 : (pa->pos > pb->pos);
+}
+
+/* Disable (and reset) the keys of the given points in the set_many KP, so
+   that none of them is written by a later flush */
+static void
+ts_clear_points(TimeseriesObject *self, struct set_point *points,
+                Py_ssize_t first, Py_ssize_t end)
+{
+  Py_ssize_t i;
+  int idx;
+
+  for (i = first; i < end; i++) {
+    if ((idx = timeseries_kp_get_key(self->set_kp, points[i].key)) >= 0) {
+      timeseries_kp_set(self->set_kp, idx, 0);
+      timeseries_kp_disable_key(self->set_kp, idx);
+    }
+  }
+}
+
+/* Write the given points (sorted by time) with one flush of the set_many KP
+   per time. Returns 0 if successful, -1 if a key could not be added, -2 if
+   a flush failed (in which case the points of that time are not left in the
+   KP). Must be called with the lock held. */
+static int
+ts_set_points(TimeseriesObject *self, struct set_point *points, Py_ssize_t cnt)
+{
+  Py_ssize_t i;
+  /* first point of the current time */
+  Py_ssize_t first = 0;
+  int idx;
+
+  if (self->set_kp == NULL &&
+      (self->set_kp = timeseries_kp_init(self->ts, TIMESERIES_KP_RESET |
+                                         TIMESERIES_KP_DISABLE)) == NULL) {
+    return -1;
+  }
+
+  for (i = 0; i < cnt; i++) {
+    if ((idx = timeseries_kp_get_key(self->set_kp, points[i].key)) < 0 &&
+        (idx = timeseries_kp_add_key(self->set_kp, points[i].key)) < 0) {
+      ts_clear_points(self, points, first, i);
+      return -1;
+    }
+    timeseries_kp_enable_key(self->set_kp, idx);
+    timeseries_kp_set(self->set_kp, idx, points[i].value);
+    if (i + 1 == cnt || points[i + 1].time != points[i].time) {
+      if (timeseries_kp_flush(self->set_kp, points[i].time) != 0) {
+        ts_clear_points(self, points, first, i + 1);
+        return -2;
+      }
+      first = i + 1;
+    }
+  }
+
+  return 0;
+}
+
+static PyObject *
+Timeseries_set_many(TimeseriesObject *self, PyObject *args, PyObject *kwds)
+{
+  static char *kwlist[] = {
+    "keys", //
+    "values", //
+    "times", //
+    NULL //
+  };
+  PyObject *keys_obj;
+  PyObject *vals_obj;
+  PyObject *times_obj;
+  PyObject *keys = NULL;
+  pyts_u64_array_t vals;
+  pyts_u64_array_t times;
+  int have_times = 0;
+  unsigned long time = 0;
+  struct set_point *points = NULL;
+  Py_ssize_t i, cnt;
+  uint64_t val;
+  int rc;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "OOO", kwlist,
+                                   &keys_obj, &vals_obj, &times_obj)) {
+    return NULL;
+  }
+
+  /* times is either a single time for all points, or one time per point */
+  if (PyIndex_Check(times_obj)) {
+    if ((time = PyLong_AsUnsignedLong(times_obj)) == (unsigned long)-1 &&
+        PyErr_Occurred()) {
+      return NULL;
+    }
+    if (time > UINT32_MAX) {
+      PyErr_SetString(PyExc_OverflowError, "time out of range");
+      return NULL;
+    }
+  } else if (pyts_u64_array_init(&times, times_obj,
+                                 "times must be an int or a sequence") != 0) {
+    return NULL;
+  } else {
+    have_times = 1;
+  }
+
+  if ((keys = PySequence_Fast(keys_obj, "keys must be a sequence")) == NULL) {
+    goto err_times;
+  }
+  if (pyts_u64_array_init(&vals, vals_obj, "values must be a sequence") != 0) {
+    goto err_keys;
+  }
+
+  cnt = PySequence_Fast_GET_SIZE(keys);
+  if (cnt != vals.len || (have_times && cnt != times.len)) {
+    PyErr_SetString(PyExc_ValueError,
+                    "keys, values and times must have the same length");
+    goto err;
+  }
+
+  if ((points = PyMem_Malloc((cnt + 1) * sizeof(struct set_point))) == NULL) {
+    PyErr_NoMemory();
+    goto err;
+  }
+  /* the keys stay valid while we hold a reference to the sequence */
+  for (i = 0; i < cnt; i++) {
+    if ((points[i].key = pyts_get_bytestr(PySequence_Fast_GET_ITEM(keys, i),
+                                          NULL)) == NULL ||
+        pyts_u64_array_get(&vals, i, &points[i].value) != 0) {
+      goto err;
+    }
+    if (have_times) {
+      if (pyts_u64_array_get(&times, i, &val) != 0) {
+        goto err;
+      }
+      if (val > UINT32_MAX) {
+        PyErr_SetString(PyExc_OverflowError, "time out of range");
+        goto err;
+      }
+      points[i].time = val;
+    } else {
+      points[i].time = time;
+    }
+    points[i].pos = i;
+  }
+  qsort(points, cnt, sizeof(struct set_point), set_point_cmp);
+
+  TS_BLOCKING_CALL(self, rc = ts_set_points(self, points, cnt));
+  if (rc != 0) {
+    PyErr_SetString(PyExc_RuntimeError, rc == -1 ?
+                    "Failed to add key" : "Failed to set values");
+    goto err;
+  }
+
+  PyMem_Free(points);
+  pyts_u64_array_free(&vals);
+  Py_DECREF(keys);
+  if (have_times) {
+    pyts_u64_array_free(&times);
+  }
+  Py_RETURN_NONE;
+
+ err:
+  PyMem_Free(points);
+  pyts_u64_array_free(&vals);
+ err_keys:
+  Py_DECREF(keys);
+ err_times:
+  if (have_times) {
+    pyts_u64_array_free(&times);
+  }
+  return NULL;
+}
+
 /* Create a new key package */
 static PyObject *
 Timeseries_new_keypackage(TimeseriesObject *self,
@@ -198,14 +403,24 @@ Timeseries_new_keypackage(TimeseriesObject *self,
   static char *kwlist[] = {
     "reset", //
     "disable", //
+    "preload", //
+    "delta", //
+    "full_every", //
+    "aggregation", //
     NULL //
   };
   int reset = 0;
   int disable = 0;
+  const char *preload = NULL;
+  int delta = 0;
+  unsigned int full_every = 0;
+  const char *aggregation = NULL;
   timeseries_kp_t *kp;
+  PyObject *pykp;
 
-  if (!PyArg_ParseTupleAndKeywords(args, keywds, "|ii", kwlist,
-                                   &reset, &disable)) {
+  if (!PyArg_ParseTupleAndKeywords(args, keywds, "|iiziIz", kwlist,
+                                   &reset, &disable, &preload,
+                                   &delta, &full_every, &aggregation)) {
     return NULL;
   }
 
@@ -221,7 +436,23 @@ Timeseries_new_keypackage(TimeseriesObject *self,
     return NULL;
   }
 
-  return KeyPackage_new((PyObject*)self, kp);
+  if ((pykp = KeyPackage_new((PyObject*)self, kp, flags)) == NULL) {
+    return NULL;
+  }
+
+  if ((delta && KeyPackage_set_delta(pykp, full_every) != 0) ||
+      (aggregation != NULL &&
+       KeyPackage_set_aggregation(pykp, aggregation) != 0)) {
+    Py_DECREF(pykp);
+    return NULL;
+  }
+
+  if (preload != NULL && KeyPackage_preload(pykp, preload) != 0) {
+    Py_DECREF(pykp);
+    return NULL;
+  }
+
+  return pykp;
 }
 
 static PyMethodDef Timeseries_methods[] = {
@@ -261,11 +492,27 @@ static PyMethodDef Timeseries_methods[] = {
     "Set a value for a single timeseries key"
   },
 
+  {
+    "set_many",
+    (PyCFunction)Timeseries_set_many,
+    METH_VARARGS | METH_KEYWORDS,
+    "Set the values of the given keys (bytes) at the given times (a single "
+    "time, or one per key). Values are grouped by time and written with one "
+    "flush per time, and keys are only resolved the first time they are set. "
+    "If a flush fails, RuntimeError is raised: the times before it have been "
+    "written, and the values of that time and the later ones are discarded"
+  },
+
   {
     "new_keypackage",
     (PyCFunction)Timeseries_new_keypackage,
     METH_VARARGS | METH_KEYWORDS,
-    "Create a new Key Package"
+    "Create a new Key Package, optionally preloading the keys from a "
+    "snapshot file written by KeyPackage.save_keys. With delta=True, a flush "
+    "only writes the values that changed since they were last written by "
+    "this KP (with a full flush every full_every flushes, if non-zero), so "
+    "every interval must be flushed through the same KP. aggregation sets "
+    "the KP's aggregation ('set', 'add', 'max' or 'min')"
   },
 
 
@@ -29,6 +29,37 @@
 #ifndef ___pytimeseries_timeseries_H
 #define ___pytimeseries_timeseries_H
 
+#include <pythread.h>
+
+#include <timeseries.h>
+
+typedef struct {
+  PyObject_HEAD
+
+  /* Timeseries Instance Handle */
+  timeseries_t *ts;
+
+  /* Serializes backend I/O (which happens without the GIL) */
+  PyThread_type_lock lock;
+
+  /* KP used (with the lock held) by set_many, which keeps the keys it has
+     seen (and resolved) across calls */
+  timeseries_kp_t *set_kp;
+} TimeseriesObject;
+
+/** Run the given (blocking) libtimeseries call with the GIL released, while
+ * holding the lock of the given Timeseries object. This ensures that the
+ * backends of a Timeseries are never used by two threads at once.
+ */
+#define TS_BLOCKING_CALL(tsobj, call)                   \
+  do {                                                  \
+    Py_BEGIN_ALLOW_THREADS                              \
+    PyThread_acquire_lock((tsobj)->lock, WAIT_LOCK);    \
+    call;                                               \
+    PyThread_release_lock((tsobj)->lock);               \
+    Py_END_ALLOW_THREADS                                \
+  } while (0)
+
 /** Expose the TimeseriesType structure */
 PyTypeObject *_pytimeseries_timeseries_get_TimeseriesType(void);
 
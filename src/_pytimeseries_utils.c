@@ -0,0 +1,184 @@
+/*
+ * Copyright (C) 2016 The Regents of the University of California.
+ *
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions are met:
+ *
+ * 1. Redistributions of source code must retain the above copyright notice,
+ *    this list of conditions and the following disclaimer.
+ *
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions and the following disclaimer in the documentation
+ *    and/or other materials provided with the distribution.
+ *
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ * ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+ * LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+ * CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ * SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+ * INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+ * CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ * POSSIBILITY OF SUCH DAMAGE.
+ */
+#include <Python.h>
+#include "pyutils.h"
+
+#include <string.h>
+
+#include "_pytimeseries_utils.h"
+
+/* size of the native integer type for the given struct format character, or
+   0 if the format is not a supported integer type */
+static Py_ssize_t
+native_int_size(char fmt)
+{
+  switch (fmt) {
+  case 'b':
+  case 'B':
+    return sizeof(char);
+  case 'h':
+  case 'H':
+    return sizeof(short);
+  case 'i':
+  case 'I':
+    return sizeof(int);
+  case 'l':
+  case 'L':
+    return sizeof(long);
+  case 'q':
+  case 'Q':
+    return sizeof(long long);
+  default:
+    return 0;
+  }
+}
+
+int
+pyts_u64_array_init(pyts_u64_array_t *arr, PyObject *obj, const char *name)
+{
+  const char *fmt;
+
+  memset(arr, 0, sizeof(pyts_u64_array_t));
+
+  /* try and use the buffer directly */
+  if (PyObject_CheckBuffer(obj) &&
+      PyObject_GetBuffer(obj, &arr->view, PyBUF_FORMAT | PyBUF_C_CONTIGUOUS)
+      == 0) {
+    fmt = arr->view.format != NULL ? arr->view.format : "B";
+    if (*fmt == '@') {
+      fmt++;
+    }
+    if (fmt[0] != '\0' && fmt[1] == '\0' && arr->view.ndim <= 1 &&
+        native_int_size(fmt[0]) == arr->view.itemsize) {
+      arr->have_view = 1;
+      arr->fmt = fmt[0];
+      arr->len = arr->view.len / arr->view.itemsize;
+      return 0;
+    }
+    /* not a format we can read in place, fall back to the sequence API */
+    PyBuffer_Release(&arr->view);
+  }
+  PyErr_Clear();
+
+  if ((arr->seq = PySequence_Fast(obj, name)) == NULL) {
+    return -1;
+  }
+  arr->len = PySequence_Fast_GET_SIZE(arr->seq);
+
+  return 0;
+}
+
+#define GET_BUF_VAL(type)                                               \
+  do {                                                                  \
+    type v;                                                             \
+    memcpy(&v, (char *)arr->view.buf + (i * sizeof(type)), sizeof(type)); \
+    if (v < 0) {                                                        \
+      goto negative;                                                    \
+    }                                                                   \
+    *val = (uint64_t)v;                                                 \
+  } while (0)
+
+#define GET_BUF_UVAL(type)                                              \
+  do {                                                                  \
+    type v;                                                             \
+    memcpy(&v, (char *)arr->view.buf + (i * sizeof(type)), sizeof(type)); \
+    *val = (uint64_t)v;                                                 \
+  } while (0)
+
+int
+pyts_u64_array_get(pyts_u64_array_t *arr, Py_ssize_t i, uint64_t *val)
+{
+  PyObject *item;
+  PyObject *num;
+  unsigned long long v;
+
+  if (arr->have_view) {
+    switch (arr->fmt) {
+    case 'b': GET_BUF_VAL(signed char); break;
+    case 'B': GET_BUF_UVAL(unsigned char); break;
+    case 'h': GET_BUF_VAL(short); break;
+    case 'H': GET_BUF_UVAL(unsigned short); break;
+    case 'i': GET_BUF_VAL(int); break;
+    case 'I': GET_BUF_UVAL(unsigned int); break;
+    case 'l': GET_BUF_VAL(long); break;
+    case 'L': GET_BUF_UVAL(unsigned long); break;
+    case 'q': GET_BUF_VAL(long long); break;
+    case 'Q': GET_BUF_UVAL(unsigned long long); break;
+    }
+    return 0;
+  }
+
+  item = PySequence_Fast_GET_ITEM(arr->seq, i);
+  if ((num = PyNumber_Index(item)) == NULL) {
+    return -1;
+  }
+  v = PyLong_AsUnsignedLongLong(num);
+  Py_DECREF(num);
+  if (v == (unsigned long long)-1 && PyErr_Occurred()) {
+    return -1;
+  }
+  *val = v;
+  return 0;
+
+ negative:
+  PyErr_SetString(PyExc_OverflowError,
+                  "can't convert negative value to unsigned int");
+  return -1;
+}
+
+void
+pyts_u64_array_free(pyts_u64_array_t *arr)
+{
+  if (arr->have_view) {
+    PyBuffer_Release(&arr->view);
+    arr->have_view = 0;
+  }
+  Py_CLEAR(arr->seq);
+}
+
+const char *
+pyts_get_bytestr(PyObject *obj, Py_ssize_t *len)
+{
+  char *str;
+  Py_ssize_t slen;
+
+  if (!PyBytes_Check(obj)) {
+    PyErr_Format(PyExc_TypeError, "keys must be bytes, not %.200s",
+                 Py_TYPE(obj)->tp_name);
+    return NULL;
+  }
+  if (PyBytes_AsStringAndSize(obj, &str, &slen) != 0) {
+    return NULL;
+  }
+  if ((size_t)slen != strlen(str)) {
+    PyErr_SetString(PyExc_ValueError, "embedded null byte");
+    return NULL;
+  }
+  if (len != NULL) {
+    *len = slen;
+  }
+  return str;
+}
@@ -0,0 +1,86 @@
+/*
+ * Copyright (C) 2016 The Regents of the University of California.
+ *
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions are met:
+ *
+ * 1. Redistributions of source code must retain the above copyright notice,
+ *    this list of conditions and the following disclaimer.
+ *
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions and the following disclaimer in the documentation
+ *    and/or other materials provided with the distribution.
+ *
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ * ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+ * LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+ * CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ * SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+ * INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+ * CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ * POSSIBILITY OF SUCH DAMAGE.
+ */
+
+#include <Python.h>
+
+#ifndef ___pytimeseries_utils_H
+#define ___pytimeseries_utils_H
+
+#include <stdint.h>
+
+/** Read-only view over a Python array of unsigned integers.
+ *
+ * Objects that support the buffer protocol with a native integer format
+ * (e.g. array.array('Q') or a NumPy uint64 array) are read in place; any
+ * other sequence of Python ints is accessed item by item.
+ */
+typedef struct {
+  /* buffer view (only valid if have_view is set) */
+  Py_buffer view;
+  int have_view;
+
+  /* struct format character of the buffer items */
+  char fmt;
+
+  /* fast sequence (used if the object does not provide a usable buffer) */
+  PyObject *seq;
+
+  /* number of items */
+  Py_ssize_t len;
+} pyts_u64_array_t;
+
+/** Initialize an array view over the given object
+ *
+ * @param arr           pointer to the array view to initialize
+ * @param obj           Python object to view
+ * @param name          name of the argument (used in error messages)
+ * @return 0 if successful, -1 (with a Python exception set) otherwise
+ */
+int pyts_u64_array_init(pyts_u64_array_t *arr, PyObject *obj,
+                        const char *name);
+
+/** Get the value of the given item
+ *
+ * @param arr           pointer to the array view
+ * @param i             index of the item to get
+ * @param val[out]      set to the value of the item
+ * @return 0 if successful, -1 (with a Python exception set) otherwise
+ */
+int pyts_u64_array_get(pyts_u64_array_t *arr, Py_ssize_t i, uint64_t *val);
+
+/** Release the resources held by the given array view */
+void pyts_u64_array_free(pyts_u64_array_t *arr);
+
+/** Get a NUL-terminated byte string from the given object
+ *
+ * @param obj           Python bytes object
+ * @param len[out]      set to the length of the string (may be NULL)
+ * @return borrowed pointer to the string, or NULL (with a Python exception
+ * set) if the object is not a byte string without embedded NUL bytes
+ */
+const char *pyts_get_bytestr(PyObject *obj, Py_ssize_t *len);
+
+#endif /* ___pytimeseries_utils_H */
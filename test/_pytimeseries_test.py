@@ -26,6 +26,8 @@
 #
 
 import _pytimeseries
+import array
+import struct
 
 
 ts = _pytimeseries.Timeseries()
@@ -71,7 +73,15 @@ print()
 # try to set a single value
 print("Setting a single value:")
 print("Should look like: a.test.key 12345 532051200")
-print((ts.set_single("a.test.key", 12345, 532051200)))
+print((ts.set_single(b"a.test.key", 12345, 532051200)))
+print()
+
+# set values at several times without a key package
+print("Setting 3 values at 2 times:")
+print("Should look like: a.test.key 1 532051200, another.test.key 2 532051200"
+      " then a.test.key 3 532051260")
+print((ts.set_many([b"a.test.key", b"another.test.key", b"a.test.key"],
+                   [1, 2, 3], [532051200, 532051200, 532051260])))
 print()
 
 # create a key package
@@ -87,36 +97,188 @@ print()
 # add key to key package
 print("Adding Key to Key Package ('a.test.key'):")
 print("Should return 0")
-print((kp.add_key("a.test.key")))
+print((kp.add_key(b"a.test.key")))
 print("Adding 'another.test.key', should return 1:")
-print((kp.add_key("another.test.key")))
+print((kp.add_key(b"another.test.key")))
 print("Getting index of 'another.test.key', should return 1:")
-print((kp.get_key("another.test.key")))
+print((kp.get_key(b"another.test.key")))
 print("Getting index of 'a.test.key', should return 0:")
-print((kp.get_key("a.test.key")))
+print((kp.get_key(b"a.test.key")))
 print("Disabling 'a.test.key', should return None:")
-print((kp.disable_key(kp.get_key('a.test.key'))))
+print((kp.disable_key(kp.get_key(b'a.test.key'))))
 print("Enabling 'a.test.key', should return None:")
-print((kp.enable_key(kp.get_key('a.test.key'))))
+print((kp.enable_key(kp.get_key(b'a.test.key'))))
 print("Getting the current value of 'a.test.key', should return 0:")
-print((kp.get(kp.get_key('a.test.key'))))
+print((kp.get(kp.get_key(b'a.test.key'))))
 print("Setting the current value of 'a.test.key' to 12345:")
-print((kp.set(kp.get_key('a.test.key'), 12345)))
+print((kp.set(kp.get_key(b'a.test.key'), 12345)))
 print("Getting the current value of 'a.test.key', should return 12345:")
-print((kp.get(kp.get_key('a.test.key'))))
+print((kp.get(kp.get_key(b'a.test.key'))))
+print("Getting index of 'a.test.key' from a memoryview, should return 0:")
+print((kp.get_key(memoryview(b"a.test.key"))))
+print("Getting index of 'another.test.key' by offset and length in a buffer, "
+      "should return 1:")
+print((kp.get_key(b"xxanother.test.keyxx", 2, 16)))
 print("Forcing resolution of all keys, should return None:")
 print((kp.resolve()))
 print("Getting the number of keys, should return 2:")
 print((kp.size))
 print("Disabling 'another.test.key' and getting enabled size, should return 1:")
-kp.disable_key(kp.get_key('another.test.key'))
+kp.disable_key(kp.get_key(b'another.test.key'))
 print((kp.enabled_size))
 print("Flushing key package, should output 1 line of metrics and then None:")
 print((kp.flush(532051200)))
 print("Enabling 'another.test.key' and flushing, should output 2 lines of data:")
-kp.enable_key(kp.get_key('another.test.key'))
+kp.enable_key(kp.get_key(b'another.test.key'))
 kp.flush(532051200)
 print()
 
+# bulk updates
+print("Upserting 2 existing and 1 new key, should return 1:")
+print((kp.upsert_many([b"a.test.key", b"another.test.key", b"third.test.key"],
+                      [1, 2, 3])))
+print("Getting the current value of 'third.test.key', should return 3:")
+print((kp.get(kp.get_key(b"third.test.key"))))
+print("Setting values of keys 0 and 2 from an array, should return None:")
+print((kp.set_many(array.array('Q', [0, 2]), array.array('Q', [10, 30]))))
+print("Getting the current value of 'third.test.key', should return 30:")
+print((kp.get(kp.get_key(b"third.test.key"))))
+print()
+
+# TSKBATCH decoding
+print("Applying a TSKBATCH message with 2 key/values, should return "
+      "(532051200, 2):")
+msg = b"TSKBATCH" + struct.pack("!BLH", 0, 532051200, 4) + b"test"
+for (key, val) in [(b"a.test.key", 100), (b"fourth.test.key", 400)]:
+    msg += struct.pack("!H", len(key)) + key + struct.pack("!Q", val)
+print((kp.apply_tskbatch(msg, b"test")))
+print("Getting the current value of 'fourth.test.key', should return 400:")
+print((kp.get(kp.get_key(b"fourth.test.key"))))
+print()
+
+# line protocol
+print("Getting the intervals of a line protocol payload, should return "
+      "([532051200], 1):")
+lpf = (b"weather,location=us-midwest temperature=82 532051230000000000\n"
+       b"weather,location=us-midwest humidity=40i,note=\"text\" "
+       b"532051240000000000\n")
+print((_pytimeseries.lpf_times(lpf, 60)))
+print("Applying the payload to a new Key Package, should return 2:")
+kp_lpf = ts.new_keypackage(reset=True)
+print((kp_lpf.apply_lpf(lpf, 60, 532051200)))
+print("Getting the current value of "
+      "'weather.location.us-midwest.temperature', should return 82:")
+print((kp_lpf.get(kp_lpf.get_key(b"weather.location.us-midwest.temperature"))))
+print()
+
+# key snapshots
+print("Saving keys to a snapshot file, should return None:")
+print((kp.save_keys("/tmp/_pytimeseries_test.keys")))
+print("Creating a Key Package preloaded from the snapshot:")
+kp2 = ts.new_keypackage(reset=True, disable=True,
+                        preload="/tmp/_pytimeseries_test.keys")
+print("Getting the number of keys, should return 4:")
+print((kp2.size))
+print("Getting the number of enabled keys, should return 0:")
+print((kp2.enabled_size))
+print("Loading the snapshot again, should return 0 (no new keys):")
+print((kp2.load_keys("/tmp/_pytimeseries_test.keys")))
+print()
+
+# value views
+print("Getting a view over the values, should return [100, 2, 30, 400]:")
+vals = kp.values_view()
+print((vals.tolist()))
+print("Setting the value of 'fourth.test.key' through the view, "
+      "should return 4000:")
+vals[kp.get_key(b"fourth.test.key")] = 4000
+print((kp.get(kp.get_key(b"fourth.test.key"))))
+print("Disabling 'a.test.key' through the enabled view, should return 3:")
+enabled = kp.enabled_view()
+enabled[kp.get_key(b"a.test.key")] = 0
+print((kp.enabled_size))
+print("Adding more keys than were reserved while the views exist, "
+      "should raise BufferError:")
+try:
+    for i in range(4096):
+        kp.add_key(("view.test.key.%d" % i).encode())
+    print("no error")
+except BufferError as e:
+    print("BufferError: %s" % e)
+vals.release()
+enabled.release()
+print()
+
+# delta flushes
+print("Creating a delta Key Package with a full flush every 3 flushes:")
+kp3 = ts.new_keypackage(delta=True, full_every=3)
+print((kp3.delta, kp3.full_every))
+kp3.upsert_many([b"a.test.key", b"another.test.key"], [1, 2])
+print("Flushing, should output 2 lines of data (full flush):")
+kp3.flush(532051200)
+kp3.set(kp3.get_key(b"another.test.key"), 3)
+print("Flushing, should output 1 line of data ('another.test.key'):")
+kp3.flush(532051260)
+print("Getting the number of keys written, should return 1:")
+print((kp3.flushed_size))
+print("Flushing, should output no data:")
+kp3.flush(532051320)
+print("Flushing, should output 2 lines of data (full flush):")
+kp3.flush(532051380)
+print()
+
+# aggregation
+print("Creating a Key Package that adds up values, should return 'add':")
+kp4 = ts.new_keypackage(reset=True, aggregation="add")
+print((kp4.aggregation))
+print("Applying 2 partial counts for 'a.test.key', should return 5:")
+kp4.upsert_many([b"a.test.key", b"a.test.key"], [2, 3])
+print((kp4.get(kp4.get_key(b"a.test.key"))))
+print("Setting a lower value with max, should return 5:")
+kp4.set(kp4.get_key(b"a.test.key"), 1, agg="max")
+print((kp4.get(kp4.get_key(b"a.test.key"))))
+print("Flushing (1 line of data), then adding 4, should return 4:")
+kp4.flush(532051200)
+kp4.set(kp4.get_key(b"a.test.key"), 4)
+print((kp4.get(kp4.get_key(b"a.test.key"))))
+print()
+
+# key eviction
+print("Creating a Key Package with 3 keys, then writing 'third.test.key' "
+      "only, twice:")
+kp5 = ts.new_keypackage(reset=True, disable=True)
+kp5.upsert_many([b"a.test.key", b"another.test.key", b"third.test.key"],
+                [1, 2, 3])
+kp5.flush(532051200)
+kp5.upsert_many([b"third.test.key"], [30])
+kp5.flush(532051260)
+kp5.upsert_many([b"third.test.key"], [300])
+kp5.flush(532051320)
+print("Evicting keys idle for more than 60 seconds unless 90% of the keys "
+      "are, should return 0:")
+print((kp5.evict(60, min_fraction=0.9)))
+print("Evicting keys idle for more than 60 seconds, should return "
+      "(2, [-1, -1, 0]):")
+(cnt, remap) = kp5.evict(60, remap=True)
+print((cnt, remap.tolist()))
+print("Getting the index of 'third.test.key', should return 0:")
+print((kp5.get_key(b"third.test.key")))
+print("Getting the index of 'a.test.key', should return None:")
+print((kp5.get_key(b"a.test.key")))
+print("Listing the keys of the first Key Package from index 2, should return "
+      "[b'third.test.key', b'fourth.test.key', b'view.test.key.0', ...]:")
+print((list(kp.keys(2))[:3]))
+print()
+
+# copying key packages
+print("Copying the evicted Key Package (after setting 'third.test.key' to "
+      "3000) into a new one, should return None:")
+kp5.set(kp5.get_key(b"third.test.key"), 3000)
+kp6 = ts.new_keypackage(reset=True, disable=True)
+print((kp6.copy_from(kp5)))
+print("Getting the value of 'third.test.key' in the copy, should return 3000:")
+print((kp6.get(kp6.get_key(b"third.test.key"))))
+print()
+
 
 print("done!")
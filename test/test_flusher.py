@@ -0,0 +1,237 @@
+#
+# Copyright (C) 2017 The Regents of the University of California.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+Tests for flushing KeyPackages with Flusher and BackendFlusher.
+"""
+
+import threading
+import time
+import unittest
+
+import pytimeseries.tsk.flusher
+
+try:
+    import _pytimeseries
+except ImportError:
+    _pytimeseries = None
+
+
+class RecordingKP:
+    """Records its flushes (and copies), in place of a KeyPackage."""
+
+    def __init__(self, flushes, fail=False):
+        self.flushes = flushes
+        self.fail = fail
+        self.copied = []
+        # names of the threads that flushed this KP
+        self.flush_threads = []
+
+    def copy_from(self, kp):
+        self.copied = [(key, kp.get(kp.get_key(key))) for key in kp.keys()]
+
+    def flush(self, time):
+        if self.fail:
+            raise RuntimeError("flush failed")
+        self.flush_threads.append(threading.current_thread().name)
+        self.flushes.append((self, time, self.copied))
+
+
+class RecordingTimeseries:
+    """Creates RecordingKPs, in place of a Timeseries."""
+
+    def __init__(self, fail=False):
+        self.flushes = []
+        self.fail = fail
+        self.kps = []
+
+    def new_keypackage(self, **kp_opts):
+        kp = RecordingKP(self.flushes, self.fail)
+        self.kps.append(kp)
+        return kp
+
+
+class FlusherTest(unittest.TestCase):
+
+    def test_sync(self):
+        ts = RecordingTimeseries()
+        flusher = pytimeseries.tsk.flusher.Flusher([ts])
+        kp = flusher.acquire()
+        flusher.submit(kp, 60)
+        # flushed before submit returns, and then reused
+        self.assertEqual(ts.flushes, [(kp, 60, [])])
+        self.assertIs(flusher.acquire(), kp)
+        flusher.close()
+
+    def test_queued(self):
+        tss = [RecordingTimeseries(), RecordingTimeseries()]
+        flusher = pytimeseries.tsk.flusher.Flusher(tss, queue_depth=2,
+                                                   max_open=1)
+        kps = [flusher.acquire() for _ in range(3)]
+        self.assertEqual(len(set(kps)), 3)
+        for (i, kp) in enumerate(kps):
+            flusher.submit(kp, 60 * (i + 1))
+        flusher.close()
+        flushed = sorted(f[1] for ts in tss for f in ts.flushes)
+        self.assertEqual(flushed, [60, 120, 180])
+        # KPs are created in turn on each Timeseries
+        self.assertEqual([len(ts.kps) for ts in tss], [2, 1])
+
+    def test_thread_per_timeseries(self):
+        tss = [RecordingTimeseries(), RecordingTimeseries()]
+        flusher = pytimeseries.tsk.flusher.Flusher(tss, queue_depth=4,
+                                                   max_open=2)
+        for flush_time in range(60, 600, 60):
+            flusher.submit(flusher.acquire(), flush_time)
+        flusher.submit(flusher.acquire_late(), 0)
+        flusher.close()
+        self.assertEqual(len(tss[0].flushes) + len(tss[1].flushes), 10)
+        # every KP is only ever flushed by the thread of its Timeseries
+        for (i, ts) in enumerate(tss):
+            for kp in ts.kps:
+                self.assertEqual(set(kp.flush_threads),
+                                 set(["flusher-%d" % i]))
+
+    def test_late(self):
+        ts = RecordingTimeseries()
+        flusher = pytimeseries.tsk.flusher.Flusher([ts])
+        kp = flusher.acquire()
+        late = flusher.acquire_late()
+        self.assertIsNot(late, kp)
+        flusher.submit(late, 60)
+        flusher.submit(kp, 120)
+        self.assertEqual(ts.flushes, [(late, 60, []), (kp, 120, [])])
+        self.assertIs(flusher.acquire_late(), late)
+        self.assertIs(flusher.acquire(), kp)
+
+    def test_failed_flush(self):
+        flusher = pytimeseries.tsk.flusher.Flusher(
+            [RecordingTimeseries(fail=True)], queue_depth=1)
+        flusher.submit(flusher.acquire(), 60)
+        for thread in flusher.threads:
+            thread.join(0.1)
+        # the flush thread hands the KP back, and the error is raised
+        with self.assertRaises(RuntimeError):
+            flusher.acquire()
+        with self.assertRaises(RuntimeError):
+            flusher.close()
+
+    def test_delta(self):
+        with self.assertRaises(ValueError):
+            pytimeseries.tsk.flusher.Flusher([RecordingTimeseries()],
+                                             queue_depth=1, delta=True)
+
+
+# the source KPs of a BackendFlusher are real KeyPackages
+@unittest.skipUnless(_pytimeseries, "the _pytimeseries extension is not built")
+class BackendFlusherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backends = {"a": RecordingTimeseries(),
+                         "b": RecordingTimeseries()}
+        self.flushed = []
+        self.flusher = pytimeseries.tsk.flusher.BackendFlusher(
+            self.backends, queue_depth=2, max_open=1,
+            on_flush=lambda name, _: self.flushed.append(name))
+
+    def wait_idle(self, name):
+        backend = self.flusher.backends[sorted(self.backends).index(name)]
+        while backend.pending:
+            time.sleep(0.001)
+
+    def fill(self, kp, values):
+        for (key, value) in values:
+            idx = kp.get_key(key)
+            if idx is None:
+                idx = kp.add_key(key)
+            kp.set(idx, value)
+
+    def test_copies_to_each_backend(self):
+        kps = []
+        for (i, flush_time) in enumerate([60, 120, 180]):
+            kp = self.flusher.acquire()
+            self.fill(kp, [(b"test.key.%d" % i, flush_time)])
+            self.flusher.submit(kp, flush_time)
+            kps.append(kp)
+            # so that no interval is dropped
+            self.wait_idle("a")
+            self.wait_idle("b")
+        self.flusher.close()
+        self.assertEqual(sorted(self.flushed), ["a"] * 3 + ["b"] * 3)
+        for ts in self.backends.values():
+            # each source KP is always copied into the same backend KP
+            self.assertEqual(len(ts.kps), len(set(kps)))
+            by_time = dict((flush_time, copied) for (_, flush_time, copied)
+                           in ts.flushes)
+            self.assertEqual(sorted(by_time), [60, 120, 180])
+            for (i, flush_time) in enumerate([60, 120, 180]):
+                self.assertIn((b"test.key.%d" % i, flush_time),
+                              by_time[flush_time])
+        self.assertEqual(self.flusher.pending, 0)
+
+    def test_kp_reused_once_copied(self):
+        kp = self.flusher.acquire()
+        self.fill(kp, [(b"test.key", 1)])
+        self.flusher.submit(kp, 60)
+        self.flusher.close()
+        self.assertIs(self.flusher.acquire(), kp)
+
+    def test_slow_backend_drops_oldest(self):
+        gate = threading.Event()
+        blocked = threading.Event()
+        slow = self.flusher.backends[0]
+        real_release = slow.release
+
+        def release(src):
+            # hold up the thread of backend "a" after its first copy
+            real_release(src)
+            if threading.current_thread() is slow.thread:
+                blocked.set()
+                gate.wait()
+        slow.release = release
+
+        for flush_time in [60, 120, 180, 240]:
+            kp = self.flusher.acquire()
+            self.fill(kp, [(b"test.key", flush_time)])
+            self.flusher.submit(kp, flush_time)
+            blocked.wait()
+            self.wait_idle("b")
+        # with "a" busy on 60 and a queue depth of 2, 120 is dropped
+        self.assertEqual(slow.dropped, 1)
+        gate.set()
+        self.flusher.close()
+        for (name, times) in [("a", [60, 180, 240]),
+                              ("b", [60, 120, 180, 240])]:
+            self.assertEqual(sorted(flush_time for (_, flush_time, _)
+                                    in self.backends[name].flushes), times)
+
+    def test_delta(self):
+        with self.assertRaises(ValueError):
+            pytimeseries.tsk.flusher.BackendFlusher(self.backends, delta=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
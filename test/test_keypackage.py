@@ -0,0 +1,100 @@
+#
+# Copyright (C) 2017 The Regents of the University of California.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+Tests for writing KeyPackage values through views.
+"""
+
+import threading
+import unittest
+
+try:
+    import _pytimeseries
+except ImportError:
+    _pytimeseries = None
+
+KEY_CNT = 1000
+
+
+@unittest.skipUnless(_pytimeseries, "the _pytimeseries extension is not built")
+class ValuesViewTest(unittest.TestCase):
+
+    def setUp(self):
+        ts = _pytimeseries.Timeseries()
+        self.kp = ts.new_keypackage(reset=True, disable=True)
+        self.indices = [self.kp.add_key(b"test.key.%d" % i)
+                        for i in range(KEY_CNT)]
+        self.kp.flush(0)
+        self.vals = self.kp.values_view()
+        self.enabled = self.kp.enabled_view()
+
+    def tearDown(self):
+        self.vals.release()
+        self.enabled.release()
+
+    def test_flush_resets_views(self):
+        for idx in self.indices[:10]:
+            self.vals[idx] = idx + 1
+            self.enabled[idx] = 1
+        self.assertEqual(self.kp.enabled_size, 10)
+        self.kp.flush(60)
+        self.assertEqual(self.kp.flushed_size, 10)
+        # the views are still valid, and were reset by the flush
+        self.assertEqual(self.vals.tolist(), [0] * KEY_CNT)
+        self.assertEqual(self.enabled.tolist(), [0] * KEY_CNT)
+        self.vals[self.indices[0]] = 7
+        self.enabled[self.indices[0]] = 1
+        self.kp.flush(120)
+        self.assertEqual(self.kp.flushed_size, 1)
+
+    def test_write_during_flush(self):
+        # values written while another thread flushes are either written by
+        # that flush or left for the next one
+        stop = threading.Event()
+
+        def flush():
+            flush_time = 60
+            while not stop.is_set():
+                self.kp.flush(flush_time)
+                flush_time += 60
+
+        thread = threading.Thread(target=flush)
+        thread.start()
+        try:
+            for i in range(20000):
+                idx = self.indices[i % KEY_CNT]
+                self.vals[idx] = i
+                self.enabled[idx] = 1
+        finally:
+            stop.set()
+            thread.join()
+        self.kp.flush(1)
+        self.assertEqual(self.vals.tolist(), [0] * KEY_CNT)
+        self.assertEqual(self.kp.enabled_size, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
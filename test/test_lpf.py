@@ -0,0 +1,139 @@
+#
+# Copyright (C) 2017 The Regents of the University of California.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+Tests for the InfluxDB line protocol (LPF) support of the TSK proxy.
+"""
+
+import unittest
+
+import pytimeseries.tsk.proxy
+import pytimeseries.utils
+
+try:
+    import _pytimeseries
+except ImportError:
+    _pytimeseries = None
+
+# 60s and 120s, in nanoseconds
+T60 = b"60000000000"
+T120 = b"120000000000"
+
+# (escaped, unescaped) tag values
+TAG_VALUES = [
+    (b"plain", "plain"),
+    (b"a.b", "a.b"),
+    (b"a/b", "a/b"),
+    (b"a\\ b", "a b"),
+    (b"a\\,b\\=c", "a,b=c"),
+    (b"10.0.0.0/8", "10.0.0.0/8"),
+]
+
+
+class FakeConsumer:
+    """Stands in for a Kafka consumer, which these tests do not read from."""
+
+    def subscribe(self, topics):
+        pass
+
+    def close(self):
+        pass
+
+
+@unittest.skipUnless(_pytimeseries, "the _pytimeseries extension is not built")
+class LpfKeyTest(unittest.TestCase):
+
+    def test_nodes_match_graphite_safe_node(self):
+        for (escaped, value) in TAG_VALUES:
+            kvs, invalid = _pytimeseries.lpf_decode(
+                b"m,tag=" + escaped + b" f=1i " + T60, 60)
+            node = pytimeseries.utils.graphite_safe_node(value).encode()
+            self.assertEqual(invalid, 0)
+            self.assertEqual(kvs, [(60, b"m.tag." + node + b".f", 1)])
+
+    def test_apply_lpf_uses_same_keys(self):
+        ts = _pytimeseries.Timeseries()
+        kp = ts.new_keypackage(reset=True)
+        payload = b"\n".join(b"m,tag=" + escaped + b" f=2i " + T60
+                             for (escaped, _) in TAG_VALUES)
+        kvs, _ = _pytimeseries.lpf_decode(payload, 60, b"pfx")
+        self.assertEqual(kp.apply_lpf(payload, 60, 60, b"pfx"), len(kvs))
+        self.assertEqual([key for (_, key, _) in kvs], list(kp.keys()))
+
+    def test_decode(self):
+        payload = b"\n".join([
+            b"cpu,host=h1 user=1i,sys=2.5,name=\"x\" " + T60,
+            b"not a point",
+            b"cpu,host=h1 user=3i " + T120,
+        ])
+        kvs, invalid = _pytimeseries.lpf_decode(payload, 60)
+        self.assertEqual(kvs, [
+            (60, b"cpu.host.h1.user", 1),
+            (60, b"cpu.host.h1.sys", 2),
+            (120, b"cpu.host.h1.user", 3),
+        ])
+        # the string field and the malformed line
+        self.assertEqual(invalid, 2)
+
+
+@unittest.skipUnless(_pytimeseries, "the _pytimeseries extension is not built")
+class LpfReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reader = pytimeseries.tsk.proxy.LpfReader(
+            "tsk-test", "test-channel", "tsk-test", "localhost:9092",
+            interval=60, key_prefix="lpf", consumer=FakeConsumer())
+
+    def tearDown(self):
+        self.reader.close()
+
+    def test_handle_msg(self):
+        calls = []
+
+        def msg_cb(msg_time, version, channel, msgbuf, msgbuflen):
+            calls.append((msg_time, version, channel))
+
+        def kv_cb(key, val):
+            calls.append((key, val))
+
+        payload = b"\n".join([
+            b"cpu,host=h\\ 1 user=1i " + T120,
+            b"cpu,host=h\\ 1 user=2i,name=\"x\" " + T60,
+            b"cpu,host=h\\ 1 sys=3i " + T120,
+        ])
+        self.reader.handle_msg(payload, msg_cb, kv_cb)
+        self.assertEqual(calls, [
+            (120, None, b"test-channel"),
+            (b"lpf.cpu.host.h 1.user", 1),
+            (b"lpf.cpu.host.h 1.sys", 3),
+            (60, None, b"test-channel"),
+            (b"lpf.cpu.host.h 1.user", 2),
+        ])
+        self.assertEqual(self.reader.invalid_counter.value, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,327 @@
+#
+# Copyright (C) 2017 The Regents of the University of California.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+Tests for the TSK proxy's imports, configuration checks and handling of
+intervals.
+"""
+
+import asyncio
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+import pytimeseries.tsk.aio
+import pytimeseries.tsk.proxy
+
+try:
+    import _pytimeseries
+except ImportError:
+    _pytimeseries = None
+
+EXAMPLE_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              os.pardir, 'config', 'tsk-proxy.conf.example')
+
+
+def loaded_lazy_modules(code):
+    """
+    Run code in a fresh interpreter (since other tests import both modules)
+    and get those of confluent_kafka and _pytimeseries that it imported.
+    """
+    out = subprocess.check_output([sys.executable, '-c', code + """
+import sys
+print(' '.join(m for m in ('confluent_kafka', '_pytimeseries')
+               if m in sys.modules))
+"""])
+    return out.split()
+
+
+class ProxyImportTest(unittest.TestCase):
+
+    def test_lazy_imports(self):
+        self.assertEqual(loaded_lazy_modules("import pytimeseries.tsk.proxy"),
+                         [])
+
+    def test_check_config_lazy_imports(self):
+        self.assertEqual(loaded_lazy_modules(
+            "import pytimeseries.tsk.proxy\n"
+            "pytimeseries.tsk.proxy.check_config(%r)" % EXAMPLE_CONFIG), [])
+
+
+class CheckConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        with open(EXAMPLE_CONFIG) as fh:
+            self.example = fh.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_config(self, config):
+        path = os.path.join(self.tmpdir, 'tsk-proxy.conf')
+        with open(path, 'w') as fh:
+            fh.write(config)
+        return path
+
+    def run_check(self, path, *args):
+        return subprocess.run(
+            [sys.executable, '-m', 'pytimeseries.tsk.proxy', '-c', path,
+             '--check-config'] + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def test_example(self):
+        self.assertEqual(pytimeseries.tsk.proxy.check_config(EXAMPLE_CONFIG),
+                         [])
+        proc = self.run_check(EXAMPLE_CONFIG)
+        self.assertEqual(proc.returncode, 0)
+        self.assertEqual(proc.stderr, b"")
+
+    def test_problems(self):
+        path = self.write_config(
+            self.example.replace("loglevel = DEBUG", "loglevel = NOISY")
+            .replace("backends = ascii", "backends = ascii,nonexistent"))
+        self.assertEqual(pytimeseries.tsk.proxy.check_config(path), [
+            "Unknown log level 'NOISY'",
+            "Missing option 'nonexistent-opts' in section [timeseries]",
+        ])
+        proc = self.run_check(path)
+        self.assertEqual(proc.returncode, 1)
+        self.assertIn(b"Unknown log level 'NOISY'", proc.stderr)
+
+    @unittest.skipUnless(_pytimeseries,
+                         "the _pytimeseries extension is not built")
+    def test_unknown_backend(self):
+        path = self.write_config(self.example.replace(
+            "backends = ascii", "backends = ascii,nonexistent\n"
+                                "nonexistent-opts ="))
+        self.assertEqual(pytimeseries.tsk.proxy.check_config(path), [])
+        self.assertEqual(self.run_check(path).returncode, 0)
+        self.assertEqual(
+            pytimeseries.tsk.proxy.check_config(path, check_backends=True),
+            ["Unknown TS backend 'nonexistent'"])
+        proc = self.run_check(path, '--check-backends')
+        self.assertEqual(proc.returncode, 1)
+        self.assertIn(b"Unknown TS backend 'nonexistent'", proc.stderr)
+
+    def test_invalid_value(self):
+        path = self.write_config(self.example + "\n[kafka]\n")
+        self.assertEqual(self.run_check(path).returncode, 1)
+        path = self.write_config(self.example.replace(
+            "[timeseries]", "[timeseries]\nflush_queue_depth = many"))
+        problems = pytimeseries.tsk.proxy.check_config(path)
+        self.assertEqual(len(problems), 1)
+        self.assertIn("flush_queue_depth", problems[0])
+
+    def test_missing_file(self):
+        proc = self.run_check(os.path.join(self.tmpdir, 'missing.conf'))
+        self.assertEqual(proc.returncode, 1)
+        self.assertNotEqual(proc.stderr, b"")
+
+
+class FakeKP:
+    """A KeyPackage that only counts its keys, as needed by the proxy."""
+
+    size = 0
+    enabled_size = 0
+
+
+class RecordingFlusher:
+    """Records the KPs submitted, in place of a Flusher."""
+
+    def __init__(self):
+        self.late_kp = FakeKP()
+        self.submitted = []
+
+    def acquire(self):
+        return FakeKP()
+
+    def acquire_late(self):
+        return self.late_kp
+
+    def submit(self, kp, time):
+        self.submitted.append((kp, time))
+
+
+class FakeMessage:
+    """A message holding only its time, in place of a Kafka message."""
+
+    def __init__(self, msg_time):
+        self.msg_time = msg_time
+
+    def value(self):
+        return b"%d" % self.msg_time
+
+    def error(self):
+        return None
+
+    def partition(self):
+        return 0
+
+
+class FakeReader:
+    """Calls msg_cb for the time of each message, in place of TskReader."""
+
+    def apply_msg(self, msgbuf, msg_cb):
+        msg_cb(int(msgbuf), 1, b"test-channel", msgbuf, len(msgbuf))
+        return 0
+
+
+class ProxyIntervalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.handlers = [(signo, signal.getsignal(signo)) for signo in
+                         (signal.SIGTERM, signal.SIGINT, signal.SIGHUP)]
+        with open(EXAMPLE_CONFIG) as fh:
+            config = fh.read()
+        path = os.path.join(self.tmpdir, 'tsk-proxy.conf')
+        with open(path, 'w') as fh:
+            fh.write(config.replace("#reorder_window = 1", "reorder_window = 2")
+                     .replace("interval = 60", "interval = 0"))
+        # nothing is replayed: messages are handed to _handle_batch
+        self.proxy = pytimeseries.tsk.proxy.Proxy(
+            path, False, replay=[os.path.join(self.tmpdir, 'none.rec')])
+        self.proxy.tsk_reader = FakeReader()
+        self.flusher = self.proxy.flusher = RecordingFlusher()
+
+    def tearDown(self):
+        for (signo, handler) in self.handlers:
+            signal.signal(signo, handler)
+        shutil.rmtree(self.tmpdir)
+
+    def handle(self, *times):
+        self.proxy._handle_batch([FakeMessage(t) for t in times])
+
+    def flushed(self):
+        return [(kp is self.flusher.late_kp, time)
+                for (kp, time) in self.flusher.submitted]
+
+    def test_window(self):
+        self.handle(60, 120, 60)
+        self.assertEqual(sorted(self.proxy.intervals), [60, 120])
+        self.assertEqual(self.flushed(), [])
+        # a newer interval pushes the oldest out of the window
+        self.handle(180)
+        self.assertEqual(sorted(self.proxy.intervals), [120, 180])
+        self.assertEqual(self.flushed(), [(False, 60)])
+        self.assertEqual(self.proxy.watermark, 60)
+
+    def test_older_than_full_window(self):
+        self.handle(60, 120)
+        # 50 does not make room for itself by flushing 60, which is still
+        # open, but is written as late data
+        self.handle(50, 60)
+        self.assertEqual(sorted(self.proxy.intervals), [60, 120])
+        self.assertEqual(self.flushed(), [(True, 50)])
+        self.assertIsNone(self.proxy.watermark)
+        self.assertEqual(self.proxy.stat_late_messages.value, 1)
+
+    def test_late_flushed_once_per_batch(self):
+        self.handle(60, 120, 180)
+        self.assertEqual(self.flushed(), [(False, 60)])
+        # the late KP is only flushed when the late time changes and at the
+        # end of the batch
+        self.handle(60, 60, 240, 60, 30, 30)
+        self.assertEqual(self.flushed(), [(False, 60), (False, 120),
+                                          (True, 60), (True, 30)])
+        self.assertEqual(self.proxy.stat_late_messages.value, 5)
+        self.assertIsNone(self.proxy.late)
+
+
+class ThreadRecorder:
+    """Wraps an object, recording the threads that call one of its methods."""
+
+    def __init__(self, obj, method):
+        self.obj = obj
+        self.method = method
+        self.threads = []
+
+    def __getattr__(self, name):
+        if name != self.method:
+            return getattr(self.obj, name)
+
+        def call(*args):
+            self.threads.append(threading.current_thread())
+            return getattr(self.obj, name)(*args)
+        return call
+
+
+@unittest.skipUnless(_pytimeseries, "the _pytimeseries extension is not built")
+class AsyncProxyStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.handlers = [(signo, signal.getsignal(signo)) for signo in
+                         (signal.SIGTERM, signal.SIGINT, signal.SIGHUP)]
+        with open(EXAMPLE_CONFIG) as fh:
+            config = fh.read()
+        self.stats_file = os.path.join(self.tmpdir, 'stats.txt')
+        path = os.path.join(self.tmpdir, 'tsk-proxy.conf')
+        with open(path, 'w') as fh:
+            fh.write(config.replace("ts_opts =",
+                                    "ts_opts = -f %s" % self.stats_file))
+        self.proxy = pytimeseries.tsk.aio.AsyncProxy(
+            path, False, replay=[os.path.join(self.tmpdir, 'none.rec')])
+
+    def tearDown(self):
+        self.proxy.executor.shutdown(wait=True)
+        for (signo, handler) in self.handlers:
+            signal.signal(signo, handler)
+        shutil.rmtree(self.tmpdir)
+
+    def flush_stats(self):
+        # make the stats for the previous interval due
+        self.proxy.stats_time -= self.proxy.stats_interval
+        asyncio.run(self.proxy._maybe_flush_stats())
+
+    def test_stats_on_executor(self):
+        timeseries = _pytimeseries.Timeseries
+        ts = ThreadRecorder(timeseries(), 'enable_backend')
+        _pytimeseries.Timeseries = lambda: ts
+        try:
+            self.flush_stats()
+        finally:
+            _pytimeseries.Timeseries = timeseries
+        main = threading.current_thread()
+        self.assertEqual(len(ts.threads), 1)
+        self.assertIsNot(ts.threads[0], main)
+
+        kp = self.proxy.stats_kp.kp = ThreadRecorder(self.proxy.stats_kp.kp,
+                                                     'flush')
+        self.flush_stats()
+        self.assertEqual(len(kp.threads), 1)
+        self.assertIsNot(kp.threads[0], main)
+        with open(self.stats_file) as fh:
+            self.assertIn(".messages_cnt ", fh.read())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+#
+# Copyright (C) 2017 The Regents of the University of California.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+Tests for recording TSKBATCH messages with TskRecorder and replaying them
+with ReplayReader.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import pytimeseries.tsk.replay
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MESSAGES = [b"first", b"", b"x" * 1000, b"last"]
+
+
+class FakeClock:
+    """Stands in for the time module, with sleep() advancing time()."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.sleeps.append(secs)
+        self.now += secs
+
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def record(self, name, msgs):
+        path = os.path.join(self.tmpdir, name)
+        recorder = pytimeseries.tsk.replay.TskRecorder(path)
+        for msg in msgs:
+            recorder.write(msg)
+        recorder.close()
+        self.assertEqual(recorder.msg_cnt, len(msgs))
+        return path
+
+    def replay(self, paths, batch_size=3):
+        reader = pytimeseries.tsk.replay.ReplayReader(paths, "test-channel")
+        msgs = []
+        while True:
+            batch = reader.consume_batch(batch_size, 1)
+            if not batch:
+                break
+            for msg in batch:
+                self.assertIsNone(msg.error())
+                msgs.append(bytes(msg.value()))
+        self.assertTrue(reader.finished)
+        self.assertEqual(reader.msg_cnt, len(msgs))
+        reader.close()
+        return msgs
+
+    def test_plain(self):
+        self.assertEqual(self.replay([self.record("a.rec", MESSAGES)]),
+                         MESSAGES)
+
+    def test_gzip(self):
+        self.assertEqual(self.replay([self.record("a.rec.gz", MESSAGES)]),
+                         MESSAGES)
+
+    @unittest.skipIf(zstandard is None, "zstandard is not installed")
+    def test_zstd(self):
+        self.assertEqual(self.replay([self.record("a.rec.zst", MESSAGES)]),
+                         MESSAGES)
+
+    def test_rate(self):
+        path = self.record("a.rec", [b"%d" % i for i in range(10)])
+        reader = pytimeseries.tsk.replay.ReplayReader([path], "test-channel",
+                                                      rate=2)
+        clock = FakeClock()
+        real_time = pytimeseries.tsk.replay.time
+        pytimeseries.tsk.replay.time = clock
+        try:
+            # the first message is due after half a second
+            self.assertEqual(len(reader.consume_batch(10, 10)), 1)
+            self.assertEqual(clock.sleeps, [0.5])
+            # a timeout shorter than the wait to the next message does not
+            # release it early
+            self.assertEqual(reader.consume_batch(10, 0.2), [])
+            self.assertEqual(reader.consume_batch(10, 0.2), [])
+            self.assertEqual(len(reader.consume_batch(10, 0.2)), 1)
+            self.assertEqual(clock.now, 1001.0)
+            # messages that fell due while not consuming are released at once
+            clock.now += 2
+            self.assertEqual(len(reader.consume_batch(10, 10)), 4)
+            self.assertEqual(len(clock.sleeps), 4)
+        finally:
+            pytimeseries.tsk.replay.time = real_time
+        reader.close()
+
+    def test_several_files(self):
+        paths = [self.record("a.rec", MESSAGES[:2]),
+                 self.record("empty.rec", []),
+                 self.record("b.rec.gz", MESSAGES[2:])]
+        self.assertEqual(self.replay(paths, batch_size=10), MESSAGES)
+
+    def test_truncated(self):
+        path = self.record("a.rec", MESSAGES)
+        with open(path, 'r+b') as fh:
+            fh.truncate(os.path.getsize(path) - 1)
+        # the messages before the truncated one are still replayed
+        self.assertEqual(self.replay([path]), MESSAGES[:-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#
+# Copyright (C) 2017 The Regents of the University of California.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+Tests for ShardedKeyPackage.
+"""
+
+import unittest
+import zlib
+
+import pytimeseries.sharded
+
+try:
+    import _pytimeseries
+except ImportError:
+    _pytimeseries = None
+
+NSHARDS = 3
+KEYS = [b"test.key.%d" % i for i in range(20)]
+
+
+@unittest.skipUnless(_pytimeseries, "the _pytimeseries extension is not built")
+class ShardedKeyPackageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.kp = self.new_kp()
+
+    def tearDown(self):
+        self.kp.close()
+
+    def new_kp(self):
+        return pytimeseries.sharded.ShardedKeyPackage(
+            [_pytimeseries.Timeseries() for _ in range(NSHARDS)])
+
+    def test_stable_shards(self):
+        other = self.new_kp()
+        try:
+            for key in KEYS:
+                idx = self.kp.add_key(key)
+                self.assertEqual(idx % NSHARDS, zlib.crc32(key) % NSHARDS)
+                # the same key goes to the same shard of another KP
+                self.assertEqual(other.add_key(key) % NSHARDS, idx % NSHARDS)
+        finally:
+            other.close()
+        self.assertEqual(self.kp.size, len(KEYS))
+        self.assertEqual(sum(shard.size for shard in self.kp.shards),
+                         len(KEYS))
+
+    def test_index_round_trip(self):
+        indices = [self.kp.add_key(key) for key in KEYS]
+        self.assertEqual(len(set(indices)), len(KEYS))
+        for (i, (key, idx)) in enumerate(zip(KEYS, indices)):
+            self.assertEqual(self.kp.get_key(key), idx)
+            self.kp.set(idx, i * 10)
+        for (i, idx) in enumerate(indices):
+            self.assertEqual(self.kp.get(idx), i * 10)
+        self.assertIsNone(self.kp.get_key(b"test.key.missing"))
+        with self.assertRaises(IndexError):
+            self.kp.get(-1)
+
+    def test_upsert_and_set_many(self):
+        self.assertEqual(self.kp.upsert_many(KEYS, list(range(len(KEYS)))),
+                         len(KEYS))
+        # keys that already exist are not added again
+        self.assertEqual(self.kp.upsert_many(KEYS[:5], [0] * 5), 0)
+        indices = [self.kp.get_key(key) for key in KEYS]
+        self.assertEqual([self.kp.get(idx) for idx in indices[5:]],
+                         list(range(5, len(KEYS))))
+        self.kp.set_many(indices, [v * 2 for v in range(len(KEYS))])
+        self.assertEqual([self.kp.get(idx) for idx in indices],
+                         [v * 2 for v in range(len(KEYS))])
+        with self.assertRaises(ValueError):
+            self.kp.upsert_many(KEYS, [0])
+
+    def test_enable_disable_flush(self):
+        indices = [self.kp.add_key(key) for key in KEYS]
+        self.assertEqual(self.kp.enabled_size, len(KEYS))
+        self.kp.disable_key(indices[0])
+        self.kp.disable_key(indices[1])
+        self.assertEqual(self.kp.enabled_size, len(KEYS) - 2)
+        self.kp.enable_key(indices[1])
+        self.assertEqual(self.kp.enabled_size, len(KEYS) - 1)
+        self.kp.flush(60)
+        self.assertEqual(len(self.kp.shard_flush_times), NSHARDS)
+
+    def test_no_timeseries(self):
+        with self.assertRaises(ValueError):
+            pytimeseries.sharded.ShardedKeyPackage([])
+
+
+if __name__ == '__main__':
+    unittest.main()
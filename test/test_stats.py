@@ -0,0 +1,90 @@
+#
+# Copyright (C) 2017 The Regents of the University of California.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+Tests for the stats reported by the TSK proxy.
+"""
+
+import unittest
+
+import pytimeseries.tsk.stats
+
+try:
+    import _pytimeseries
+except ImportError:
+    _pytimeseries = None
+
+
+class StatsRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = pytimeseries.tsk.stats.StatsRegistry()
+        self.msgs = self.stats.counter("messages")
+        self.errors = self.stats.counter("errors")
+        self.kp_size = self.stats.gauge("kp_size")
+        self.latency = self.stats.histogram("latency", bounds=(10, 100))
+
+    def test_histogram(self):
+        # in microseconds: on a bound, between bounds, and past the last one
+        for usec in [10, 11, 100, 5000]:
+            self.latency.observe(usec / 1000000.0)
+        self.assertEqual([b.name for b in self.latency.buckets],
+                         ["latency.bucket_10us", "latency.bucket_100us",
+                          "latency.bucket_inf"])
+        self.assertEqual([b.value for b in self.latency.buckets], [1, 2, 1])
+        self.assertEqual(self.latency.count.value, 4)
+        self.assertEqual(self.latency.sum.value, 5121)
+
+    def test_snapshot(self):
+        self.msgs.value += 5
+        self.kp_size.value = 42
+        self.latency.observe(0.00005)
+        self.assertEqual(self.stats.snapshot(), (
+            {"messages": 5, "latency.bucket_100us": 1, "latency.count": 1,
+             "latency.sum_us": 50},
+            {"kp_size": 42}))
+        # counters are reset, gauges keep their value
+        self.assertEqual(self.stats.snapshot(), ({}, {"kp_size": 42}))
+
+    @unittest.skipUnless(_pytimeseries,
+                         "the _pytimeseries extension is not built")
+    def test_write(self):
+        kp = _pytimeseries.Timeseries().new_keypackage(reset=True)
+        self.stats.bind(kp, lambda name: "test.stats." + name)
+        self.assertEqual(kp.size, len(self.stats.counters))
+        self.msgs.value += 3
+        self.kp_size.value = 7
+        self.stats.write(kp)
+        for (key, value) in [(b"test.stats.messages", 3),
+                             (b"test.stats.errors", 0),
+                             (b"test.stats.kp_size", 7)]:
+            self.assertEqual(kp.get(kp.get_key(key)), value)
+        self.assertEqual(self.msgs.value, 0)
+        self.assertEqual(self.kp_size.value, 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+#
+# Copyright (C) 2017 The Regents of the University of California.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+Tests for the TSK proxy supervisor.
+"""
+
+import unittest
+
+import pytimeseries.tsk.supervisor
+
+
+class ParsePartitionsTest(unittest.TestCase):
+
+    def test_parse(self):
+        parse = pytimeseries.tsk.supervisor.parse_partitions
+        self.assertEqual(parse("3"), [3])
+        self.assertEqual(parse("0-3"), [0, 1, 2, 3])
+        self.assertEqual(parse("7, 0,2,4-5"), [0, 2, 4, 5, 7])
+        # overlapping ranges are merged
+        self.assertEqual(parse("0-2,1-3,2"), [0, 1, 2, 3])
+
+    def test_invalid(self):
+        parse = pytimeseries.tsk.supervisor.parse_partitions
+        for spec in ["", ",", "a", "1-b"]:
+            with self.assertRaises(ValueError):
+                parse(spec)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#
+# Copyright (C) 2017 The Regents of the University of California.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+Tests for writing values with Timeseries.set_many.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+try:
+    import _pytimeseries
+except ImportError:
+    _pytimeseries = None
+
+# Writes values with the ascii backend to the given file, first with the
+# file size limit set to 0 so that writing to it (and so the flush) fails,
+# then again once the limit is lifted. Prints whether the first set_many
+# failed.
+FAILING_BACKEND_SCRIPT = """
+import resource
+import signal
+import sys
+import _pytimeseries
+
+signal.signal(signal.SIGXFSZ, signal.SIG_IGN)
+ts = _pytimeseries.Timeseries()
+ts.enable_backend(ts.get_backend_by_name("ascii"), "-f " + sys.argv[1])
+soft, hard = resource.getrlimit(resource.RLIMIT_FSIZE)
+resource.setrlimit(resource.RLIMIT_FSIZE, (0, hard))
+keys = [b"failed.key.%d" % i for i in range(100000)]
+try:
+    ts.set_many(keys, [1] * len(keys), 60)
+    failed = False
+except RuntimeError:
+    failed = True
+resource.setrlimit(resource.RLIMIT_FSIZE, (soft, hard))
+ts.set_many([b"test.key"], [2], 120)
+del ts
+print(failed)
+"""
+
+
+@unittest.skipUnless(_pytimeseries, "the _pytimeseries extension is not built")
+class SetManyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_failed_flush_discards_values(self):
+        path = os.path.join(self.tmpdir, 'out.txt')
+        out = subprocess.check_output([sys.executable, '-c',
+                                       FAILING_BACKEND_SCRIPT, path])
+        if out.strip() != b"True":
+            self.skipTest("the ascii backend does not report write errors")
+        with open(path, 'rb') as fh:
+            lines = fh.read().splitlines()
+        # the keys of the failed flush are not written by the next one
+        self.assertEqual([line for line in lines if line.endswith(b" 120")],
+                         [b"test.key 2 120"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+#
+# Copyright (C) 2017 The Regents of the University of California.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+"""
+Tests for writing TSKBATCH messages with TskWriter and reading them back with
+TskReader.
+"""
+
+import unittest
+
+import pytimeseries.tsk.proxy
+import pytimeseries.tsk.writer
+
+
+class FakeConsumer:
+    """Stands in for a Kafka consumer, which these tests do not read from."""
+
+    def subscribe(self, topics):
+        pass
+
+    def close(self):
+        pass
+
+
+class RecordingProducer:
+    """Records the messages produced, in place of a Kafka producer."""
+
+    def __init__(self):
+        self.messages = []
+
+    def produce(self, topic, value, on_delivery=None):
+        # like librdkafka, copy the payload
+        self.messages.append((topic, bytes(value)))
+
+    def poll(self, timeout=0):
+        return 0
+
+    def flush(self, timeout=-1):
+        return 0
+
+
+class BytesProducer(RecordingProducer):
+    """
+    Only accepts bytes payloads, like confluent_kafka's produce() (which
+    rejects writable buffers and memoryviews).
+    """
+
+    def __init__(self):
+        RecordingProducer.__init__(self)
+        self.rejected = 0
+
+    def produce(self, topic, value, on_delivery=None):
+        if not isinstance(value, bytes):
+            self.rejected += 1
+            raise TypeError("argument 2 must be read-only bytes-like object, "
+                            "not %s" % type(value).__name__)
+        RecordingProducer.produce(self, topic, value, on_delivery)
+
+
+class TskWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.writer = pytimeseries.tsk.writer.TskWriter(
+            "tsk-test", "test-channel", "localhost:9092", max_msg_size=100,
+            producer=RecordingProducer())
+        self.reader = pytimeseries.tsk.proxy.TskReader(
+            "tsk-test", "test-channel", "tsk-test", "localhost:9092",
+            consumer=FakeConsumer())
+
+    def tearDown(self):
+        self.reader.close()
+
+    def read_back(self):
+        """Decode the messages produced, as (time, key, value) tuples."""
+        kvs = []
+        for (topic, msg) in self.writer.producer.messages:
+            self.assertEqual(topic, "tsk-test.test-channel")
+            self.assertLessEqual(len(msg), self.writer.max_msg_size)
+            times = []
+            self.reader.handle_msg(
+                msg, lambda msg_time, *_: times.append(msg_time),
+                lambda key, val: kvs.append((times[-1], key, val)))
+        return kvs
+
+    def test_round_trip(self):
+        written = [(60, b"a.key.%d" % i, i * 1000) for i in range(10)]
+        written.append((120, b"b.key", 2 ** 64 - 1))
+        for (msg_time, key, value) in written[:5]:
+            self.writer.write(msg_time, key, value)
+        self.writer.write_many(60, [k for (_, k, _) in written[5:10]],
+                               [v for (_, _, v) in written[5:10]])
+        self.writer.write(*written[10])
+        self.writer.flush()
+        # 100-byte messages hold up to 4 of these key/values, and a change
+        # of time starts a new message
+        self.assertEqual(self.writer.msg_cnt, 4)
+        self.assertEqual(self.read_back(), written)
+
+    def test_write_many_error_keeps_written(self):
+        with self.assertRaises(ValueError):
+            self.writer.write_many(60, [b"a", b"b", b"x" * 100, b"c"],
+                                   [1, 2, 3, 4])
+        # the key/values before the one that does not fit are kept, and
+        # later writes carry on after them
+        self.writer.write(60, b"d", 5)
+        self.writer.flush()
+        self.assertEqual(self.read_back(),
+                         [(60, b"a", 1), (60, b"b", 2), (60, b"d", 5)])
+
+    def test_buffer_passed_through(self):
+        values = []
+        self.writer.producer.produce = \
+            lambda topic, value, on_delivery=None: values.append(value)
+        self.writer.write(60, b"a", 1)
+        self.writer.flush()
+        self.assertEqual(len(values), 1)
+        self.assertIsInstance(values[0], memoryview)
+        self.assertFalse(self.writer.copy_payload)
+
+    def test_bytes_only_producer(self):
+        self.writer.producer = BytesProducer()
+        self.writer.write(60, b"a", 1)
+        self.writer.write(120, b"b", 2)
+        self.writer.flush()
+        # the payload is only offered as a buffer once
+        self.assertEqual(self.writer.producer.rejected, 1)
+        self.assertTrue(self.writer.copy_payload)
+        self.assertEqual(self.read_back(), [(60, b"a", 1), (120, b"b", 2)])
+
+
+if __name__ == '__main__':
+    unittest.main()